@@ -1,18 +1,20 @@
 # --- FILE: app/activity_review_dialog.py ---
+import numpy as np
 import pandas as pd
 from PySide6.QtWidgets import (
-    QDialog, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem,
+    QDialog, QVBoxLayout, QHBoxLayout, QTableView,
     QLabel, QPushButton, QSplitter, QTextEdit, QHeaderView, QComboBox,
     QMessageBox, QGroupBox, QAbstractItemView, QMenu, QCheckBox,
     QWidget, QLineEdit, QFormLayout, QSizePolicy  # <--- Added QSizePolicy
 )
-from PySide6.QtCore import Qt, Signal, QSize
+from PySide6.QtCore import Qt, Signal, QSize, QAbstractTableModel, QModelIndex
 from PySide6.QtGui import QColor, QBrush, QAction, QFont
 
 # --- New Imports for Enhanced Table ---
 from app.excel_filter import FilterableHeaderView
-from app.widgets import NumericTableWidgetItem, DateTableWidgetItem, SORT_ROLE
+from app.invoice_table_model import InvoiceTableModel, InvoiceFilterIndex
 from app.constants import Columns
+from invoice_schema import set_values, STATUS_MANUAL_VALUES
 
 # Standard codes taxed at "Local da Prestação" (LC 116/03 - Art. 3 Exceções)
 LOCAL_PRESTACAO_CODES = [
@@ -21,6 +23,127 @@ LOCAL_PRESTACAO_CODES = [
     '1705', '1710'
 ]
 
+LOCAL_TOMADOR_STATUS = 'Local_Tomador'
+
+
+def _truncate_description(val):
+    text = str(val)
+    return text[:100] + "..." if len(text) > 100 else text
+
+
+class ActivityInvoiceModel(InvoiceTableModel):
+    """
+    Invoice table of the activity review: the shared virtual model with the raw
+    column names as headers and 'Local Tomador' rows in red.
+    """
+    HEADER_MAP = {}
+    COLUMN_FORMATTERS = {**InvoiceTableModel.COLUMN_FORMATTERS,
+                         Columns.SERVICE_DESCRIPTION: _truncate_description}
+
+    def __init__(self, df, visible_columns, parent=None, row_positions=None):
+        super().__init__(df, visible_columns, parent=parent, row_positions=row_positions)
+        self.color_tomador = QColor("#BF616A")
+
+    def _compute_status(self, positions):
+        super()._compute_status(positions)
+        if not hasattr(self, '_is_tomador'):
+            self._is_tomador = np.zeros(len(self._df), dtype=bool)
+        if 'status_manual' in self._df.columns:
+            self._is_tomador[positions] = (self._df['status_manual'].iloc[positions] == LOCAL_TOMADOR_STATUS).to_numpy()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.ForegroundRole and index.isValid() and self._is_tomador[self._rows[index.row()]]:
+            return self.color_tomador
+        return super().data(index, role)
+
+
+class ActivitySummaryModel(QAbstractTableModel):
+    """
+    Summary by activity code (count, total value, 'Local Tomador' flags).
+    Built from one groupby; later edits apply per-code deltas, so only the
+    affected entries change (new codes are appended, emptied codes removed).
+    """
+    HEADERS = ["Código", "Descrição (Excel)", "Qtd Notas", "Valor Total", "Status Local"]
+
+    def __init__(self, summary, activity_data, parent=None):
+        super().__init__(parent)
+        self.activity_data = activity_data
+        # code -> [count, total, n_tomador]; row order = initial order (value desc)
+        self._codes = [str(c) for c in summary.index]
+        self._stats = {str(code): [int(r['count']), float(r['total']), int(r['tomador'])]
+                       for code, r in summary.iterrows()}
+        self.color_local = QColor("#D08770")
+        self.color_local_text = QColor("white")
+
+    def code_at(self, row):
+        return self._codes[row]
+
+    def apply_delta(self, delta, sign):
+        """Adds (sign=+1) or subtracts (sign=-1) a per-code summary of some rows."""
+        changed = []
+        for code, r in delta.iterrows():
+            code = str(code)
+            if code not in self._stats:
+                row = len(self._codes)
+                self.beginInsertRows(QModelIndex(), row, row)
+                self._codes.append(code)
+                self._stats[code] = [0, 0.0, 0]
+                self.endInsertRows()
+            stats = self._stats[code]
+            stats[0] += sign * int(r['count'])
+            stats[1] += sign * float(r['total'])
+            stats[2] += sign * int(r['tomador'])
+            changed.append(code)
+
+        for code in changed:
+            row = self._codes.index(code)
+            if self._stats[code][0] <= 0:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                self._codes.pop(row)
+                del self._stats[code]
+                self.endRemoveRows()
+            else:
+                self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.HEADERS) - 1))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._codes)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        code = self._codes[index.row()]
+        count, total, n_tomador = self._stats[code]
+        is_local = code in LOCAL_PRESTACAO_CODES
+        col = index.column()
+
+        if role == Qt.DisplayRole:
+            if col == 0:
+                return code
+            if col == 1:
+                if self.activity_data and code in self.activity_data:
+                    return self.activity_data[code][0][0]
+                return "Não encontrado no Excel"
+            if col == 2:
+                return str(count)
+            if col == 3:
+                return f"R$ {total:,.2f}"
+            status = "📍 LOCAL PRESTAÇÃO" if is_local else "Normal"
+            return f"{status} ({n_tomador} Local Tomador)" if n_tomador else status
+        if is_local and role == Qt.BackgroundRole:
+            return self.color_local
+        if is_local and role == Qt.ForegroundRole:
+            return self.color_local_text
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+
 class ActivityReviewDialog(QDialog):
     """
     Dialog allowing the user to:
@@ -39,9 +162,9 @@ class ActivityReviewDialog(QDialog):
         self.df = invoices_df
         self.activity_data = activity_data # Dictionary from main.py
         
-        # Ensure status column exists
+        # Ensure status column exists (categorical, like the rest of the schema)
         if 'status_manual' not in self.df.columns:
-            self.df['status_manual'] = ''
+            self.df['status_manual'] = pd.Categorical([''] * len(self.df), categories=STATUS_MANUAL_VALUES)
 
         # Helper list for ComboBoxes (Code - Description)
         # We store the FULL text here
@@ -52,9 +175,11 @@ class ActivityReviewDialog(QDialog):
                 self.code_list.append(f"{code} - {desc}")
             self.code_list.sort()
 
-        # State for Table
+        # State for Table (row positions into self.df; no copies of the frame)
         self.current_summary_code = None 
-        self.current_display_df = self.df.copy() 
+        self._base_positions = np.arange(len(self.df))  # summary code + text filters
+        self._filter_index = InvoiceFilterIndex(self.df)
+        self.invoice_model = None
         
         # Filter State
         self.active_filters = [] 
@@ -81,15 +206,11 @@ class ActivityReviewDialog(QDialog):
         summary_group = QGroupBox("Resumo por Código de Atividade (Clique para filtrar)")
         summary_layout = QVBoxLayout(summary_group)
         
-        self.summary_table = QTableWidget()
-        self.summary_table.setColumnCount(5)
-        self.summary_table.setHorizontalHeaderLabels([
-            "Código", "Descrição (Excel)", "Qtd Notas", "Valor Total", "Status Local"
-        ])
-        self.summary_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        self.summary_table = QTableView()
+        self.summary_table.verticalHeader().setVisible(False)
         self.summary_table.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.summary_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
-        self.summary_table.cellClicked.connect(self.on_summary_row_clicked)
+        self.summary_table.clicked.connect(lambda index: self.on_summary_row_clicked(index.row(), index.column()))
         self.summary_table.setAlternatingRowColors(True)
         self.summary_table.setMaximumHeight(200)
         
@@ -146,7 +267,8 @@ class ActivityReviewDialog(QDialog):
         invoice_layout.addWidget(self.filters_container)
         
         # --- The Table ---
-        self.invoice_table = QTableWidget()
+        self.invoice_table = QTableView()
+        self.invoice_table.verticalHeader().setVisible(False)
         self.invoice_table.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.invoice_table.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.invoice_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
@@ -160,8 +282,6 @@ class ActivityReviewDialog(QDialog):
         header.customContextMenuRequested.connect(self.show_column_context_menu)
         self.invoice_table.setHorizontalHeader(header)
         
-        self.invoice_table.itemSelectionChanged.connect(self.on_invoice_selection_changed)
-        
         # Enable Right-Click Context Menu on Rows
         self.invoice_table.setContextMenuPolicy(Qt.CustomContextMenu)
         self.invoice_table.customContextMenuRequested.connect(self.open_context_menu)
@@ -232,123 +352,102 @@ class ActivityReviewDialog(QDialog):
         filter_widgets["layout"].deleteLater()
         self.refresh_table()
 
-    def _apply_filters_to_df(self, df):
-        if df is None or df.empty or not self.active_filters: return df
-        filtered_df = df.copy()
+    def _text_filters_mask(self):
+        """'Contém' / 'Não Contém' filters as one boolean mask over self.df (cached per column/text)."""
+        mask = np.ones(len(self.df), dtype=bool)
         for f in self.active_filters:
             column_name = f["combo"].currentText()
             filter_text = f["edit"].text().strip().lower()
-            logic_mode = f["logic"].currentText()
-            if filter_text and column_name in filtered_df.columns:
-                try:
-                    col_series = filtered_df[column_name].astype(str).str.lower()
-                    mask = col_series.str.contains(filter_text, na=False, regex=False)
-                    if logic_mode == "Contém": filtered_df = filtered_df[mask]
-                    else: filtered_df = filtered_df[~mask]
-                except Exception: pass
-        return filtered_df
+            if filter_text and column_name in self.df.columns:
+                matches = self._filter_index.contains_mask(column_name, filter_text)
+                mask &= matches if f["logic"].currentText() == "Contém" else ~matches
+        return mask
+
+    @property
+    def current_display_df(self):
+        """Rows after the summary code and text filters (materialized on demand)."""
+        return self.df.iloc[self._base_positions]
 
     # --- TABLE LOADING LOGIC ---
 
+    def _summarize(self, positions=None):
+        """count / total value / 'Local Tomador' flags per activity code (one groupby)."""
+        df = self.df if positions is None else self.df.iloc[positions]
+        parts = pd.DataFrame({
+            'code': df['CÓDIGO DA ATIVIDADE'],
+            'count': df['NÚMERO'].notna(),
+            'total': pd.to_numeric(df['VALOR'], errors='coerce'),
+            'tomador': df['status_manual'] == LOCAL_TOMADOR_STATUS,
+        })
+        return parts.groupby('code', observed=True).agg(count=('count', 'sum'), total=('total', 'sum'), tomador=('tomador', 'sum'))
+
     def load_summary_table(self):
-        self.summary_table.setRowCount(0)
-        if 'CÓDIGO DA ATIVIDADE' not in self.df.columns: return
-        summary = self.df.groupby('CÓDIGO DA ATIVIDADE').agg({
-            'VALOR': 'sum', 'NÚMERO': 'count'
-        }).reset_index().sort_values('VALOR', ascending=False)
-        self.summary_table.setRowCount(len(summary))
-        
-        for row_idx, row_data in summary.iterrows():
-            code = str(row_data['CÓDIGO DA ATIVIDADE'])
-            count = row_data['NÚMERO']
-            value = row_data['VALOR']
-            desc = "Não encontrado no Excel"
-            if self.activity_data and code in self.activity_data:
-                desc = self.activity_data[code][0][0]
-            is_local = code in LOCAL_PRESTACAO_CODES
-            local_status = "📍 LOCAL PRESTAÇÃO" if is_local else "Normal"
-            items = [
-                QTableWidgetItem(code), QTableWidgetItem(desc),
-                QTableWidgetItem(str(count)), QTableWidgetItem(f"R$ {value:,.2f}"),
-                QTableWidgetItem(local_status)
-            ]
-            if is_local:
-                color = QColor("#D08770")
-                for it in items: it.setBackground(color); it.setForeground(QColor("white"))
-            for c, it in enumerate(items): self.summary_table.setItem(row_idx, c, it)
+        if 'CÓDIGO DA ATIVIDADE' not in self.df.columns:
+            self.summary_model = None
+            return
+        summary = self._summarize().sort_values('total', ascending=False)
+        self.summary_model = ActivitySummaryModel(summary, self.activity_data, self.summary_table)
+        self.summary_table.setModel(self.summary_model)
+        self.summary_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+
+    def _update_rows(self, indices, columns, mutate):
+        """
+        Applies `mutate()` to the given invoices (index labels) and refreshes only
+        what depends on them: summary entries of the old/new codes, cached
+        strings and filter masks of the edited columns.
+        """
+        positions = self.df.index.get_indexer_for(indices)
+        positions = positions[positions >= 0]
+        track_summary = getattr(self, 'summary_model', None) is not None
+        if track_summary:
+            self.summary_model.apply_delta(self._summarize(positions), -1)
+        mutate()
+        if track_summary:
+            self.summary_model.apply_delta(self._summarize(positions), +1)
+
+        self._filter_index.invalidate_columns(columns)
+        self.invoice_table.horizontalHeader().invalidate_values(columns)
+        self.invoice_model.refresh_rows(indices)
+        self.refresh_table()
 
     def load_invoice_data(self, filter_code=None):
         self.current_summary_code = filter_code
         self.refresh_table()
 
-    def refresh_table(self):
-        self.invoice_table.blockSignals(True)
-        self.invoice_table.setSortingEnabled(False)
-        if self.current_summary_code:
-            temp_df = self.df[self.df['CÓDIGO DA ATIVIDADE'] == self.current_summary_code].copy()
-        else:
-            temp_df = self.df.copy()
-
-        self.current_display_df = self._apply_filters_to_df(temp_df)
-        self.invoice_table.column_mapping = self.visible_columns
-        self.invoice_table.horizontalHeader().set_dataframe(self.current_display_df)
-        self.invoice_table.setColumnCount(len(self.visible_columns))
-        self.invoice_table.setHorizontalHeaderLabels(self.visible_columns)
-        self.invoice_table.setRowCount(len(self.current_display_df))
-        
-        row_idx = 0
-        for original_idx, row in self.current_display_df.iterrows():
-            for col_idx, col_name in enumerate(self.visible_columns):
-                raw_val = row.get(col_name, '')
-                item = None
-                if col_name in ['VALOR', 'ALÍQUOTA', 'correct_rate', 'VALOR DEDUÇÃO']:
-                    display_text = f"{raw_val:,.2f}" if pd.notna(raw_val) and isinstance(raw_val, (int, float)) else str(raw_val)
-                    item = NumericTableWidgetItem(display_text)
-                    item.setData(SORT_ROLE, float(raw_val) if pd.notna(raw_val) else 0.0)
-                elif col_name == 'DATA EMISSÃO':
-                    display_text = ""; sort_val = pd.NaT
-                    if pd.notna(raw_val):
-                        if hasattr(raw_val, 'strftime'): display_text = raw_val.strftime('%d/%m/%Y'); sort_val = raw_val
-                        else: display_text = str(raw_val)
-                    item = DateTableWidgetItem(display_text)
-                    item.setData(SORT_ROLE, sort_val)
-                else:
-                    val_str = str(raw_val) if pd.notna(raw_val) else ""
-                    display_str = val_str[:100] + "..." if col_name == 'DISCRIMINAÇÃO DOS SERVIÇOS' and len(val_str) > 100 else val_str
-                    item = QTableWidgetItem(display_str)
-                    item.setData(Qt.UserRole + 1, val_str) 
-
-                if col_idx == 0: item.setData(Qt.UserRole, original_idx)
-                if str(row.get('status_manual', '')) == 'Local_Tomador':
-                    item.setForeground(QColor("#BF616A"))
-                self.invoice_table.setItem(row_idx, col_idx, item)
-            row_idx += 1
-        self.invoice_table.setSortingEnabled(True)
-        self.invoice_table.blockSignals(False)
+    def _ensure_invoice_model(self):
+        if self.invoice_model is not None and self.invoice_model.is_compatible(self.df, self.visible_columns):
+            return
+        self.invoice_model = ActivityInvoiceModel(self.df, self.visible_columns, parent=self.invoice_table,
+                                                  row_positions=self._base_positions)
+        self.invoice_table.setModel(self.invoice_model)
+        self.invoice_table.selectionModel().selectionChanged.connect(self.on_invoice_selection_changed)
         self.invoice_table.resizeColumnsToContents()
         try:
             desc_idx = self.visible_columns.index('DISCRIMINAÇÃO DOS SERVIÇOS')
             if self.invoice_table.columnWidth(desc_idx) > 400: self.invoice_table.setColumnWidth(desc_idx, 400)
         except: pass
 
+    def refresh_table(self):
+        mask = self._text_filters_mask()
+        if self.current_summary_code:
+            mask &= (self._filter_index.text_column('CÓDIGO DA ATIVIDADE') == self.current_summary_code)
+        self._base_positions = np.flatnonzero(mask)
+
+        self.invoice_table.column_mapping = self.visible_columns
+        header = self.invoice_table.horizontalHeader()
+        header.set_dataframe(self.df, row_positions=lambda: self._base_positions)
+        self._ensure_invoice_model()
+        self.apply_excel_filters()
+
     # --- ACTIONS & EVENTS ---
 
-    def apply_excel_filters(self, col_index, allowed_values):
+    def apply_excel_filters(self, col_index=None, allowed_values=None):
         header = self.invoice_table.horizontalHeader()
-        active_filters = header.filters 
-        for row in range(self.invoice_table.rowCount()):
-            should_show = True
-            for f_col_idx, allowed in active_filters.items():
-                col_name = self.visible_columns[f_col_idx]
-                item_0 = self.invoice_table.item(row, 0)
-                if not item_0: continue
-                original_idx = item_0.data(Qt.UserRole)
-                try:
-                    raw_val = self.current_display_df.at[original_idx, col_name]
-                    val_str = str(raw_val) if pd.notna(raw_val) else ""
-                except: val_str = ""
-                if val_str not in allowed: should_show = False; break
-            self.invoice_table.setRowHidden(row, not should_show)
+        mask = np.ones(len(self.df), dtype=bool)
+        for f_col_idx, allowed in header.filters.items():
+            if f_col_idx < len(self.visible_columns):
+                mask &= self._filter_index.values_mask(self.visible_columns[f_col_idx], allowed)
+        self.invoice_model.set_row_positions(self._base_positions[mask[self._base_positions]])
 
     def show_column_context_menu(self, pos):
         menu = QMenu(self)
@@ -369,7 +468,7 @@ class ActivityReviewDialog(QDialog):
         self.refresh_table()
 
     def on_summary_row_clicked(self, row, col):
-        code = self.summary_table.item(row, 0).text()
+        code = self.summary_model.code_at(row)
         self.load_invoice_data(filter_code=code)
         self.desc_viewer.clear()
 
@@ -378,38 +477,32 @@ class ActivityReviewDialog(QDialog):
         self.load_invoice_data(filter_code=None)
         self.desc_viewer.clear()
 
-    def on_invoice_selection_changed(self):
+    def on_invoice_selection_changed(self, *args):
         selected_rows = self.invoice_table.selectionModel().selectedRows()
         if not selected_rows: return
-        last_row = selected_rows[-1].row()
-        item = self.invoice_table.item(last_row, 0)
-        if item:
-            original_idx = item.data(Qt.UserRole)
-            full_desc = self.df.loc[original_idx, 'DISCRIMINAÇÃO DOS SERVIÇOS']
-            self.desc_viewer.setPlainText(str(full_desc))
+        original_idx = self.invoice_model.data(selected_rows[-1], Qt.UserRole)
+        full_desc = self.df.loc[original_idx, 'DISCRIMINAÇÃO DOS SERVIÇOS']
+        self.desc_viewer.setPlainText(str(full_desc))
 
     def get_selected_indices(self):
         selected_rows = self.invoice_table.selectionModel().selectedRows()
-        indices = []
-        for row_obj in selected_rows:
-            r = row_obj.row()
-            if not self.invoice_table.isRowHidden(r):
-                item = self.invoice_table.item(r, 0)
-                if item: indices.append(item.data(Qt.UserRole))
-        return indices
+        return [self.invoice_model.data(row_obj, Qt.UserRole) for row_obj in selected_rows]
 
     def set_local_tomador(self):
         indices = self.get_selected_indices()
         if not indices: QMessageBox.warning(self, "Aviso", "Selecione notas."); return
-        self.df.loc[indices, 'status_manual'] = 'Local_Tomador'
-        self.refresh_table() 
+        self._set_manual_status(indices, LOCAL_TOMADOR_STATUS)
         QMessageBox.information(self, "Sucesso", f"{len(indices)} notas marcadas.")
 
     def clear_manual_status(self):
         indices = self.get_selected_indices()
         if not indices: QMessageBox.warning(self, "Aviso", "Selecione notas."); return
-        self.df.loc[indices, 'status_manual'] = ''
-        self.refresh_table()
+        self._set_manual_status(indices, '')
+
+    def _set_manual_status(self, indices, status):
+        def apply_status():
+            set_values(self.df, indices, 'status_manual', status)
+        self._update_rows(indices, ['status_manual'], apply_status)
 
     def bulk_change_activity(self):
         indices = self.get_selected_indices()
@@ -470,16 +563,16 @@ class ActivityReviewDialog(QDialog):
             # Even if truncated, the code is at the start "1234 - Desc...", so split still works
             new_code = combo.currentText().split(' - ')[0].strip()
             
-            # Update the MAIN DataFrame
-            self.df.loc[indices, 'CÓDIGO DA ATIVIDADE'] = new_code
-            
-            if self.activity_data and new_code in self.activity_data:
-                self.df.loc[indices, 'activity_desc'] = self.activity_data[new_code][0][0]
-                self.df.loc[indices, 'correct_rate'] = self.activity_data[new_code][0][1]
+            def apply_new_code():
+                # Update the MAIN DataFrame
+                set_values(self.df, indices, 'CÓDIGO DA ATIVIDADE', new_code)
+                
+                if self.activity_data and new_code in self.activity_data:
+                    set_values(self.df, indices, 'activity_desc', self.activity_data[new_code][0][0])
+                    self.df.loc[indices, 'correct_rate'] = self.activity_data[new_code][0][1]
             
-            # Real-time update
-            self.load_summary_table()
-            self.refresh_table()
+            # Real-time update (only the affected rows and summary entries)
+            self._update_rows(indices, ['CÓDIGO DA ATIVIDADE', 'activity_desc', 'correct_rate'], apply_new_code)
             QMessageBox.information(self, "Sucesso", "Atividades atualizadas com sucesso.")
 
     def open_context_menu(self, position):
@@ -0,0 +1,58 @@
+# --- FILE: app/auto_membership.py ---
+"""
+Composição dos autos como posições (np.intp) no DataFrame mestre de notas.
+
+Cada auto guarda apenas auto_data['positions']; as linhas só são materializadas
+quando é preciso mostrá-las/calculá-las (auto_frame). Os arrays nunca são
+alterados in place: cada operação devolve um array novo, por isso dois autos
+(p.ex. os do "dividir auto") podem partilhar o mesmo.
+"""
+
+import numpy as np
+import pandas as pd
+
+EMPTY_POSITIONS = np.empty(0, dtype=np.intp)
+
+
+def positions_of(df, index_labels):
+    """Posições das etiquetas de índice em df (etiquetas desconhecidas são ignoradas)."""
+    if index_labels is None or len(index_labels) == 0:
+        return EMPTY_POSITIONS
+    positions = df.index.get_indexer_for(list(index_labels))
+    return positions[positions >= 0].astype(np.intp, copy=False)
+
+
+def auto_positions(auto_data):
+    positions = auto_data.get('positions')
+    return EMPTY_POSITIONS if positions is None else positions
+
+
+def has_invoices(auto_data):
+    return len(auto_positions(auto_data)) > 0
+
+
+def auto_frame(df, auto_data):
+    """Linhas do auto (cópia materializada a pedido, na ordem de atribuição)."""
+    return df.iloc[auto_positions(auto_data)]
+
+
+def auto_labels(df, auto_data):
+    return df.index[auto_positions(auto_data)]
+
+
+def add_positions(positions, new_positions):
+    """Acrescenta as posições que ainda não estão no auto (mantém a ordem; O(n + k))."""
+    new_positions = pd.unique(np.asarray(new_positions, dtype=np.intp))
+    new_positions = new_positions[~np.isin(new_positions, positions)]
+    if not len(new_positions):
+        return positions
+    return np.concatenate([positions, new_positions])
+
+
+def union_positions(autos):
+    """Posições atribuídas a pelo menos um auto (ordem da primeira ocorrência)."""
+    arrays = [auto_positions(a) for a in autos.values()]
+    arrays = [p for p in arrays if len(p)]
+    if not arrays:
+        return EMPTY_POSITIONS
+    return pd.unique(np.concatenate(arrays))
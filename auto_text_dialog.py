@@ -9,6 +9,7 @@ from pandas.api.types import is_datetime64_any_dtype
 # --- Local Application Imports ---
 from .constants import Columns
 from document_parts import format_invoice_numbers
+from invoice_schema import as_text
 
 
 class AutoTextDialog(QDialog):
@@ -121,7 +122,10 @@ class AutoTextDialog(QDialog):
 
             service_groups = {}
             if activity_code_col in df_invoices_para_listar.columns and activity_desc_col in df_invoices_para_listar.columns:
-                df_safe = df_invoices_para_listar.fillna({activity_code_col: 'N/A', activity_desc_col: 'N/A'})
+                # as_text: 'N/A' may not be one of the categories of the code/desc columns
+                df_safe = df_invoices_para_listar.assign(**{
+                    activity_code_col: as_text(df_invoices_para_listar[activity_code_col], 'N/A'),
+                    activity_desc_col: as_text(df_invoices_para_listar[activity_desc_col], 'N/A')})
                 for (code, desc), group in df_safe.groupby([activity_code_col, activity_desc_col]):
                     key = (str(code).strip(), str(desc).strip())
                     if key not in service_groups:
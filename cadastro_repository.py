@@ -0,0 +1,142 @@
+# --- FILE: cadastro_repository.py ---
+
+import os
+import re
+import logging
+import threading
+import pandas as pd
+from app.constants import Columns
+
+# Colunas base do cadastro (sempre presentes e sempre texto)
+CADASTRO_DTYPES = {Columns.CNPJ: str, Columns.RAZAO_SOCIAL: str, Columns.IMU: str,
+                   Columns.ENDERECO: str, Columns.CEP: str, Columns.EPAF_NUMERO: str}
+
+# Um repositório por ficheiro de cadastro (partilhado pela GUI e pelos workers)
+_REPOSITORIES = {}
+_REPOSITORIES_LOCK = threading.Lock()
+
+
+def get_cadastro_path(master_filepath):
+    """'{master}_cadastro{ext}' ao lado do ficheiro mestre."""
+    base, ext = os.path.splitext(master_filepath)
+    return f"{base}_cadastro{ext}"
+
+
+def _digits(value):
+    return re.sub(r'\D', '', str(value))
+
+
+class CadastroRepository:
+    """
+    Register of companies ({master}_cadastro.xlsx) loaded once and indexed by
+    CNPJ and IMU (digits only). The file is only re-read when its mtime/size
+    changes on disk; save() writes back and keeps the in-memory copy.
+    """
+
+    def __init__(self, cadastro_path):
+        self.cadastro_path = cadastro_path
+        self._lock = threading.RLock()
+        self._df = None
+        self._signature = None
+        self._by_cnpj = {}
+        self._by_clean_cnpj = {}
+        self._by_clean_imu = {}
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.cadastro_path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _set_frame(self, df):
+        for col in CADASTRO_DTYPES:
+            if col not in df.columns:
+                df[col] = ''
+            df[col] = df[col].fillna('').astype(str)
+        self._df = df.reset_index(drop=True)
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._by_cnpj, self._by_clean_cnpj, self._by_clean_imu = {}, {}, {}
+        for pos, (cnpj, imu) in enumerate(zip(self._df[Columns.CNPJ], self._df[Columns.IMU])):
+            self._by_cnpj.setdefault(cnpj, pos)
+            clean_cnpj, clean_imu = _digits(cnpj), _digits(imu)
+            if clean_cnpj:
+                self._by_clean_cnpj.setdefault(clean_cnpj, pos)
+            if clean_imu:
+                self._by_clean_imu.setdefault(clean_imu, pos)
+
+    def load(self, force=False):
+        """Returns the register as a DataFrame, re-reading the file only if it changed."""
+        with self._lock:
+            signature = self._file_signature()
+            if not force and self._df is not None and signature == self._signature:
+                return self._df
+
+            if signature is None:
+                df = pd.DataFrame(columns=list(CADASTRO_DTYPES.keys()))
+            else:
+                logging.info(f"Cadastro: a ler '{self.cadastro_path}' (alterado no disco).")
+                df = pd.read_excel(self.cadastro_path, dtype=CADASTRO_DTYPES)
+            self._set_frame(df)
+            self._signature = signature
+            return self._df
+
+    @property
+    def frame(self):
+        return self.load()
+
+    def _record_at(self, pos):
+        return None if pos is None else self._df.iloc[pos].to_dict()
+
+    def get_by_cnpj(self, cnpj):
+        """Exact match first (formatted as in the file), then digits-only match."""
+        with self._lock:
+            self.load()
+            pos = self._by_cnpj.get(cnpj)
+            if pos is None:
+                pos = self._by_clean_cnpj.get(_digits(cnpj))
+            return self._record_at(pos)
+
+    def get_by_imu(self, imu):
+        with self._lock:
+            self.load()
+            return self._record_at(self._by_clean_imu.get(_digits(imu)))
+
+    def upsert(self, record):
+        """
+        Updates the company with the same CNPJ (digits-only comparison) or appends it.
+        Returns True if a new company was added. Call save() to persist.
+        """
+        with self._lock:
+            self.load()
+            pos = self._by_clean_cnpj.get(_digits(record.get(Columns.CNPJ, '')))
+            if pos is None:
+                new_row = pd.DataFrame([{k: str(v) for k, v in record.items()}])
+                self._set_frame(pd.concat([self._df, new_row], ignore_index=True))
+                return True
+
+            for k, v in record.items():
+                if k not in self._df.columns:
+                    self._df[k] = ''
+                self._df.at[pos, k] = str(v)
+            self._rebuild_index()
+            return False
+
+    def save(self):
+        """Writes the in-memory register back to disk (no re-read afterwards)."""
+        with self._lock:
+            if self._df is None:
+                return
+            self._df.to_excel(self.cadastro_path, index=False)
+            self._signature = self._file_signature()
+
+
+def get_cadastro_repository(cadastro_path):
+    key = os.path.abspath(cadastro_path)
+    with _REPOSITORIES_LOCK:
+        repo = _REPOSITORIES.get(key)
+        if repo is None:
+            repo = _REPOSITORIES[key] = CadastroRepository(cadastro_path)
+        return repo
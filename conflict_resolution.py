@@ -0,0 +1,110 @@
+# --- FILE: conflict_resolution.py ---
+"""
+Resolução de notas duplicadas (mesmo número, conteúdos diferentes).
+
+Um único motor de ranking usado pelos dois carregadores (ficheiro único e
+multi-ano) e pelo DuplicateReviewDialog:
+
+    rank_conflicts(df)    -> marca '_is_conflict' e '_conflict_rank' (1 = versão sugerida)
+    resolve_conflicts(df) -> mantém a versão sugerida (ou as escolhidas pelo utilizador)
+
+Prioridade (igual ao antigo "Smart Sort"):
+    RPS != 1 > Regime != Simples Nacional > Maior Alíquota > Maior Valor > Maior Descrição
+"""
+
+import numpy as np
+import pandas as pd
+
+CONFLICT_COL = '_is_conflict'
+RANK_COL = '_conflict_rank'
+
+ID_SYNONYMS = ['NÚMERO', 'NUMERO', 'NUMBER', 'NO', 'Nº']
+RPS_SYNONYMS = ['Nº RPS', 'RPS', 'NO RPS', 'NUMERO RPS']
+REGIME_SYNONYMS = ['REGIME DE TRIBUTAÇÃO', 'REGIME', 'REGIME TRIBUTACAO']
+DESC_SYNONYMS = ['DISCRIMINAÇÃO DOS SERVIÇOS', 'DISCRIMINACAO DOS SERVICOS', 'DESCRIÇÃO', 'DESC']
+
+SIMPLES_REGIME_TEXT = "Optante pelo Simples Nacional"
+
+
+def find_column(columns, synonyms):
+    """Primeira coluna (comparação sem maiúsculas/minúsculas) que corresponde a um sinónimo."""
+    upper_cols = {str(c).upper().strip(): c for c in columns}
+    for name in synonyms:
+        if name.upper() in upper_cols:
+            return upper_cols[name.upper()]
+    return None
+
+
+def _numeric(df, col):
+    if col is None or col not in df.columns:
+        return np.zeros(len(df))
+    return pd.to_numeric(df[col], errors='coerce').fillna(0).to_numpy(dtype=float)
+
+
+def conflict_score(df):
+    """
+    Score composto por linha (menor = melhor): a posição de cada linha na
+    ordenação lexicográfica dos critérios de prioridade, calculada com um np.lexsort.
+    """
+    n = len(df)
+    rps_col = find_column(df.columns, RPS_SYNONYMS)
+    regime_col = find_column(df.columns, REGIME_SYNONYMS)
+    desc_col = find_column(df.columns, DESC_SYNONYMS)
+
+    rps_bad = (_numeric(df, rps_col) == 1).astype(np.int8)
+    if regime_col:
+        regime_bad = df[regime_col].astype(str).str.contains(SIMPLES_REGIME_TEXT, regex=False, na=False).to_numpy(dtype=np.int8)
+    else:
+        regime_bad = np.zeros(n, dtype=np.int8)
+    desc_len = df[desc_col].astype(str).str.len().fillna(0).to_numpy(dtype=float) if desc_col else np.zeros(n)
+
+    # np.lexsort: a última chave é a principal; colunas "maior é melhor" entram negadas
+    order = np.lexsort((-desc_len, -_numeric(df, 'VALOR'), -_numeric(df, 'ALÍQUOTA'), regime_bad, rps_bad))
+    score = np.empty(n, dtype=np.int64)
+    score[order] = np.arange(n)
+    return score
+
+
+def rank_conflicts(df, id_col=None):
+    """
+    Marca (in place) os grupos de notas com o mesmo número:
+        '_is_conflict'   -> o número aparece em mais de uma linha
+        '_conflict_rank' -> posição da linha dentro do grupo (1 = versão sugerida)
+    Devolve o número de notas em conflito.
+    """
+    id_col = id_col or find_column(df.columns, ID_SYNONYMS)
+    if id_col is None or df.empty:
+        df[CONFLICT_COL] = False
+        df[RANK_COL] = 1
+        return 0
+
+    codes, uniques = pd.factorize(df[id_col])
+    group_sizes = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    in_conflict = (codes >= 0) & (group_sizes[codes.clip(min=0)] > 1)
+
+    ranks = pd.Series(conflict_score(df)).groupby(codes).rank(method='first')
+    df[CONFLICT_COL] = in_conflict
+    df[RANK_COL] = ranks.fillna(1).to_numpy(dtype=np.int32)
+    return int((group_sizes > 1).sum())
+
+
+def default_winner_mask(df):
+    """Linhas mantidas pela resolução automática (sem conflito ou 1.ª do grupo)."""
+    if CONFLICT_COL not in df.columns:
+        return np.ones(len(df), dtype=bool)
+    if RANK_COL not in df.columns:
+        rank_conflicts(df)
+    in_conflict = df[CONFLICT_COL].fillna(False).to_numpy(dtype=bool)
+    return ~in_conflict | (df[RANK_COL].to_numpy() == 1)
+
+
+def resolve_conflicts(df, keep_index=None):
+    """
+    Remove as versões descartadas e as colunas auxiliares. `keep_index` (rótulos do
+    índice, p.ex. do DuplicateReviewDialog) substitui a sugestão automática.
+    """
+    if keep_index is not None:
+        resolved = df.loc[keep_index]
+    else:
+        resolved = df[default_winner_mask(df)]
+    return resolved.drop(columns=[c for c in (CONFLICT_COL, RANK_COL) if c in resolved.columns]).copy()
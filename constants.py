@@ -36,6 +36,8 @@ class Columns:
 # Other constants
 APP_NAME = "Caronte FFRM"
 SESSION_FILE_PREFIX = "session_"
+WORKSPACE_DIR_PREFIX = "workspace_"  # Per-company snapshot of the analyzed invoices (app/workspace_store.py)
+CACHE_DIR = "cache"  # Local cache folder (derived data that can be safely deleted)
 APP_VERSION = "1.1.0"  # Update this before every pyinstaller build
 GITHUB_REPO_OWNER = "Ostrensky" 
 GITHUB_REPO_NAME = "Caronte_FFRM"
@@ -1,232 +1,445 @@
 # --- FILE: data_loader.py ---
 
 import os
+import numpy as np
 import pandas as pd
 from datetime import datetime
-from document_parts import formatar_texto_multa, format_invoice_numbers, _format_currency_brl # ✅ Import currency formatterimport traceback
+from document_parts import formatar_texto_multa, format_invoice_numbers, format_invoice_number_groups, _format_currency_brl # ✅ Import currency formatterimport traceback
 import logging
 import locale
 # Import the loader, as it's still used by the wizard (even if not here)
 from app.pgdas_loader import _load_and_process_pgdas
 from app.config import get_custom_general_texts
+from cadastro_repository import get_cadastro_path, get_cadastro_repository
+from app.auto_membership import positions_of
 from statistics import mode # ✅ Import mode
 
-def _load_and_process_dams(dam_filepath):
+# --- DAM CSV INGESTION ---
+# Um único leitor para o CSV de DAMs: o mapa de créditos (alocação) e a tabela
+# do relatório derivam do mesmo DataFrame, lido uma vez por ficheiro.
+
+DAM_COLUMN_MAP = {
+    'codigoVerificacao': 'codigoVerificacao', 'Código Verificação': 'codigoVerificacao', 'Codigo Verificacao': 'codigoVerificacao',
+    'Código de Verificação': 'codigoVerificacao', 'Codigo': 'codigoVerificacao', 'Verificação': 'codigoVerificacao',
+    'referenciaPagamento': 'referenciaPagamento', 'Competência': 'referenciaPagamento', 'Referência': 'referenciaPagamento',
+    'receita': 'receita', 'Receita': 'receita',
+    'totalRecolher': 'totalRecolher', 'Valor': 'totalRecolher', 'Valor Pago': 'totalRecolher',
+    'tributo': 'tributo', 'Tributo': 'tributo',
+    'numerosDasNotas': 'numerosDasNotas', 'Notas': 'numerosDasNotas', 'Números das Notas': 'numerosDasNotas', 'Nota': 'numerosDasNotas'
+}
+
+# Cache por (caminho, mtime, tamanho) -> DataFrame tipado (não modificar o retorno)
+_DAM_FRAME_CACHE = {}
+_DAM_FRAME_CACHE_MAX = 8
+
+
+def _sniff_dam_csv_format(dam_filepath, sample_size=64 * 1024):
     """
-    Loads the DAMs file (CSV) robustly, handling UTF-8-SIG (BOM), Latin1, 
-    and both comma/semicolon separators.
-    
-    ✅ UPDATED: Now filters out DAMs that are not 'ISS Normal' or that have 
-    specific invoice numbers associated (meaning they are not 'Avulsos').
+    Detects (encoding, separator) once from the first bytes of the file.
+    UTF-8 (with or without BOM) is preferred; anything that fails to decode is Latin1.
+    The separator is the most frequent of ';', ',' and TAB on the header line.
     """
+    with open(dam_filepath, 'rb') as f:
+        head = f.read(sample_size)
+
+    try:
+        text = head.decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        if e.start >= len(head) - 3 and len(head) == sample_size:
+            # Caractere multibyte cortado no fim da amostra: continua a ser UTF-8
+            text = head[:e.start].decode('utf-8-sig')
+            encoding = 'utf-8-sig'
+        else:
+            text = head.decode('latin1')
+            encoding = 'latin1'
+
+    header = text.splitlines()[0] if text else ''
+    counts = {sep: header.count(sep) for sep in (';', ',', '\t')}
+    sep = max(counts, key=counts.get)
+    return encoding, (sep if counts[sep] > 0 else None)
+
+
+def _read_dam_csv(dam_filepath):
+    encoding, sep = _sniff_dam_csv_format(dam_filepath)
+    try:
+        return _read_dam_csv_with(dam_filepath, encoding, sep)
+    except UnicodeDecodeError:
+        # A amostra era UTF-8 mas o resto do ficheiro não (acentos latin1 só depois dos 64KB)
+        return _read_dam_csv_with(dam_filepath, 'latin1', sep)
+
+
+def _read_dam_csv_with(dam_filepath, encoding, sep):
     df_dams = None
-    
-    attempts = [
-        ('utf-8-sig', ','),
-        ('utf-8-sig', ';'),
-        ('latin1', ';'),
-        ('latin1', ',')
-    ]
-    
-    last_error = None
-    
-    for encoding, sep in attempts:
-        try:
-            df_dams = pd.read_csv(dam_filepath, sep=sep, decimal='.', thousands=',', encoding=encoding, on_bad_lines='skip')
-            if len(df_dams.columns) > 1:
-                break 
-        except Exception as e:
-            last_error = e
-            continue
-            
+    if sep:
+        df_dams = pd.read_csv(dam_filepath, sep=sep, decimal='.', thousands=',', encoding=encoding, on_bad_lines='skip')
     if df_dams is None or len(df_dams.columns) < 2:
-        try:
-            df_dams = pd.read_csv(dam_filepath, sep=None, engine='python', encoding='utf-8-sig', on_bad_lines='skip')
-        except:
-            raise ValueError(f"Não foi possível ler o arquivo DAM. Erro: {last_error}")
+        # Último recurso: sniffer do motor python
+        df_dams = pd.read_csv(dam_filepath, sep=None, engine='python', encoding=encoding, on_bad_lines='skip')
+    return df_dams
 
-    # --- CLEANUP HEADERS ---
+
+def _normalize_dam_columns(df_dams):
     df_dams.columns = df_dams.columns.astype(str).str.strip().str.replace(r'^[^\w]+', '', regex=True)
 
-    col_map = {
-        'codigoVerificacao': 'codigoVerificacao', 'Código Verificação': 'codigoVerificacao', 'Codigo Verificacao': 'codigoVerificacao',
-        'referenciaPagamento': 'referenciaPagamento', 'Competência': 'referenciaPagamento', 'Referência': 'referenciaPagamento',
-        'receita': 'receita', 'Receita': 'receita',
-        'totalRecolher': 'totalRecolher', 'Valor': 'totalRecolher', 'Valor Pago': 'totalRecolher',
-        # ✅ Added mapping for filters
-        'tributo': 'tributo', 'Tributo': 'tributo',
-        'numerosDasNotas': 'numerosDasNotas', 'Notas': 'numerosDasNotas', 'Números das Notas': 'numerosDasNotas', 'Nota': 'numerosDasNotas'
-    }
-    
+    lower_map = {k.lower(): v for k, v in DAM_COLUMN_MAP.items()}
     new_cols = {}
     for col in df_dams.columns:
         c_str = str(col).strip()
-        if c_str in col_map:
-            new_cols[col] = col_map[c_str]
-        else:
-            for k, v in col_map.items():
-                if k.lower() == c_str.lower():
-                    new_cols[col] = v; break
-    
+        target = DAM_COLUMN_MAP.get(c_str) or lower_map.get(c_str.lower())
+        if target:
+            new_cols[col] = target
     if new_cols:
         df_dams.rename(columns=new_cols, inplace=True)
 
-    # Validation
     if 'codigoVerificacao' not in df_dams.columns:
-        if len(df_dams.columns) >= 2: 
+        if len(df_dams.columns) >= 2:
             df_dams.rename(columns={
                 df_dams.columns[0]: 'codigoVerificacao',
                 df_dams.columns[1]: 'referenciaPagamento'
             }, inplace=True)
             if len(df_dams.columns) >= 5:
-                 df_dams.rename(columns={df_dams.columns[4]: 'totalRecolher'}, inplace=True)
+                df_dams.rename(columns={df_dams.columns[4]: 'totalRecolher'}, inplace=True)
         else:
             raise ValueError(f"Coluna 'codigoVerificacao' não encontrada.\nColunas lidas: {list(df_dams.columns)}")
+    return df_dams
 
-    # Process Data
-    dam_payments_map = {}
-    
-    for _, row in df_dams.iterrows():
-        try:
-            # ✅ FILTER 1: Tributo must be 'ISS Normal' (if column exists)
-            tributo_val = str(row.get('tributo', '')).strip()
-            if 'tributo' in df_dams.columns and tributo_val and tributo_val.lower() != 'iss normal':
-                continue
 
-            # ✅ FILTER 2: Must be 'Avulso' (Empty Invoice Numbers)
-            # If 'numerosDasNotas' has content (e.g., "193"), it is linked to a note and is NOT a free credit.
-            notas_val = row.get('numerosDasNotas')
-            if pd.notna(notas_val) and str(notas_val).strip() != '':
-                continue
+def _parse_dam_values(col):
+    """Accepts numbers already parsed by read_csv and BRL strings ('R$ 1.234,56')."""
+    if pd.api.types.is_numeric_dtype(col):
+        return col.astype(float)
+    is_str = col.map(lambda v: isinstance(v, str))
+    cleaned = (col.astype(str)
+               .str.replace('R$', '', regex=False)
+               .str.replace('.', '', regex=False)
+               .str.replace(',', '.', regex=False)
+               .str.strip())
+    return pd.to_numeric(cleaned.where(is_str, col), errors='coerce').astype(float)
 
-            # Parse Date (MM/YYYY)
-            ref_str = str(row.get('referenciaPagamento', '')).strip()
-            if not ref_str or len(ref_str) < 6: continue
-            
-            try:
-                if '/' in ref_str:
-                    parts = ref_str.split('/')
-                    key = f"{int(parts[0])}/{parts[1]}"
-                elif len(ref_str) == 6: # 012021
-                    m = int(ref_str[:2])
-                    y = ref_str[2:]
-                    key = f"{m}/{y}"
-                else:
-                    key = ref_str
-            except:
-                key = ref_str
-
-            # Parse Value
-            val_raw = row.get('totalRecolher', 0)
-            if isinstance(val_raw, str):
-                val_raw = val_raw.replace('R$', '').replace('.', '').replace(',', '.')
-            
-            val_float = float(val_raw)
-            
-            code = str(row.get('codigoVerificacao', '')).strip()
 
-            if key not in dam_payments_map:
-                dam_payments_map[key] = []
-            
-            dam_payments_map[key].append({
-                'val': val_float,
-                'code': code
-            })
-            
-        except Exception:
-            continue
+def _parse_dam_competencia(ref):
+    """
+    Vectorized 'MM/YYYY' | 'MMYYYY' -> 'M/YYYY' key (same rules as the old row loop).
+    References shorter than 6 characters get None (not usable for allocation).
+    """
+    has_slash = ref.str.contains('/', regex=False)
+    parts = ref.str.split('/')
+    month_part = parts.str[0].fillna('')
+    year_part = parts.str[1].fillna('')
+    slash_ok = has_slash & month_part.str.fullmatch(r'\s*\d+\s*')
+    slash_key = month_part.where(slash_ok, '0').str.strip().astype(int).astype(str) + '/' + year_part
 
-    return dam_payments_map
+    compact_ok = ~has_slash & (ref.str.len() == 6) & ref.str[:2].str.fullmatch(r'\d+')
+    compact_key = ref.str[:2].where(compact_ok, '0').astype(int).astype(str) + '/' + ref.str[2:]
 
-def _load_all_dams_formatted(dam_filepath):
+    key = ref.copy()
+    key = key.where(~slash_ok, slash_key)
+    key = key.where(~compact_ok, compact_key)
+    return key.where(ref.str.len() >= 6, None)
+
+
+def read_dam_report(dam_filepath):
     """
-    Loads the DAM CSV and formats it specifically for the Word report table.
-    Filters: Only 'ISS Normal' and empty 'numerosDasNotas' (Avulsas).
-    Uses robust loading to handle Brazilian CSV formats (semicolons, encoding).
+    Reads one raw DAM report (CSV or Excel) with normalized column names.
+    Module-level so it can run in a worker process (MultiYearPrepWorker).
     """
-    if not dam_filepath or not os.path.exists(dam_filepath):
-        return []
+    if dam_filepath.lower().endswith('.csv'):
+        df_dams = _read_dam_csv(dam_filepath)
+    else:
+        df_dams = pd.read_excel(dam_filepath)
+    return _normalize_dam_columns(df_dams)
+
+
+def consolidate_dam_reports(raw_frames):
+    """Concatenates raw DAM reports once, drops repeated (código, competência) rows and types them."""
+    full_dam_df = pd.concat(raw_frames, ignore_index=True)
+    full_dam_df['codigoVerificacao'] = full_dam_df['codigoVerificacao'].astype(str).str.strip()
+    subset_cols = ['codigoVerificacao']
+    if 'referenciaPagamento' in full_dam_df.columns: subset_cols.append('referenciaPagamento')
+    full_dam_df.drop_duplicates(subset=subset_cols, inplace=True)
+    return build_dam_frame(full_dam_df)
+
+
+def build_dam_frame(df_dams):
+    """
+    Typed DataFrame with only the 'ISS Normal' payments that have no invoice
+    numbers linked (Avulsos), from a raw report with normalized columns:
+
+        codigo (str), referencia (str), competencia ('M/YYYY' or None),
+        valor (float, NaN if unparseable), receita (float), tributo (str)
+    """
+    n = len(df_dams)
+
+    def text_col(name, default=''):
+        if name in df_dams.columns:
+            return df_dams[name].astype(str).str.strip()
+        return pd.Series([default] * n, index=df_dams.index, dtype=object)
+
+    # ✅ FILTER 1: Tributo must be 'ISS Normal' (if column exists; blank is accepted)
+    tributo = text_col('tributo')
+    keep = (tributo == '') | (tributo.str.lower() == 'iss normal')
+
+    # ✅ FILTER 2: Must be 'Avulso' (Empty Invoice Numbers)
+    if 'numerosDasNotas' in df_dams.columns:
+        notas = df_dams['numerosDasNotas']
+        keep &= notas.isna() | (notas.astype(str).str.strip() == '')
+
+    if 'totalRecolher' in df_dams.columns:
+        valor = _parse_dam_values(df_dams['totalRecolher'])
+    else:
+        valor = pd.Series(0.0, index=df_dams.index)
+    if 'receita' in df_dams.columns:
+        receita = pd.to_numeric(df_dams['receita'], errors='coerce').astype(float)
+    else:
+        receita = pd.Series(float('nan'), index=df_dams.index)
+
+    referencia = text_col('referenciaPagamento')
+    return pd.DataFrame({
+        'codigo': text_col('codigoVerificacao'),
+        'referencia': referencia,
+        'competencia': _parse_dam_competencia(referencia),
+        'valor': valor,
+        'receita': receita,
+        'tributo': tributo,
+    })[keep].reset_index(drop=True)
+
+
+def load_dam_frame(dam_source):
+    """
+    Returns the typed DAM frame (see build_dam_frame) for a CSV path, or the
+    frame itself when `dam_source` is already one (DAMs consolidated in memory).
+    File results are cached per (path + mtime + size); callers must not mutate them.
+    """
+    if isinstance(dam_source, pd.DataFrame):
+        return dam_source
+
+    stat = os.stat(dam_source)
+    cache_key = (os.path.abspath(dam_source), stat.st_mtime_ns, stat.st_size)
+    cached = _DAM_FRAME_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
 
     try:
-        # --- 1. ROBUST LOADING (Same as _load_and_process_dams) ---
-        df = None
-        attempts = [
-            ('utf-8-sig', ','), 
-            ('utf-8-sig', ';'), 
-            ('latin1', ';'), 
-            ('latin1', ',')
-        ]
-        
-        for encoding, sep in attempts:
-            try:
-                df = pd.read_csv(dam_filepath, sep=sep, decimal='.', thousands=',', encoding=encoding, on_bad_lines='skip')
-                if len(df.columns) > 1: break
-            except: continue
-            
-        if df is None or len(df.columns) < 2:
-             try: df = pd.read_csv(dam_filepath, sep=None, engine='python', encoding='utf-8-sig', on_bad_lines='skip')
-             except: return []
+        df_dams = _read_dam_csv(dam_source)
+    except Exception as e:
+        raise ValueError(f"Não foi possível ler o arquivo DAM. Erro: {e}")
+    frame = build_dam_frame(_normalize_dam_columns(df_dams))
 
-        # --- 2. NORMALIZE HEADERS (Fixes spaces, BOM, case) ---
-        df.columns = df.columns.astype(str).str.strip().str.replace(r'^[^\w]+', '', regex=True)
-        
-        col_map = {
-            'tributo': 'tributo', 'Tributo': 'tributo',
-            'numerosDasNotas': 'numerosDasNotas', 'Notas': 'numerosDasNotas', 'Números das Notas': 'numerosDasNotas',
-            'receita': 'receita', 'Receita': 'receita',
-            'totalRecolher': 'totalRecolher', 'Valor': 'totalRecolher', 'Valor Pago': 'totalRecolher',
-            'codigoVerificacao': 'codigoVerificacao', 'Código Verificação': 'codigoVerificacao',
-            'referenciaPagamento': 'referenciaPagamento', 'Competência': 'referenciaPagamento'
-        }
-        
-        new_cols = {}
-        for col in df.columns:
-            c_str = str(col).strip()
-            # Try exact match first, then case-insensitive
-            if c_str in col_map: 
-                new_cols[col] = col_map[c_str]
-            else:
-                for k, v in col_map.items():
-                    if k.lower() == c_str.lower(): 
-                        new_cols[col] = v; break
-        
-        if new_cols: df.rename(columns=new_cols, inplace=True)
+    if len(_DAM_FRAME_CACHE) >= _DAM_FRAME_CACHE_MAX:
+        _DAM_FRAME_CACHE.pop(next(iter(_DAM_FRAME_CACHE)))
+    _DAM_FRAME_CACHE[cache_key] = frame
+    return frame
 
-        # --- 3. FILTER & FORMAT ---
-        formatted_rows = []
-        for _, row in df.iterrows():
-            
-            # Filter A: Must be "ISS Normal" (Ignore others)
-            # We use .get() safely in case the column is missing in a specific file
-            tributo_raw = str(row.get('tributo', '')).strip()
-            if 'tributo' in df.columns and tributo_raw.lower() != "iss normal":
-                continue
 
-            # Filter B: Must NOT have Invoice Numbers (Avulsas only)
-            notas_raw = row.get('numerosDasNotas')
-            if pd.notna(notas_raw) and str(notas_raw).strip() != "":
-                # If field is not empty, it's linked to an invoice, so we skip it
-                continue
-            
-            # Prepare Values
-            val_pago = pd.to_numeric(row.get('totalRecolher'), errors='coerce')
-            val_receita = pd.to_numeric(row.get('receita'), errors='coerce')
-            
-            row_dict = {
-                'codigo': str(row.get('codigoVerificacao', '-')).strip(),
-                'competencia': str(row.get('referenciaPagamento', '-')),
-                'receita': _format_currency_brl(val_receita) if pd.notna(val_receita) else "R$ 0,00",
-                'valor_pago': _format_currency_brl(val_pago) if pd.notna(val_pago) else "R$ 0,00",
-                'tributo': tributo_raw if tributo_raw else '-',
-                'notas_associadas': "-" # Forced to dash since we filtered for empty
+def has_dam_source(dam_source):
+    """True for an in-memory DAM frame or an existing DAM file path."""
+    if isinstance(dam_source, pd.DataFrame):
+        return True
+    return bool(dam_source) and os.path.exists(dam_source)
+
+def _load_and_process_dams(dam_filepath):
+    """
+    Builds the DAM credit map used for allocation: {'M/YYYY': [{'val', 'code'}, ...]}.
+    Only 'ISS Normal' DAMs without linked invoice numbers ('Avulsos') are kept.
+    Accepts a CSV path or an in-memory DAM frame.
+    """
+    frame = load_dam_frame(dam_filepath)
+    usable = frame[frame['competencia'].notna() & frame['valor'].notna()]
+
+    dam_payments_map = {}
+    for key, val, code in zip(usable['competencia'], usable['valor'], usable['codigo']):
+        dam_payments_map.setdefault(key, []).append({'val': float(val), 'code': code})
+    return dam_payments_map
+
+def _load_all_dams_formatted(dam_filepath):
+    """
+    Formats the DAM CSV rows (same filters as the credit map) for the Word report table.
+    """
+    if not has_dam_source(dam_filepath):
+        return []
+
+    try:
+        frame = load_dam_frame(dam_filepath)
+        receita = frame['receita'].fillna(0.0).map(_format_currency_brl)
+        valor = frame['valor'].fillna(0.0).map(_format_currency_brl)
+        codigo = frame['codigo'].where(frame['codigo'] != '', '-')
+        tributo = frame['tributo'].where(frame['tributo'] != '', '-')
+        return [
+            {
+                'codigo': c,
+                'competencia': ref,
+                'receita': rec,
+                'valor_pago': val,
+                'tributo': trib,
+                'notas_associadas': "-"  # Forced to dash since we filtered for empty
             }
-            formatted_rows.append(row_dict)
-            
-        return formatted_rows
+            for c, ref, rec, val, trib in zip(codigo, frame['referencia'], receita, valor, tributo)
+        ]
 
     except Exception as e:
         logging.error(f"Error loading full DAMs table: {e}")
         return []
+
+# --- REPORT CONTEXT HELPERS ---
+# Achados e listas de notas dos autos calculados sobre tabelas "longas"
+# (uma linha por nota x achado / nota x auto) com um único groupby cada,
+# em vez de filtrar o DataFrame de notas várias vezes por auto e por mês.
+
+def _month_keys(dates):
+    """datetime64 -> ano*100 + mês (-1 para NaT)."""
+    months = np.asarray(dates, dtype='datetime64[ns]').astype('datetime64[M]')
+    valid = ~np.isnat(months)
+    numbers = months.astype(np.int64)
+    return np.where(valid, (numbers // 12 + 1970) * 100 + numbers % 12 + 1, -1)
+
+
+def _month_key_of_label(mes_ano):
+    """'MM/YYYY' -> ano*100 + mês (None se inválido)."""
+    try:
+        month, year = str(mes_ano).split('/')
+        return int(year) * 100 + int(month)
+    except ValueError:
+        return None
+
+
+def _periodo_text(min_date, max_date):
+    min_str, max_str = min_date.strftime('%m/%Y'), max_date.strftime('%m/%Y')
+    return min_str if min_str == max_str else f"{min_str} a {max_str}"
+
+
+def _collect_findings(company_invoices_df, infraction_mask):
+    """
+    Achados fora dos autos (decadência, prescrição, fora do município, local do
+    tomador) a partir de uma única agregação por (achado, grupo).
+    """
+    df = company_invoices_df
+    cols = df.columns
+    not_autuado = ~infraction_mask
+    selections = []  # (achado, máscara, grupo por linha ou None)
+
+    if 'status_legal' in cols and 'DATA EMISSÃO' in cols and 'NÚMERO' in cols:
+        status = df['status_legal']
+        selections.append(('achado_decadencia_nao_autuado', (status == 'Decadente').to_numpy(dtype=bool) & not_autuado, None))
+        selections.append(('achado_prescrito_nao_autuado', (status == 'Prescrito').to_numpy(dtype=bool) & not_autuado, None))
+
+    if all(col in cols for col in ['NATUREZA DA OPERAÇÃO', 'CÓDIGO DA ATIVIDADE', 'DATA EMISSÃO', 'NÚMERO']):
+        fora = (df['NATUREZA DA OPERAÇÃO'].astype(object).str.contains("Fora do Município", case=False, na=False)
+                & (df['CÓDIGO DA ATIVIDADE'] == '0702'))
+        selections.append(('achado_fora_municipio', fora.to_numpy(dtype=bool), None))
+
+    if 'status_manual' in cols and 'activity_desc' in cols and 'NÚMERO' in cols:
+        # groupby ignora descrições em falta, como antes
+        tomador = (df['status_manual'] == 'Local_Tomador').to_numpy(dtype=bool) & df['activity_desc'].notna().to_numpy()
+        selections.append(('achado_local_tomador', tomador, df['activity_desc']))
+
+    pieces = [(key, np.flatnonzero(mask), groups) for key, mask, groups in selections]
+    pieces = [p for p in pieces if len(p[1])]
+    if not pieces:
+        return {}
+
+    positions = np.concatenate([pos for _, pos, _ in pieces])
+    dates = df['DATA EMISSÃO'] if 'DATA EMISSÃO' in cols else pd.Series(pd.NaT, index=df.index)
+    long_df = pd.DataFrame({
+        'achado': np.repeat([key for key, _, _ in pieces], [len(pos) for _, pos, _ in pieces]),
+        'grupo': np.concatenate([np.full(len(pos), "", dtype=object) if groups is None
+                                 else groups.iloc[pos].astype(str).to_numpy(dtype=object)
+                                 for _, pos, groups in pieces]),
+        'data': pd.to_datetime(dates.iloc[positions], errors='coerce').to_numpy(),
+        'numero': df['NÚMERO'].iloc[positions].astype(str).to_numpy(dtype=object),
+    })
+    grouped = long_df.groupby(['achado', 'grupo'], sort=True)
+    summary = grouped['data'].agg(['min', 'max'])
+    group_texts = format_invoice_number_groups(long_df['numero'].to_numpy(), grouped.ngroup().to_numpy())
+
+    findings = {}
+    tomador_texts = []
+    for group_code, ((achado, grupo), row) in enumerate(summary.iterrows()):
+        nfs_numeros = group_texts[group_code]
+        if achado == 'achado_local_tomador':
+            desc = grupo or "Atividade Não Especificada"
+            tomador_texts.append(
+                f"NFes de nº(s) {nfs_numeros} foram desconsideradas pois o serviço '{desc}' tem tributação no local do tomador."
+            )
+        elif pd.notna(row['min']):
+            findings[achado] = {'periodo': _periodo_text(row['min'], row['max']), 'nfs_numeros': nfs_numeros}
+    if tomador_texts:
+        findings['achado_local_tomador'] = "\n".join(tomador_texts)
+    return findings
+
+
+def _split_compensated_invoices(company_invoices_df, report_autos):
+    """
+    Marca uma vez cada nota dos autos com (auto, competência) e separa-as,
+    por junção com a tabela de meses compensados (iss_apurado_op <= 0.01 pago
+    por DAM/PGDAS), em notas compensadas e notas que ficam no auto.
+
+    Returns (textos das notas compensadas pela ordem dos autos/meses,
+             {auto: (nfs_e_numeros, data mínima, data máxima)} das restantes,
+             autos sem notas válidas).
+    """
+    auto_codes, positions, empty_autos = [], [], set()
+    comp_rows = []
+    for code, (auto_key, auto_data, auto_info) in enumerate(report_autos):
+        auto_positions = pd.unique(positions_of(company_invoices_df, auto_info.get('invoices', [])))
+        if not len(auto_positions):
+            empty_autos.add(auto_key)
+            continue
+        auto_codes.append(np.full(len(auto_positions), code, dtype=np.int64))
+        positions.append(auto_positions)
+
+        # Meses compensados e a origem do pagamento
+        for mes_data in auto_data.get('dados_anuais', []):
+            if mes_data.get('iss_apurado_op', 0.0) > 0.01:
+                continue
+            month_key = _month_key_of_label(mes_data.get('mes_ano')) if mes_data.get('mes_ano') else None
+            if month_key is None:
+                continue
+            sources = []
+            if mes_data.get('dam_iss_pago', 0.0) > 0.001:
+                sources.append("DAM")
+            if mes_data.get('das_iss_pago', 0.0) > 0.001:
+                sources.append("PGDAS")
+            if not sources: continue
+            comp_rows.append((code, month_key, mes_data['mes_ano'], " e ".join(sources)))
+
+    if not positions:
+        return [], {}, empty_autos
+
+    positions = np.concatenate(positions)
+    has_numbers = 'NÚMERO' in company_invoices_df.columns
+    tagged = pd.DataFrame({
+        'auto': np.concatenate(auto_codes),
+        'data': company_invoices_df['DATA EMISSÃO'].iloc[positions].to_numpy(),
+        'numero': (company_invoices_df['NÚMERO'].iloc[positions].astype(str).to_numpy(dtype=object)
+                   if has_numbers else None),
+    })
+    tagged['mes'] = _month_keys(tagged['data'])
+
+    # (auto, mês): a primeira linha compensada de cada mês leva todas as notas desse mês
+    comp = pd.DataFrame(comp_rows, columns=['auto', 'mes', 'mes_ano', 'fonte']).drop_duplicates(['auto', 'mes'])
+    matched = tagged.merge(comp[['auto', 'mes']].assign(_comp=True), on=['auto', 'mes'], how='left')
+    is_compensated = matched['_comp'].notna().to_numpy()
+
+    compensated_texts = []
+    if has_numbers and is_compensated.any():
+        compensated = tagged[is_compensated]
+        month_texts = format_invoice_number_groups(
+            compensated['numero'].to_numpy(), list(zip(compensated['auto'].tolist(), compensated['mes'].tolist())))
+        for code, month_key, mes_ano, fonte in comp.itertuples(index=False):
+            nums = month_texts.get((code, month_key))
+            if nums:
+                # ✅ Format: "NFS-e 9 a 10 (Comp: 08/2021 via DAM) referente ao AUTO-001"
+                compensated_texts.append(f"NFS-e {nums} (Comp: {mes_ano} via {fonte}) referente ao {report_autos[code][0]}")
+
+    remaining = {}
+    rest = tagged[~is_compensated]
+    if has_numbers and not rest.empty:
+        summary = rest.groupby('auto', sort=False)['data'].agg(['min', 'max'])
+        auto_texts = format_invoice_number_groups(rest['numero'].to_numpy(), rest['auto'].to_numpy())
+        for code, row in summary.iterrows():
+            remaining[report_autos[code][0]] = (auto_texts[code], row['min'], row['max'])
+    return compensated_texts, remaining, empty_autos
     
 
 def create_context_for_generation(master_filepath, company_cnpj,
@@ -264,8 +477,7 @@ def create_context_for_generation(master_filepath, company_cnpj,
         
         logging.info("Data Loader: master_filepath parece ser um string válido. A tentar processar o caminho...")
 
-        base, ext = os.path.splitext(master_filepath)
-        cadastro_path = f"{base}_cadastro{ext}"
+        cadastro_path = get_cadastro_path(master_filepath)
 
         logging.info(f"Data Loader: Caminho do cadastro determinado como: '{cadastro_path}'")
         if not os.path.exists(cadastro_path):
@@ -283,7 +495,9 @@ def create_context_for_generation(master_filepath, company_cnpj,
 
         # ✅ --- INÍCIO DO BLOCO DE DEBUG BLINDADO ---
         try:
-            df_empresas = pd.read_excel(cadastro_path, dtype={'cnpj': str, 'imu': str, 'cep': str, 'epaf_numero': str})
+            # Repositório em cache: só volta a ler o Excel se o ficheiro mudou (mtime)
+            cadastro_repo = get_cadastro_repository(cadastro_path)
+            df_empresas = cadastro_repo.load()
         
         except PermissionError as pe:
             # Erro específico de ficheiro bloqueado
@@ -302,10 +516,10 @@ def create_context_for_generation(master_filepath, company_cnpj,
             raise e
         
         logging.info(f"Data Loader: Leitura do Excel concluída com sucesso. {len(df_empresas)} linhas lidas.")
-        company_data = df_empresas[df_empresas['cnpj'] == company_cnpj]
-        if company_data.empty:
+        company_record = cadastro_repo.get_by_cnpj(company_cnpj)
+        if company_record is None:
             raise ValueError(f"ERROR: CNPJ '{company_cnpj}' not found.")
-        context = company_data.iloc[0].to_dict()
+        context = company_record
         if company_imu:
             context['imu'] = company_imu
             logging.info(f"Using IMU from override: {company_imu}")
@@ -376,10 +590,9 @@ def create_context_for_generation(master_filepath, company_cnpj,
         all_infraction_indices = []
         for auto_info in final_data.values():
             all_infraction_indices.extend(auto_info.get('invoices', []))
-        unique_indices = list(set(all_infraction_indices))
-        # 💡 FIX: Check if indices exist before filtering
-        valid_indices = company_invoices_df.index.intersection(unique_indices)
-        df_all_infractions = company_invoices_df.loc[valid_indices].copy()
+        # Uma única máscara (em vez de isin sobre a lista em cada achado)
+        infraction_mask = company_invoices_df.index.isin(all_infraction_indices)
+        df_all_infractions = company_invoices_df[infraction_mask]
 
 
         # --- Multa Logic ---
@@ -420,58 +633,8 @@ def create_context_for_generation(master_filepath, company_cnpj,
 
 
         # --- Other findings logic ---
-        # 💡 FIX: Check required columns for 'achados'.
-        if 'status_legal' in company_invoices_df.columns:
-            df_decadente_nao_autuado = company_invoices_df[(company_invoices_df['status_legal'] == 'Decadente') & (~company_invoices_df.index.isin(all_infraction_indices))]
-            # 💡 FIX: Check columns *inside* the block
-            if not df_decadente_nao_autuado.empty and 'DATA EMISSÃO' in df_decadente_nao_autuado.columns and 'NÚMERO' in df_decadente_nao_autuado.columns:
-                valid_dates = df_decadente_nao_autuado['DATA EMISSÃO'].dropna()
-                if not valid_dates.empty:
-                    min_date = valid_dates.min().strftime('%m/%Y')
-                    max_date = valid_dates.max().strftime('%m/%Y')
-                    periodo = min_date if min_date == max_date else f"{min_date} a {max_date}"
-                    nfs_numeros = format_invoice_numbers(df_decadente_nao_autuado['NÚMERO'].astype(str).unique())
-                    context['achado_decadencia_nao_autuado'] = {'periodo': periodo, 'nfs_numeros': nfs_numeros}
-            
-            df_prescrito_nao_autuado = company_invoices_df[(company_invoices_df['status_legal'] == 'Prescrito') & (~company_invoices_df.index.isin(all_infraction_indices))]
-            if not df_prescrito_nao_autuado.empty and 'DATA EMISSÃO' in df_prescrito_nao_autuado.columns and 'NÚMERO' in df_prescrito_nao_autuado.columns:
-                valid_dates = df_prescrito_nao_autuado['DATA EMISSÃO'].dropna()
-                if not valid_dates.empty:
-                    min_date = valid_dates.min().strftime('%m/%Y')
-                    max_date = valid_dates.max().strftime('%m/%Y')
-                    periodo = min_date if min_date == max_date else f"{min_date} a {max_date}"
-                    nfs_numeros = format_invoice_numbers(df_prescrito_nao_autuado['NÚMERO'].astype(str).unique())
-                    context['achado_prescrito_nao_autuado'] = {'periodo': periodo, 'nfs_numeros': nfs_numeros}
-        
-        # 💡 FIX: Check all required columns before filtering
-        required_cols_fora = ['NATUREZA DA OPERAÇÃO', 'CÓDIGO DA ATIVIDADE', 'DATA EMISSÃO', 'NÚMERO']
-        if all(col in company_invoices_df.columns for col in required_cols_fora):
-            df_fora = company_invoices_df[(company_invoices_df['NATUREZA DA OPERAÇÃO'].str.contains("Fora do Município", case=False, na=False)) & (company_invoices_df['CÓDIGO DA ATIVIDADE'] == '0702')]
-            if not df_fora.empty:
-                valid_dates = df_fora['DATA EMISSÃO'].dropna()
-                if not valid_dates.empty:
-                    min_date = valid_dates.min().strftime('%m/%Y')
-                    max_date = valid_dates.max().strftime('%m/%Y')
-                    periodo = min_date if min_date == max_date else f"{min_date} a {max_date}"
-                    nfs_numeros = format_invoice_numbers(df_fora['NÚMERO'].astype(str).unique())
-                    context['achado_fora_municipio'] = {'periodo': periodo, 'nfs_numeros': nfs_numeros}
-        
-        # ✅ --- START: Report Text for 'Local Tomador' ---
-        # 💡 FIX: Check required columns
-        if 'status_manual' in company_invoices_df.columns and 'activity_desc' in company_invoices_df.columns and 'NÚMERO' in company_invoices_df.columns:
-            df_tomador = company_invoices_df[company_invoices_df['status_manual'] == 'Local_Tomador']
-            if not df_tomador.empty:
-                achados_tomador_list = []
-                # Agrupa por descrição da atividade para criar o texto
-                for desc, group_df in df_tomador.groupby('activity_desc'):
-                    nfs_numeros = format_invoice_numbers(group_df['NÚMERO'].astype(str).unique())
-                    if not desc or pd.isna(desc):
-                        desc = "Atividade Não Especificada"
-                    achados_tomador_list.append(
-                        f"NFes de nº(s) {nfs_numeros} foram desconsideradas pois o serviço '{desc}' tem tributação no local do tomador."
-                    )
-                context['achado_local_tomador'] = "\n".join(achados_tomador_list)
-        # ✅ --- END: Report Text for 'Local Tomador' ---
+        # Decadência / prescrição não autuadas, fora do município e local do tomador
+        context.update(_collect_findings(company_invoices_df, infraction_mask))
         
         if period_start_date and period_end_date and not df_dates.empty:
             all_months = pd.date_range(period_start_date, period_end_date, freq='MS').strftime('%Y-%m').tolist()
@@ -509,77 +672,29 @@ def create_context_for_generation(master_filepath, company_cnpj,
             lista_autos_compensados_str = format_invoice_numbers(numeros_autos_compensados)
             context['achado_autos_compensados'] = {'lista_numeros': lista_autos_compensados_str}
 
-        lista_strings_compensadas = []
-        
+        report_autos = []
         for auto_data in context['autos']:
             auto_key = auto_data.get('numero')
-            if not auto_key: continue
-            
-            original_auto_info = final_data.get(auto_key)
-            if not original_auto_info: continue
+            if auto_key and final_data.get(auto_key):
+                report_autos.append((auto_key, auto_data, final_data[auto_key]))
 
-            invoice_indices = original_auto_info.get('invoices', [])
-            valid_indices = company_invoices_df.index.intersection(invoice_indices)
-            if len(valid_indices) == 0: continue
-            
-            df_invoices = company_invoices_df.loc[valid_indices].copy()
-            
-            # Prepare df_invoices for date filtering
-            if 'DATA EMISSÃO' not in df_invoices.columns:
-                continue # Cannot filter without dates
-            
-            if not pd.api.types.is_datetime64_any_dtype(df_invoices['DATA EMISSÃO']):
-                df_invoices['DATA EMISSÃO'] = pd.to_datetime(df_invoices['DATA EMISSÃO'], errors='coerce')
-            
-            df_invoices['mes_ano_str'] = df_invoices['DATA EMISSÃO'].dt.strftime('%m/%Y')
-            
-            dados_anuais = auto_data.get('dados_anuais', [])
-            
-            # Identify compensated months AND their source
-            for mes_data in dados_anuais:
-                # Check if this specific month resulted in 0.00 debt
-                if mes_data.get('iss_apurado_op', 0.0) <= 0.01:
-                    mes_ano_val = mes_data.get('mes_ano')
-                    if not mes_ano_val: continue
-                    
-                    # Determine source of payment for this month
-                    sources = []
-                    if mes_data.get('dam_iss_pago', 0.0) > 0.001:
-                        sources.append("DAM")
-                    if mes_data.get('das_iss_pago', 0.0) > 0.001:
-                        sources.append("PGDAS")
-                    
-                    if not sources: continue # Should not happen if compensated, but safety check
-                    
-                    source_label = " e ".join(sources)
-                    
-                    # Filter invoices specifically for THIS month
-                    invoices_mes_mask = df_invoices['mes_ano_str'] == mes_ano_val
-                    invoices_mes_df = df_invoices[invoices_mes_mask]
-                    
-                    # Remove these invoices from the main listing dataframe (for the table header)
-                    # We modify the auto_data['nfs_e_numeros'] later based on remaining
-                    df_invoices = df_invoices[~invoices_mes_mask] 
-
-                    if not invoices_mes_df.empty and 'NÚMERO' in invoices_mes_df.columns:
-                        nums = format_invoice_numbers(invoices_mes_df['NÚMERO'].astype(str).tolist())
-                        if nums:
-                            # ✅ Format: "NFS-e 9 a 10 (Comp: 08/2021 via DAM) referente ao AUTO-001"
-                            texto = f"NFS-e {nums} (Comp: {mes_ano_val} via {source_label}) referente ao {auto_key}"
-                            lista_strings_compensadas.append(texto)
-
-            # Recalculate the main list of invoices for the auto (excluding the compensated ones)
-            if not df_invoices.empty and 'NÚMERO' in df_invoices.columns:
-                auto_data['nfs_e_numeros'] = format_invoice_numbers(df_invoices['NÚMERO'].astype(str).tolist())
-                
-                # Recalculate Period for the remaining invoices
-                valid_dates = df_invoices['DATA EMISSÃO'].dropna()
-                if not valid_dates.empty:
-                    min_d, max_d = valid_dates.min(), valid_dates.max()
-                    if min_d.month == max_d.month and min_d.year == max_d.year:
-                        auto_data['periodo'] = min_d.strftime('%m/%Y')
-                    else:
-                        auto_data['periodo'] = f"{min_d.strftime('%m/%Y')} a {max_d.strftime('%m/%Y')}"
+        if 'DATA EMISSÃO' in company_invoices_df.columns:
+            lista_strings_compensadas, remaining_invoices, empty_autos = _split_compensated_invoices(
+                company_invoices_df, report_autos)
+        else:
+            # Cannot filter without dates
+            lista_strings_compensadas, remaining_invoices = [], {}
+            empty_autos = {auto_key for auto_key, _, _ in report_autos}
+
+        for auto_key, auto_data, original_auto_info in report_autos:
+            if auto_key in empty_autos: continue
+
+            # Main list of invoices for the auto (excluding the compensated ones)
+            if auto_key in remaining_invoices:
+                nfs_e_numeros, min_d, max_d = remaining_invoices[auto_key]
+                auto_data['nfs_e_numeros'] = nfs_e_numeros
+                if pd.notna(min_d):
+                    auto_data['periodo'] = _periodo_text(min_d, max_d)
             else:
                 auto_data['nfs_e_numeros'] = "N/A" # Or handle as fully compensated auto logic (though logic above separates fully compensated autos)
 
@@ -694,7 +809,7 @@ def create_context_for_generation(master_filepath, company_cnpj,
         context['lista_autos_numeros'] = lista_autos_numeros
         logging.info(f"Generated list of auto numbers for templates: {lista_autos_numeros}")
         context['pagamentos_avulsos'] = None
-        if dam_filepath:
+        if has_dam_source(dam_filepath):
             dams_data = _load_all_dams_formatted(dam_filepath)
             if dams_data:
                 context['pagamentos_avulsos'] = dams_data # ✅ Set correct key
@@ -1,26 +1,157 @@
 # --- FILE: description_analyzer.py ---
 import os
 import re
-import spacy
+import json
+import hashlib
+import logging
+import threading
 import pandas as pd
 import numpy as np
 import unicodedata
 from PySide6.QtCore import QObject, Signal
 from utils import resource_path  # A função resource_path é a chave
+from app.constants import CACHE_DIR
 from collections import defaultdict, Counter
 
 # --- Thresholds for Activity Analysis ---
 MIN_VOTE_THRESHOLD = 1
 CATEGORY_SIMILARITY_THRESHOLD = 0.60 
 
+# --- Location Analysis ---
+# Ficheiro opcional (um município por linha, '#' para comentários) que substitui
+# a lista embutida de cidades. Permite usar a lista completa do IBGE.
+CITY_LIST_FILENAME = "municipios.txt"
+
+# --- Activity Index Cache ---
+# Vetores das descrições oficiais + matriz de similaridade código×código,
+# persistidos em disco por versão da tabela de alíquotas.
+SPACY_MODEL_NAME = "pt_core_news_md"
+ACTIVITY_INDEX_FORMAT = 1
+_ACTIVITY_INDEX_CACHE = {}
+
+# --- spaCy Model Singleton ---
+# O spaCy só é importado quando o modelo é realmente pedido. Assim, a geração,
+# o IDD em lote e o scanner nunca pagam o custo da importação.
+_NLP_MODEL = None
+_NLP_LOCK = threading.Lock()
+
+
+def get_nlp_model():
+    """
+    Devolve o modelo spaCy partilhado pelo processo, carregando-o na primeira chamada.
+    Chamadas concorrentes (ex: pré-carregamento em background) aguardam o mesmo carregamento.
+    Levanta OSError se a pasta do modelo não for encontrada.
+    """
+    global _NLP_MODEL
+    if _NLP_MODEL is not None:
+        return _NLP_MODEL
+    with _NLP_LOCK:
+        if _NLP_MODEL is None:
+            import spacy
+            # Funciona para 'python gui.py' e para o .exe
+            _NLP_MODEL = spacy.load(resource_path(SPACY_MODEL_NAME))
+    return _NLP_MODEL
+
+
+def is_nlp_model_loaded():
+    return _NLP_MODEL is not None
+
+
+def preload_nlp_model_async():
+    """
+    Inicia o carregamento do modelo numa thread daemon (chamar depois de a janela aparecer).
+    Erros são apenas registados; a análise volta a tentar e reporta-os ao utilizador.
+    """
+    if _NLP_MODEL is not None:
+        return None
+
+    def _warm():
+        try:
+            get_nlp_model()
+            logging.info("Modelo spaCy pré-carregado em background.")
+        except Exception as e:
+            logging.warning(f"Pré-carregamento do spaCy falhou: {e}")
+
+    thread = threading.Thread(target=_warm, name="spacy-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def activity_table_version(activity_data):
+    """
+    Gera uma chave estável para a tabela de alíquotas (códigos, descrições e sinónimos).
+    Qualquer alteração no ficheiro de alíquotas produz uma nova versão.
+    """
+    payload = [
+        [code, [[str(desc), str(syn)] for (desc, _aliq, syn) in entries]]
+        for code, entries in sorted(activity_data.items())
+    ]
+    raw = json.dumps([ACTIVITY_INDEX_FORMAT, SPACY_MODEL_NAME, payload], ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+def _activity_index_path(version):
+    return os.path.join(CACHE_DIR, f"activity_index_{version}.npz")
+
+
+def _strip_accents_lower(text):
+    nfkd_form = unicodedata.normalize('NFD', text)
+    return u"".join([c for c in nfkd_form if not unicodedata.combining(c)]).lower()
+
+
+def load_city_list(file_path):
+    """
+    Lê a lista de municípios de um ficheiro de texto (um por linha).
+    Retorna um set normalizado (minúsculas, sem acentos) ou None se o ficheiro não existir.
+    """
+    if not file_path or not os.path.exists(file_path):
+        return None
+    cities = set()
+    with open(file_path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            name = line.split('#', 1)[0].strip()
+            if name:
+                cities.add(_strip_accents_lower(name))
+    return cities
+
+
+def _build_trie_pattern(words):
+    """
+    Compila uma lista de palavras numa única regex em forma de trie
+    (prefixos partilhados), para que o custo da busca não cresça
+    com o número de cidades.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def _to_regex(node):
+        is_terminal = '' in node
+        branches = [re.escape(char) + _to_regex(child)
+                    for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if is_terminal:
+            body = '(?:' + body + ')?'
+        return body
+
+    return _to_regex(trie)
+
+
 class DescriptionAnalyzer(QObject):
     progress = Signal(str)
 
-    def __init__(self):
+    def __init__(self, cities_path=None):
         super().__init__()
         self.nlp = None
         self.keyword_map = None 
-        self.official_desc_docs = None
+        self.code_positions = {}
+        self.code_has_vector = None
+        self.similarity_matrix = None
         
         self.non_informative_words = {
             'de', 'a', 'o', 'que', 'e', 'do', 'da', 'em', 'um', 'para', 'com', 'não', 'uma', 'os', 'no', 'na',
@@ -63,20 +194,21 @@ class DescriptionAnalyzer(QObject):
                'pinhais', 'piraquara', 'itaperucu', 'rio branco do sul', 'tijucas',
                 'lapa', 'campo do tenente', 'pien', 'tunas', 'bocaiuva', 'sjp', 'cerro azul'
         }
+        cities_from_file = load_city_list(cities_path or resource_path(CITY_LIST_FILENAME))
+        if cities_from_file:
+            self.known_brazilian_cities = cities_from_file
+
+        # Pré-computa o detector de cidades uma única vez por analisador
+        self._normalized_neighborhoods = {self._normalize_text(n) for n in self.curitiba_neighborhoods}
+        self._location_regex = self._build_location_regex(self.known_brazilian_cities)
 
     def load_models(self):
         try:
             if not self.nlp:
-                self.progress.emit("🧠 Carregando modelo de linguagem (spaCy)...")
-                
-                # ✅ --- START: THIS IS THE CORRECT LOGIC ---
-                # 1. Encontra a pasta md' na raiz do projeto
-                #    (Funciona para 'python gui.py' e para o .exe)
-                model_path = resource_path('pt_core_news_md')
-                
-                # 2. Carrega o modelo usando o caminho explícito
-                self.nlp = spacy.load(model_path)
-                # ✅ --- END: THIS IS THE CORRECT LOGIC ---
+                if not is_nlp_model_loaded():
+                    self.progress.emit("🧠 Carregando modelo de linguagem (spaCy)...")
+                # Modelo partilhado: só é carregado uma vez por processo
+                self.nlp = get_nlp_model()
             
             self.progress.emit("✅ Modelo de IA (spaCy) carregado.")
             return True
@@ -100,39 +232,52 @@ class DescriptionAnalyzer(QObject):
     def _normalize_text(self, text):
         if not isinstance(text, str):
             return ""
-        nfkd_form = unicodedata.normalize('NFD', text)
-        return u"".join([c for c in nfkd_form if not unicodedata.combining(c)]).lower()
+        return _strip_accents_lower(text)
+
+    def _build_location_regex(self, cities):
+        """
+        Cria uma única regex (trie) com todas as cidades conhecidas,
+        delimitada por fronteiras de palavra.
+        """
+        normalized = {self._normalize_text(c).strip() for c in cities}
+        normalized.discard("")
+        if not normalized:
+            return None
+        return re.compile(r'\b' + _build_trie_pattern(normalized) + r'\b')
+
+    def _filter_away_cities(self, matches, home_city="curitiba"):
+        """Remove a cidade sede e os bairros de Curitiba dos nomes encontrados."""
+        normalized_home_city = self._normalize_text(home_city)
+        found = []
+        for city in dict.fromkeys(matches):
+            if city != normalized_home_city and city not in self._normalized_neighborhoods:
+                found.append(city.title())
+        return found
 
     def _find_service_locations(self, description, home_city="curitiba"):
         """
-        Usa uma busca "brute-force" de keywords contra as listas de cidades.
+        Procura cidades fora da sede numa única descrição, usando a regex pré-compilada.
         """
-        if not isinstance(description, str):
+        if not isinstance(description, str) or self._location_regex is None:
             return []
-            
-        found_cities = set()
-        
-        normalized_description = self._normalize_text(description)
-        normalized_home_city = self._normalize_text(home_city)
-        normalized_neighborhoods = {self._normalize_text(n) for n in self.curitiba_neighborhoods}
-        away_cities = self.known_brazilian_cities 
+        matches = self._location_regex.findall(self._normalize_text(description))
+        return self._filter_away_cities(matches, home_city)
 
-        for city in away_cities:
-            try:
-                if re.search(r'\b' + re.escape(city) + r'\b', normalized_description):
-                    found_cities.add(city.title()) 
-            except re.error:
-                if city in normalized_description:
-                    found_cities.add(city.title())
-
-        final_cities_to_alert = set()
-        for city_name in found_cities:
-            normalized_city = self._normalize_text(city_name)
-            if (normalized_city != normalized_home_city and
-                normalized_city not in normalized_neighborhoods):
-                final_cities_to_alert.add(city_name)
-                    
-        return list(final_cities_to_alert)
+    def find_service_locations_column(self, descriptions, home_city="curitiba"):
+        """
+        Versão vetorizada de _find_service_locations para uma coluna inteira.
+        Retorna uma Series de listas, alinhada com o índice de entrada.
+        """
+        if self._location_regex is None:
+            return pd.Series([[] for _ in range(len(descriptions))], index=descriptions.index, dtype=object)
+
+        is_text = descriptions.map(lambda x: isinstance(x, str))
+        normalized = (descriptions.where(is_text, "").astype(str)
+                      .str.normalize('NFD')
+                      .str.replace(r'[\u0300-\u036f]', '', regex=True)
+                      .str.lower())
+        matches = normalized.str.findall(self._location_regex)
+        return matches.map(lambda found: self._filter_away_cities(found, home_city) if found else [])
 
     def _get_key_lemmas(self, text):
         """
@@ -156,16 +301,18 @@ class DescriptionAnalyzer(QObject):
 
     def _build_keyword_map(self, activity_data):
         """
-        Cria o "Keyword Map" reverso E o cache de "Official Docs".
+        Cria o "Keyword Map" reverso e a matriz de similaridade entre as
+        descrições oficiais de cada código (cosseno dos vetores spaCy).
         """
         self.progress.emit("🗺️  Construindo mapa de palavras-chave e descrições...")
         keyword_map = defaultdict(list)
-        official_desc_docs = {} 
+        official_desc_vectors = {}
         
         for code, entries in activity_data.items():
             for (description, aliquot, synonyms) in entries: 
-                if code not in official_desc_docs:
-                    official_desc_docs[code] = self.nlp(description)
+                if code not in official_desc_vectors:
+                    doc = self.nlp(description)
+                    official_desc_vectors[code] = (doc.vector, doc.has_vector and len(doc) > 0)
                 
                 desc_lemmas = self._get_key_lemmas(description)
                 for lemma in desc_lemmas:
@@ -178,11 +325,85 @@ class DescriptionAnalyzer(QObject):
                     for lemma in synonym_lemmas:
                         if code not in keyword_map[lemma]: 
                             keyword_map[lemma].append(code)
-                        
+
+        codes = list(official_desc_vectors.keys())
+        if codes:
+            vectors = np.vstack([official_desc_vectors[c][0] for c in codes]).astype(np.float32)
+            has_vector = np.array([official_desc_vectors[c][1] for c in codes], dtype=bool)
+        else:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+            has_vector = np.zeros(0, dtype=bool)
+
+        norms = np.linalg.norm(vectors, axis=1) if len(codes) else np.zeros(0, dtype=np.float32)
+        has_vector &= norms > 0
+        unit = np.divide(vectors, norms[:, None], out=np.zeros_like(vectors), where=norms[:, None] > 0)
+
         self.keyword_map = keyword_map
-        self.official_desc_docs = official_desc_docs
+        self.code_positions = {code: i for i, code in enumerate(codes)}
+        self.code_has_vector = has_vector
+        self.similarity_matrix = unit @ unit.T
         self.progress.emit("✅ Mapa de palavras-chave construído.")
 
+    def _load_activity_index(self, version):
+        """Tenta carregar o índice de atividades da memória ou do disco."""
+        cached = _ACTIVITY_INDEX_CACHE.get(version)
+        if cached is None:
+            path = _activity_index_path(version)
+            if not os.path.exists(path):
+                return False
+            try:
+                with np.load(path, allow_pickle=False) as data:
+                    cached = {
+                        'keyword_map': json.loads(str(data['keyword_map'])),
+                        'code_positions': {str(c): i for i, c in enumerate(data['codes'])},
+                        'code_has_vector': data['has_vector'],
+                        'similarity_matrix': data['similarity'],
+                    }
+            except Exception as e:
+                logging.warning(f"Cache de atividades inválido ({path}): {e}")
+                return False
+            _ACTIVITY_INDEX_CACHE[version] = cached
+
+        self.keyword_map = cached['keyword_map']
+        self.code_positions = cached['code_positions']
+        self.code_has_vector = cached['code_has_vector']
+        self.similarity_matrix = cached['similarity_matrix']
+        return True
+
+    def _save_activity_index(self, version):
+        codes = sorted(self.code_positions, key=self.code_positions.get)
+        _ACTIVITY_INDEX_CACHE[version] = {
+            'keyword_map': dict(self.keyword_map),
+            'code_positions': self.code_positions,
+            'code_has_vector': self.code_has_vector,
+            'similarity_matrix': self.similarity_matrix,
+        }
+        path = _activity_index_path(version)
+        tmp_path = path + ".tmp"
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.savez(f,
+                         codes=np.array(codes, dtype=str),
+                         has_vector=self.code_has_vector,
+                         similarity=self.similarity_matrix,
+                         keyword_map=np.array(json.dumps(self.keyword_map, ensure_ascii=False)))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.warning(f"Não foi possível gravar o cache de atividades: {e}")
+
+    def prepare_activity_index(self, activity_data):
+        """
+        Garante que o mapa de palavras-chave e a matriz de similaridade estão prontos,
+        reutilizando o cache (memória/disco) da versão atual da tabela de alíquotas.
+        """
+        version = activity_table_version(activity_data)
+        if self._load_activity_index(version):
+            self.progress.emit("✅ Mapa de palavras-chave carregado do cache.")
+            return
+        self._build_keyword_map(activity_data)
+        self._save_activity_index(version)
+
     def analyze_invoices(self, df_invoices, activity_data):
         """
         Executa a análise de "3 Etapas" (Triage, Voting, Similarity)
@@ -194,13 +415,13 @@ class DescriptionAnalyzer(QObject):
 
         # --- 1. Location Analysis ---
         self.progress.emit("📍 Verificando localização do serviço...")
-        locations = df_invoices['DISCRIMINAÇÃO DOS SERVIÇOS'].apply(lambda x: self._find_service_locations(x))
-        df_invoices['location_alert'] = locations.apply(lambda x: ', '.join(x))
+        locations = self.find_service_locations_column(df_invoices['DISCRIMINAÇÃO DOS SERVIÇOS'])
+        df_invoices['location_alert'] = locations.map(', '.join)
         
         # --- 2. "3-Stage" Activity Analysis ---
         
         if not self.keyword_map:
-            self._build_keyword_map(activity_data)
+            self.prepare_activity_index(activity_data)
             
         activity_alerts = []
         
@@ -240,14 +461,15 @@ class DescriptionAnalyzer(QObject):
                 continue
 
             # --- STAGE 3: SIMILARITY CHECK ---
-            doc_declared = self.official_desc_docs.get(declared_code)
-            doc_winner = self.official_desc_docs.get(winning_code)
+            pos_declared = self.code_positions.get(declared_code)
+            pos_winner = self.code_positions.get(winning_code)
 
-            if not doc_declared or not doc_winner or not doc_declared.has_vector or not doc_winner.has_vector:
+            if (pos_declared is None or pos_winner is None or
+                    not self.code_has_vector[pos_declared] or not self.code_has_vector[pos_winner]):
                 activity_alerts.append("") 
                 continue
                 
-            similarity_score = doc_declared.similarity(doc_winner)
+            similarity_score = self.similarity_matrix[pos_declared, pos_winner]
             
             if similarity_score < CATEGORY_SIMILARITY_THRESHOLD:
                 alert_text = (
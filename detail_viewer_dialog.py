@@ -3,8 +3,8 @@
 import pandas as pd
 from datetime import datetime
 from PySide6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QPushButton, 
-                               QTableWidget, QDialogButtonBox, QComboBox, 
-                               QLineEdit, QLabel, QWidget, QTableWidgetItem,
+                               QTableView, QDialogButtonBox, QComboBox, 
+                               QLineEdit, QLabel, QWidget,
                                QApplication, QMessageBox, QMenu, QCompleter, # ✅ Import QMenu, QCompleter
                                QHeaderView, QStyle) # ✅ Import QHeaderView
 from PySide6.QtGui import QAction # ✅ Import QAction
@@ -12,13 +12,38 @@ from PySide6.QtCore import Qt, QStringListModel # ✅ Import QStringListModel
 import numpy as np # ✅ Import NumPy
 
 # ✅ Import widgets/constants for consistent table formatting
-from .widgets import NumericTableWidgetItem, DateTableWidgetItem, ColumnSelectionDialog, SORT_ROLE
+from .widgets import ColumnSelectionDialog
 from .constants import Columns
-from PySide6.QtGui import QColor
+from .invoice_table_model import InvoiceTableModel, InvoiceFilterIndex
+
+
+class DetailInvoiceModel(InvoiceTableModel):
+    """Shared invoice model with raw column names and the detailed tooltips of the viewer."""
+    HEADER_MAP = {}
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.ToolTipRole or not index.isValid():
+            return super().data(index, role)
+
+        src_row = self._rows[index.row()]
+        col_name = self._visible_columns[index.column()]
+        tooltip = self.display_text(index.row(), index.column())
+        if col_name == Columns.BROKEN_RULE_DETAILS and self._has_rule[src_row]:
+            raw_value = self._df[col_name].iat[src_row]
+            if isinstance(raw_value, list):
+                tooltip = "Infrações:\n- " + "\n- ".join(map(str, raw_value))
+        if self._is_decadent[src_row]:
+            status = str(self._df[Columns.STATUS_LEGAL].iat[src_row])
+            tooltip = f"{tooltip}\n(Nota {status.lower()}, desconsiderada para autuação)"
+        return tooltip
 
 
 class InvoiceDetailViewerDialog(QDialog):
-    def __init__(self, df, all_columns, parent=None):
+    def __init__(self, df, all_columns, parent=None, row_positions=None):
+        """
+        `row_positions` (optional) shows only those rows of `df`, so callers can
+        pass their full frame instead of materializing a subset.
+        """
         super().__init__(parent)
         self.setWindowTitle("Visualizador de Detalhes da Nota Fiscal")
         self.setMinimumSize(1100, 650)
@@ -31,8 +56,14 @@ class InvoiceDetailViewerDialog(QDialog):
         else:
              self.visible_columns = all_columns[:]
              
+        self.visible_columns = [c for c in self.visible_columns if c in self.df.columns]
+             
         self.active_filters = []
-        self.current_filtered_df = self.df.copy() 
+        self._base_positions = np.arange(len(df)) if row_positions is None else np.asarray(row_positions, dtype=np.intp)
+        self._filtered_positions = self._base_positions
+        self._filter_index = InvoiceFilterIndex(self.df)
+        self._completer_models = {}  # column -> QStringListModel of its distinct values
+        self.model = None
 
         main_layout = QVBoxLayout(self)
         
@@ -57,8 +88,9 @@ class InvoiceDetailViewerDialog(QDialog):
         self.filters_layout.setContentsMargins(0, 0, 0, 0) # ✅ Adiciona margem
         main_layout.addWidget(self.filters_widget)
         
-        self.table = QTableWidget()
-        self.table.setEditTriggers(QTableWidget.EditTriggers.NoEditTriggers)
+        self.table = QTableView()
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableView.EditTriggers.NoEditTriggers)
         self.table.setAlternatingRowColors(True)
         self.table.setSortingEnabled(True)
         
@@ -74,7 +106,7 @@ class InvoiceDetailViewerDialog(QDialog):
         buttons.rejected.connect(self.reject)
         main_layout.addWidget(buttons)
         
-        self.populate_table_from_df(self.df) # Initial population
+        self.populate_table() # Initial population
 
     # ✅ --- REQ 2: Funções de filtro com Completer ---
     def add_filter_row(self):
@@ -134,8 +166,10 @@ class InvoiceDetailViewerDialog(QDialog):
                 completer.setModel(None) 
                 edit_widget.setPlaceholderText("Digite o número...")
             else:
-                unique_values = self.df[column_name].astype(str).unique()
-                model = QStringListModel(unique_values)
+                model = self._completer_models.get(column_name)
+                if model is None:
+                    unique_values = pd.unique(self._filter_index.text_column(column_name)).tolist()
+                    model = self._completer_models[column_name] = QStringListModel(unique_values, self)
                 completer.setModel(model)
                 edit_widget.setPlaceholderText("Digite ou selecione da lista...")
                 
@@ -157,97 +191,38 @@ class InvoiceDetailViewerDialog(QDialog):
         self.apply_all_filters()
     # ✅ --- FIM REQ 2 ---
     
-    def _fmtd(self, val):
-        """Helper to format currency in BRL (1.234,56)"""
-        # ... (função inalterada) ...
-        if not isinstance(val, (int, float)):
-            try:
-                val = float(val)
-            except (ValueError, TypeError):
-                return "0,00"
-        return f"{val:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-
-    def populate_table_from_df(self, df_to_show):
-        """Populates the table from a given DataFrame."""
-        # ... (função inalterada, como na última modificação) ...
-        self.table.setSortingEnabled(False)
-        self.table.setRowCount(0)
-        self.table.setColumnCount(len(self.visible_columns))
-        self.table.setHorizontalHeaderLabels(self.visible_columns)
-
-        if df_to_show is None or df_to_show.empty:
-            self.table.setSortingEnabled(True)
-            return
-
-        self.table.setRowCount(len(df_to_show))
-        rule_color = QColor(100, 92, 63)
-        expired_color = QColor(80, 80, 80)
+    @property
+    def current_filtered_df(self):
+        """Rows currently shown (materialized on demand)."""
+        return self.df.iloc[self._filtered_positions]
 
-        for row_idx, (index, row_data) in enumerate(df_to_show.iterrows()):
-            status = row_data.get(Columns.STATUS_LEGAL)
-            for col_idx, col_name in enumerate(self.visible_columns):
-                raw_value = row_data.get(col_name)
-                item = None
-                tooltip_text = ""
-
-                if col_name == Columns.BROKEN_RULE_DETAILS:
-                    display_text = "; ".join(map(str, raw_value)) if isinstance(raw_value, list) and raw_value else ""
-                    tooltip_text = "Infrações:\n- " + "\n- ".join(map(str, raw_value)) if display_text else ""
-                    item = QTableWidgetItem(display_text)
-                
-                elif col_name == Columns.VALUE:
-                    display_text = self._fmtd(raw_value)
-                    item = NumericTableWidgetItem(display_text)
-                    item.setData(SORT_ROLE, float(raw_value) if pd.notna(raw_value) else 0.0)
-                
-                elif col_name in [Columns.RATE, Columns.CORRECT_RATE, 'ALÍQUOTA']:
-                    display_text = f"{raw_value:,.2f}" if pd.notna(raw_value) else "0.00"
-                    item = NumericTableWidgetItem(display_text)
-                    item.setData(SORT_ROLE, float(raw_value) if pd.notna(raw_value) else 0.0)
-                
-                elif col_name == Columns.ISSUE_DATE and pd.notna(raw_value):
-                    display_text = raw_value.strftime('%d/%m/%Y')
-                    item = DateTableWidgetItem(display_text)
-                    item.setData(SORT_ROLE, raw_value)
-                
-                else:
-                    display_text = str(raw_value if pd.notna(raw_value) else '')
-                    item = QTableWidgetItem(display_text)
-                
-                if status in ['Decadente', 'Prescrito']:
-                    item.setBackground(expired_color)
-                    tooltip_text += f"\n(Nota {status.lower()}, desconsiderada para autuação)"
-                if col_name == Columns.BROKEN_RULE_DETAILS and display_text:
-                    item.setBackground(rule_color)
-
-                item.setToolTip(tooltip_text or display_text)
-                self.table.setItem(row_idx, col_idx, item)
-        
-        self.table.resizeColumnsToContents()
-        self.table.setSortingEnabled(True)
+    def populate_table(self):
+        """Shows the filtered rows; the model (and its cached strings) is rebuilt only when the columns change."""
+        if self.model is None or not self.model.is_compatible(self.df, self.visible_columns):
+            self.model = DetailInvoiceModel(self.df, self.visible_columns, parent=self.table,
+                                            row_positions=self._filtered_positions)
+            self.table.setModel(self.model)
+            self.table.resizeColumnsToContents()
+        else:
+            self.model.set_row_positions(self._filtered_positions)
 
     def apply_all_filters(self):
-        """IMPROVED: Filters the DataFrame first and stores the result."""
-        # ... (função inalterada) ...
-        filtered_df = self.df.copy()
+        """Filters with cached boolean masks (no DataFrame copies) and updates the visible rows."""
+        mask = np.ones(len(self.df), dtype=bool)
         for f in self.active_filters:
             column_name = f["combo"].currentText()
             filter_text = f["edit"].text().strip().lower()
             
-            if filter_text and column_name in filtered_df.columns:
-                try:
-                    mask = filtered_df[column_name].astype(str).str.lower().str.contains(filter_text, na=False)
-                    filtered_df = filtered_df[mask]
-                except Exception as e:
-                    print(f"Error filtering column {column_name}: {e}")
+            if filter_text and column_name in self.df.columns:
+                mask &= self._filter_index.contains_mask(column_name, filter_text)
         
-        self.current_filtered_df = filtered_df 
-        self.populate_table_from_df(self.current_filtered_df) 
+        self._filtered_positions = self._base_positions[mask[self._base_positions]]
+        self.populate_table() 
     
     def copy_table_to_clipboard(self):
         """Copies the currently visible (filtered) data to the clipboard."""
         # ... (função inalterada) ...
-        if self.current_filtered_df is not None and not self.current_filtered_df.empty:
+        if len(self._filtered_positions):
             df_to_copy = self.current_filtered_df[self.visible_columns]
             try:
                 clipboard = QApplication.clipboard()
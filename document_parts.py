@@ -1,12 +1,11 @@
 # --- FILE: document_parts.py ---
 
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.table import WD_ALIGN_VERTICAL
-from docx.shared import Pt # ✅ NEW: Required for font sizing
+# ⚠️ python-docx é importado dentro das funções de tabela (não pesa no arranque da GUI)
 import pandas as pd
 import logging
-import numpy as np
 from app.config import get_custom_auto_texts
+# Compressão dos números de NFS-e em intervalos (NumPy, memoizada); re-exportada daqui
+from invoice_ranges import format_invoice_numbers, format_invoice_number_groups
 
 # ... (Previous helper functions remain unchanged: _format_currency_brl, format_invoice_numbers, etc.) ...
 
@@ -22,46 +21,6 @@ def _format_currency_brl_plain(value):
         return f"{value:,.2f}".replace(",", "v").replace(".", ",").replace("v", ".")
     return str(value)
 
-def format_invoice_numbers(invoice_numbers):
-    if isinstance(invoice_numbers, np.ndarray):
-        if invoice_numbers.size == 0:
-            return ""
-    elif not invoice_numbers:
-         return ""
-
-    numeric_invoices = []
-    for n in invoice_numbers:
-        try:
-            val = int(n)
-            numeric_invoices.append(val)
-        except (ValueError, TypeError):
-            continue
-            
-    numeric_invoices = sorted(list(set(numeric_invoices)))
-
-    if not numeric_invoices:
-        return ", ".join(sorted(list(set([str(x) for x in invoice_numbers]))))
-
-    ranges = []
-    start_range = numeric_invoices[0]
-
-    for i in range(1, len(numeric_invoices)):
-        if numeric_invoices[i] != numeric_invoices[i-1] + 1:
-            end_range = numeric_invoices[i-1]
-            if start_range == end_range:
-                ranges.append(str(start_range))
-            else:
-                ranges.append(f"{start_range} a {end_range}")
-            start_range = numeric_invoices[i]
-
-    end_range = numeric_invoices[-1]
-    if start_range == end_range:
-        ranges.append(str(start_range))
-    else:
-        ranges.append(f"{start_range} a {end_range}")
-
-    return ", ".join(ranges)
-
 def _safe_period_string(df):
     if 'DATA EMISSÃO' not in df.columns or df.empty or df['DATA EMISSÃO'].dropna().empty:
         return "[Período Indisponível]"
@@ -224,6 +183,7 @@ def formatar_texto_multa(auto_data, df_invoices, valor_multa_str, multas_list=No
 # ✅ --- START: New Helper to force font size ---
 def _set_table_font_size(table, size_pt):
     """Iterates through all cells in a table and sets the font size."""
+    from docx.shared import Pt
     for row in table.rows:
         for cell in row.cells:
             for paragraph in cell.paragraphs:
@@ -232,6 +192,8 @@ def _set_table_font_size(table, size_pt):
 # ✅ --- END: New Helper ---
 
 def create_table_for_auto(doc, auto_data, idd_mode=False):
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.enum.table import WD_ALIGN_VERTICAL
     table = None
     has_das = auto_data.get('tem_pagamento_das', False)
     has_dam = auto_data.get('tem_pagamento_dam', False)
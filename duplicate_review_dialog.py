@@ -6,6 +6,7 @@ from PySide6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QListWidget,
                                QWidget, QAbstractItemView)
 from PySide6.QtCore import Qt
 from PySide6.QtGui import QColor
+from conflict_resolution import rank_conflicts, RANK_COL
 
 class DuplicateReviewDialog(QDialog):
     """
@@ -25,21 +26,19 @@ class DuplicateReviewDialog(QDialog):
         self.id_col = self.col_map.get('id', id_col) 
         self.conflict_col = conflict_col
         
-        # Ensure conflict column exists
-        if self.conflict_col not in self.df.columns:
-            # Fallback: calculate if missing
-            self.df[self.conflict_col] = self.df.duplicated(subset=[self.id_col], keep=False)
+        # Ensure conflict/rank columns exist (same engine as the loaders)
+        if self.conflict_col not in self.df.columns or RANK_COL not in self.df.columns:
+            rank_conflicts(self.df, self.id_col)
 
-        # Extract conflicts
-        self.conflict_groups = self.df[self.df[self.conflict_col]].groupby(self.id_col)
-        self.conflict_ids = sorted(list(self.conflict_groups.groups.keys()))
+        # Extract conflicts: only the conflicting rows are ordered (by number, then rank)
+        conflicts_df = self.df[self.df[self.conflict_col]].sort_values([self.id_col, RANK_COL], kind='stable')
+        self.conflict_groups = conflicts_df.groupby(self.id_col, sort=True)
+        self.conflict_ids = list(self.conflict_groups.groups.keys())
         
         # Store user decisions: {invoice_number: selected_index_in_original_df}
-        self.decisions = {} 
-        
-        # Pre-fill decisions with the "first" (Smart Sort winner) as default
-        for invoice_num, indices in self.conflict_groups.groups.items():
-            self.decisions[invoice_num] = indices[0]
+        # Pre-filled with the rank-1 row of each group (default winner)
+        winners = conflicts_df[conflicts_df[RANK_COL] == 1]
+        self.decisions = dict(zip(winners[self.id_col], winners.index))
 
         self._setup_ui()
         self._load_list()
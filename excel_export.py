@@ -0,0 +1,186 @@
+# --- FILE: app/excel_export.py ---
+"""
+Exportação de relatórios .xlsx em streaming (openpyxl em modo write-only).
+
+O workbook em modo normal guarda todas as células em memória até ao save; em
+write-only cada linha é serializada para um ficheiro temporário assim que é
+escrita, por isso a memória fica constante seja qual for o tamanho da folha.
+Larguras e formatos são definidos por coluna antes da primeira linha:
+
+    with StreamingExcelWriter(path) as book:
+        sheet = book.add_sheet("Resumo", columns, formats={'Valor': BRL_FORMAT})
+        for row in produce_rows():
+            sheet.write_row(row)          # linha a linha, à medida que são geradas
+
+Um scan longo pode escrever cada resultado logo que o obtém: se for
+interrompido, o close() (no `with`) grava o relatório parcial com o que já saiu.
+
+⚠️ openpyxl só é importado quando se cria o writer (não pesa no arranque da GUI).
+"""
+
+import math
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+
+BRL_FORMAT = '"R$" #,##0.00'
+DATE_FORMAT = 'DD/MM/YYYY'
+DATETIME_FORMAT = 'DD/MM/YYYY HH:MM'
+PERCENT_FORMAT = '0.00"%"'
+INTEGER_FORMAT = '0'
+DEFAULT_WIDTH = 18
+MAX_AUTO_WIDTH = 60
+FRAME_CHUNK_ROWS = 10000
+
+_INVALID_SHEET_CHARS = str.maketrans({c: '_' for c in '[]:*?/\\'})
+
+
+def safe_sheet_name(name):
+    """Nome válido para uma folha Excel (sem []:*?/\\, até 31 caracteres)."""
+    return (str(name).translate(_INVALID_SHEET_CHARS).strip("'") or "Folha")[:31]
+
+
+def _cell_value(value):
+    """Valor Python que o openpyxl aceita (NaN/NaT -> vazio, numpy -> Python)."""
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return None if math.isnan(value) or math.isinf(value) else value
+    if isinstance(value, (str, int, bool, date)):
+        if isinstance(value, datetime) and value.tzinfo is not None:
+            value = value.replace(tzinfo=None)
+        return value
+    if isinstance(value, (list, tuple, set, dict)):
+        return str(value)
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    return str(value)
+
+
+def frame_formats(df, money_columns=()):
+    """Formatos por omissão a partir dos dtypes (datas) e das colunas monetárias indicadas."""
+    formats = {}
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            formats[col] = DATE_FORMAT
+        elif col in money_columns:
+            formats[col] = BRL_FORMAT
+    return formats
+
+
+class SheetStream:
+    """Uma folha em escrita: cabeçalho já escrito, linhas acrescentadas uma a uma."""
+
+    def __init__(self, worksheet, columns, formats=None, widths=None, default_width=DEFAULT_WIDTH):
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font
+        from openpyxl.utils import get_column_letter
+
+        self._ws = worksheet
+        self.columns = list(columns)
+        self.rows_written = 0
+        formats = formats or {}
+        widths = widths or {}
+        # Uma célula formatada por coluna, reutilizada: cada linha é serializada no append()
+        self._format_cells = []
+        for col in self.columns:
+            cell = None
+            if formats.get(col):
+                cell = WriteOnlyCell(worksheet)
+                cell.number_format = formats[col]
+            self._format_cells.append(cell)
+
+        # Larguras têm de ser definidas antes da primeira linha (write-only)
+        for i, col in enumerate(self.columns, start=1):
+            width = widths.get(col)
+            if width is None:
+                width = min(max(default_width, len(str(col)) + 2), MAX_AUTO_WIDTH)
+            worksheet.column_dimensions[get_column_letter(i)].width = width
+        if self.columns:
+            worksheet.freeze_panes = 'A2'
+
+        bold = Font(bold=True)
+        header = []
+        for col in self.columns:
+            cell = WriteOnlyCell(worksheet, value=str(col))
+            cell.font = bold
+            header.append(cell)
+        worksheet.append(header)
+
+    def write_row(self, row):
+        """Acrescenta uma linha (sequência pela ordem das colunas ou dict por coluna)."""
+        if isinstance(row, dict):
+            row = [row.get(col) for col in self.columns]
+        cells = []
+        for value, cell in zip(row, self._format_cells):
+            value = _cell_value(value)
+            if cell is None or value is None:
+                cells.append(value)
+            else:
+                cell.value = value
+                cells.append(cell)
+        self._ws.append(cells)
+        self.rows_written += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def write_frame(self, df, chunk_rows=FRAME_CHUNK_ROWS):
+        """Escreve as linhas de um DataFrame por blocos (as colunas em falta ficam vazias)."""
+        frame = df if list(df.columns) == self.columns else df.reindex(columns=self.columns)
+        for start in range(0, len(frame), chunk_rows):
+            self.write_rows(frame.iloc[start:start + chunk_rows].itertuples(index=False, name=None))
+
+
+class StreamingExcelWriter:
+    """Workbook .xlsx em write-only; usar como context manager (grava no fim, mesmo com erro)."""
+
+    def __init__(self, path):
+        from openpyxl import Workbook
+        self.path = path
+        self._wb = Workbook(write_only=True)
+        self._closed = False
+        self.sheets = {}
+
+    def add_sheet(self, name, columns, formats=None, widths=None, default_width=DEFAULT_WIDTH):
+        title = safe_sheet_name(name)
+        sheet = SheetStream(self._wb.create_sheet(title=title), columns, formats, widths, default_width)
+        self.sheets[title] = sheet
+        return sheet
+
+    def add_frame(self, name, df, formats=None, widths=None, money_columns=()):
+        """Folha completa a partir de um DataFrame (formatos de data inferidos do dtype)."""
+        all_formats = frame_formats(df, money_columns)
+        all_formats.update(formats or {})
+        sheet = self.add_sheet(name, df.columns, all_formats, widths)
+        sheet.write_frame(df)
+        return sheet
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if not self.sheets:
+            # Um .xlsx precisa de pelo menos uma folha
+            self.add_sheet("Folha", [])
+        self._wb.save(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def export_frame(path, df, sheet_name="Folha1", formats=None, widths=None, money_columns=()):
+    """Atalho para um DataFrame numa única folha."""
+    with StreamingExcelWriter(path) as book:
+        book.add_frame(sheet_name, df, formats, widths, money_columns)
+    return path
@@ -1,14 +1,113 @@
 # --- FILE: app/widgets/excel_filter.py ---
 
-from PySide6.QtWidgets import (QDialog, QVBoxLayout, QLineEdit, QListWidget, 
-                               QListWidgetItem, QDialogButtonBox, QCheckBox, 
+from PySide6.QtWidgets import (QDialog, QVBoxLayout, QLineEdit, QListView, 
+                               QDialogButtonBox, QCheckBox, 
                                QHBoxLayout, QLabel, QPushButton)
-from PySide6.QtCore import Qt, Signal
+from PySide6.QtCore import Qt, Signal, QAbstractListModel, QModelIndex
 from PySide6.QtGui import QIcon, QAction
+import numpy as np
 import pandas as pd
+from invoice_schema import as_text
+
+
+class ColumnValueIndex:
+    """
+    Factorized string values of one column ("" for blanks): computed once per
+    column, then the unique values/counts of any subset of rows are a bincount.
+    """
+
+    def __init__(self, series):
+        codes, uniques = pd.factorize(as_text(series), sort=True)
+        self.codes = codes
+        self.uniques = np.asarray(uniques, dtype=object)
+
+    def value_counts(self, row_positions=None):
+        """Returns (values, counts) sorted by value, only for values present in the rows."""
+        codes = self.codes if row_positions is None else self.codes[row_positions]
+        counts = np.bincount(codes, minlength=len(self.uniques))
+        present = np.flatnonzero(counts)
+        return self.uniques[present], counts[present]
+
+
+class FilterValuesModel(QAbstractListModel):
+    """Checkable list of distinct values; only the rows matching the search are exposed."""
+
+    def __init__(self, values, counts=None, parent=None):
+        super().__init__(parent)
+        self.values = values
+        self.counts = counts
+        self.labels = np.array([v if v else "(Vazio)" for v in values], dtype=object)
+        self.lower_labels = pd.Series(self.labels, dtype=object).str.lower().to_numpy()
+        self.checked = np.ones(len(values), dtype=bool)
+        self.visible = np.arange(len(values))
+        self._search_text = ""
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.visible)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        pos = self.visible[index.row()]
+        if role == Qt.DisplayRole:
+            return self.labels[pos]
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if self.checked[pos] else Qt.Unchecked
+        if role == Qt.ToolTipRole and self.counts is not None:
+            return f"{self.counts[pos]} nota(s)"
+        if role == Qt.UserRole:
+            return self.values[pos]
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not index.isValid():
+            return False
+        self.checked[self.visible[index.row()]] = Qt.CheckState(value) == Qt.Checked
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        return True
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
+
+    def set_search_text(self, text):
+        """Incremental search: a longer query only re-scans the rows that already matched."""
+        text = text.lower()
+        if not text:
+            visible = np.arange(len(self.values))
+        else:
+            candidates = self.visible if self._search_text and text.startswith(self._search_text) else np.arange(len(self.values))
+            matches = pd.Series(self.lower_labels[candidates], dtype=object).str.contains(text, regex=False).to_numpy(dtype=bool)
+            visible = candidates[matches]
+        self._search_text = text
+        self.beginResetModel()
+        self.visible = visible
+        self.endResetModel()
+
+    def set_visible_checked(self, checked):
+        self.checked[self.visible] = checked
+        self._emit_all_changed()
+
+    def invert_visible(self):
+        self.checked[self.visible] = ~self.checked[self.visible]
+        self._emit_all_changed()
+
+    def set_checked_values(self, allowed_values):
+        self.checked = np.isin(self.values, list(allowed_values))
+        self._emit_all_changed()
+
+    def visible_check_state(self):
+        visible_checked = self.checked[self.visible]
+        if len(visible_checked) == 0 or not visible_checked.any():
+            return Qt.Unchecked
+        return Qt.Checked if visible_checked.all() else Qt.PartiallyChecked
+
+    def _emit_all_changed(self):
+        if len(self.visible):
+            self.dataChanged.emit(self.index(0), self.index(len(self.visible) - 1), [Qt.CheckStateRole])
+
 
 class ExcelFilterDialog(QDialog):
-    def __init__(self, unique_values, parent=None):
+    def __init__(self, unique_values, parent=None, counts=None):
         super().__init__(parent)
         self.setWindowTitle("Filtrar")
         self.setWindowFlags(Qt.Popup) # Popup style (closes if clicked outside)
@@ -41,26 +140,16 @@ class ExcelFilterDialog(QDialog):
         
         self.layout().addLayout(controls_layout)
 
-        # 3. List of Values
-        self.list_widget = QListWidget()
-        self.items = []
-        
-        # Sort values, putting blanks at the top or bottom
-        sorted_values = sorted(map(str, unique_values), key=lambda x: (x is None, x))
-        
-        for val in sorted_values:
-            text_label = val if val else "(Vazio)"
-            item = QListWidgetItem(text_label)
-            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
-            item.setCheckState(Qt.Checked)
-            
-            # Store real value in UserRole (in case text is modified for display)
-            item.setData(Qt.UserRole, val)
-            
-            self.list_widget.addItem(item)
-            self.items.append(item)
-            
-        self.layout().addWidget(self.list_widget)
+        # 3. List of Values (model/view: only the rows on screen are painted)
+        if not isinstance(unique_values, np.ndarray) or counts is None:
+            unique_values = np.array(sorted(map(str, unique_values)), dtype=object)
+        self.model = FilterValuesModel(unique_values, counts, self)
+        self.model.dataChanged.connect(self.update_check_all_state)
+
+        self.list_view = QListView()
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setModel(self.model)
+        self.layout().addWidget(self.list_view)
 
         # 4. Buttons
         buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -69,14 +158,8 @@ class ExcelFilterDialog(QDialog):
         self.layout().addWidget(buttons)
 
     def filter_list(self, text):
-        """Hides items that don't match the search text."""
-        text = text.lower()
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            item_text = item.text().lower()
-            
-            is_match = text in item_text
-            item.setHidden(not is_match)
+        """Shows only the values that match the search text."""
+        self.model.set_search_text(text)
         
         # Update "Check All" state based on visible items
         self.update_check_all_state()
@@ -86,61 +169,33 @@ class ExcelFilterDialog(QDialog):
         Triggered when user clicks 'Select All'. 
         Only checks/unchecks items that are currently VISIBLE (searched).
         """
-        state = self.check_all.checkState()
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            if not item.isHidden():
-                item.setCheckState(state)
+        self.model.set_visible_checked(self.check_all.checkState() != Qt.Unchecked)
 
     def invert_visible_selection(self):
         """
         Inverts the check state of currently visible items.
         Great for: Search 'Curitiba' -> Invert (unchecks them) -> OK.
         """
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            if not item.isHidden():
-                current = item.checkState()
-                new_state = Qt.Unchecked if current == Qt.Checked else Qt.Checked
-                item.setCheckState(new_state)
+        self.model.invert_visible()
         self.update_check_all_state()
 
-    def update_check_all_state(self):
+    def update_check_all_state(self, *args):
         """
         Updates the master checkbox based on the state of visible items.
         """
-        all_checked = True
-        any_checked = False
-        visible_count = 0
-        
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            if not item.isHidden():
-                visible_count += 1
-                if item.checkState() == Qt.Checked:
-                    any_checked = True
-                else:
-                    all_checked = False
-        
-        if visible_count == 0:
-            self.check_all.setCheckState(Qt.Unchecked)
-        elif all_checked:
-            self.check_all.setCheckState(Qt.Checked)
-        elif any_checked:
-            self.check_all.setCheckState(Qt.PartiallyChecked)
-        else:
-            self.check_all.setCheckState(Qt.Unchecked)
+        self.check_all.setCheckState(self.model.visible_check_state())
+
+    def set_checked_values(self, allowed_values):
+        """Pre-selects only the given values (existing filter)."""
+        self.model.set_checked_values(allowed_values)
+        self.update_check_all_state()
+
+    def all_values_selected(self):
+        return bool(self.model.checked.all())
 
     def get_selected_values(self):
         """Returns a set of strings that are checked."""
-        selected = set()
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            if item.checkState() == Qt.Checked:
-                # Retrieve original value stored in UserRole
-                val = item.data(Qt.UserRole)
-                selected.add(val)
-        return selected
+        return set(self.model.values[self.model.checked].tolist())
 
 # --- FilterableHeaderView remains mostly the same, ensuring it calls this Dialog ---
 from PySide6.QtWidgets import QHeaderView
@@ -154,9 +209,36 @@ class FilterableHeaderView(QHeaderView):
         self.setHighlightSections(True)
         self.filters = {} 
         self.df_source = None 
+        self.row_positions = None
+        self._value_indexes = {}  # column -> ColumnValueIndex (for the current base frame)
+        self._indexed_df = None
 
-    def set_dataframe(self, df):
+    def set_dataframe(self, df, row_positions=None):
+        """
+        Accepts a DataFrame or a callable returning one (evaluated only when the dialog opens).
+        With `row_positions` (array or callable), `df` is the full base frame and only those
+        rows are offered: the per-column value index is then reused across refreshes.
+        """
         self.df_source = df
+        self.row_positions = row_positions
+
+    def invalidate_values(self, columns=None):
+        """Drops cached value counts (all columns, or just the edited ones)."""
+        if columns is None:
+            self._value_indexes.clear()
+        else:
+            for col in columns:
+                self._value_indexes.pop(col, None)
+
+    def _value_counts(self, df, col_name):
+        if df is not self._indexed_df:
+            self._value_indexes.clear()
+            self._indexed_df = df
+        index = self._value_indexes.get(col_name)
+        if index is None:
+            index = self._value_indexes[col_name] = ColumnValueIndex(df[col_name])
+        positions = self.row_positions() if callable(self.row_positions) else self.row_positions
+        return index.value_counts(positions)
 
     def paintSection(self, painter, rect, logicalIndex):
         painter.save()
@@ -185,7 +267,8 @@ class FilterableHeaderView(QHeaderView):
             super().mousePressEvent(event)
 
     def show_filter_dialog(self, col_index):
-        if self.df_source is None or self.df_source.empty:
+        df_source = self.df_source() if callable(self.df_source) else self.df_source
+        if df_source is None or df_source.empty:
             return
 
         # Attempt to get column name
@@ -195,9 +278,11 @@ class FilterableHeaderView(QHeaderView):
         except:
             return
 
-        unique_vals = self.df_source[raw_col_name].fillna("").astype(str).unique()
+        unique_vals, counts = self._value_counts(df_source, raw_col_name)
+        if len(unique_vals) == 0:
+            return
 
-        dialog = ExcelFilterDialog(unique_vals, self)
+        dialog = ExcelFilterDialog(unique_vals, self, counts=counts)
         
         # Position dialog right under the header section
         header_pos = self.mapToGlobal(self.sectionPosition(col_index))
@@ -205,23 +290,17 @@ class FilterableHeaderView(QHeaderView):
         
         # Pre-select based on existing filters
         if col_index in self.filters:
-            current_allowed = self.filters[col_index]
-            for i in range(dialog.list_widget.count()):
-                item = dialog.list_widget.item(i)
-                val = item.data(Qt.UserRole)
-                if val not in current_allowed:
-                    item.setCheckState(Qt.Unchecked)
-            dialog.update_check_all_state()
+            dialog.set_checked_values(self.filters[col_index])
 
         if dialog.exec():
             selected = dialog.get_selected_values()
             
             # If everything is selected, clear the filter (optimization)
-            if len(selected) == len(unique_vals):
+            if dialog.all_values_selected():
                 if col_index in self.filters:
                     del self.filters[col_index]
             else:
                 self.filters[col_index] = selected
             
             self.filter_changed.emit(col_index, selected)
-            self.viewport().update()
\ No newline at end of file
+            self.viewport().update()
@@ -5,9 +5,17 @@ import logging
 import traceback
 import os
 import multiprocessing
+
+# --- Startup instrumentation (--profile-startup) ---
+# Must be installed before the Qt / app imports so they show up in the tree.
+from app import startup_profiler
+PROFILE_STARTUP = startup_profiler.is_enabled() and multiprocessing.current_process().name == "MainProcess"
+if PROFILE_STARTUP:
+    startup_profiler.install()
+
 from PySide6.QtWidgets import QApplication
+from PySide6.QtCore import QTimer
 from PySide6.QtGui import QFont, QIcon
-from app.video_splash import VideoSplashScreen
 
 # Import the main window from its new module
 from app.main_window import AuditApp
@@ -192,6 +200,8 @@ if __name__ == "__main__":
     sys.excepthook = handle_exception
 
     app = QApplication(sys.argv)
+    if PROFILE_STARTUP:
+        startup_profiler.mark("QApplication criada")
     
     # ... fonts and stylesheets setup ...
     font = QFont("Segoe UI", 10)
@@ -211,19 +221,37 @@ if __name__ == "__main__":
     # 3. Create the Main Window (But DO NOT show it yet)
     # We create it now so it loads in the background while video plays
     main_window = AuditApp()
+    if PROFILE_STARTUP:
+        startup_profiler.mark("AuditApp construída")
+
+    def warm_up_nlp():
+        """Loads the spaCy model in a background thread once the window is visible."""
+        from description_analyzer import preload_nlp_model_async
+        preload_nlp_model_async()
+
+    def on_first_paint():
+        """Runs on the first event-loop tick after show() (startup profiling only)."""
+        startup_profiler.mark("Primeira pintura da janela principal")
+        startup_profiler.uninstall()
+        report_path = startup_profiler.write_report()
+        logging.info(f"Perfil de arranque gravado em {os.path.abspath(report_path)}")
 
     def start_main_app():
         """Slot called when video finishes."""
         main_window.show()
+        if PROFILE_STARTUP:
+            QTimer.singleShot(0, on_first_paint)
+        QTimer.singleShot(0, warm_up_nlp)
 
     # 4. Initialize Splash
     if os.path.exists(video_path):
         print("Found video, initializing splash...")
+        from app.video_splash import VideoSplashScreen  # QtMultimedia only when there is a video
         splash = VideoSplashScreen(video_path, width=800, height=500)
         splash.finished.connect(start_main_app)
         splash.start()
     else:
         print("Video not found, skipping.")
-        main_window.show()
+        start_main_app()
 
     sys.exit(app.exec())
\ No newline at end of file
@@ -0,0 +1,260 @@
+# --- FILE: invoice_ranges.py ---
+"""
+Compressão de números de NFS-e em intervalos para o texto dos relatórios
+("1 a 3, 7, 10 a 12"), com NumPy: sort + unique + quebras onde diff != 1.
+
+    format_invoice_numbers(nums)               -> uma lista (memoizada pela entrada congelada)
+    format_invoice_number_groups(nums, keys)   -> {grupo: texto} de várias listas num só sort
+
+Regras (iguais às da versão em ciclo):
+    - cada valor conta como número se int(valor) funcionar ('0012' -> 12, 12.7 -> 12);
+    - valores não numéricos são ignorados quando há pelo menos um número;
+    - sem nenhum número, devolve os valores distintos como texto, ordenados.
+
+Micro-benchmark contra a versão em ciclo:
+    python -m invoice_ranges [n_notas] [n_grupos]
+"""
+
+import sys
+import time
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+FORMAT_CACHE_SIZE = 1024
+
+# Só dígitos e até 18 deles: cabe em int64 (o resto segue pelo caminho lento, valor a valor)
+_MAX_FAST_DIGITS = 18
+
+
+def _parse_one(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def _ascii_digits_to_int(values):
+    """
+    Array 'U' -> (int64, máscara) para os textos só com dígitos ASCII (até 18),
+    lendo os códigos UCS-4 coluna a coluna em vez de converter texto a texto.
+    """
+    n = len(values)
+    width = values.dtype.itemsize // 4
+    numbers = np.zeros(n, dtype=np.int64)
+    if width == 0 or n == 0:
+        return numbers, np.zeros(n, dtype=bool)
+    chars = np.ascontiguousarray(values).view(np.uint32).reshape(n, width)
+    fast = chars[:, 0] != 0
+    for col in range(width):
+        column = chars[:, col]
+        present = column != 0
+        if not present.any():
+            break
+        if col == _MAX_FAST_DIGITS:
+            fast &= ~present
+            break
+        digit = column - np.uint32(ord('0'))  # não-dígitos dão > 9 (unsigned)
+        fast &= ~present | (digit <= 9)
+        numbers = np.where(present, numbers * 10 + digit.astype(np.int64), numbers)
+    return np.where(fast, numbers, 0), fast
+
+
+def _parse_invoice_numbers(values):
+    """
+    Converte como int(valor): devolve (inteiros int64, máscara de válidos) ou
+    None se algum número não cabe em int64.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'iub':
+        return values.astype(np.int64), np.ones(len(values), dtype=bool)
+    if values.dtype.kind == 'f':
+        valid = np.isfinite(values)
+        return np.where(valid, np.trunc(np.where(valid, values, 0)), 0).astype(np.int64), valid
+
+    if values.dtype.kind == 'O':
+        kind = pd.api.types.infer_dtype(values, skipna=False)
+        if kind == 'integer':
+            try:
+                return values.astype(np.int64), np.ones(len(values), dtype=bool)
+            except OverflowError:
+                return None
+        if kind == 'string':
+            values = values.astype(str)
+
+    if values.dtype.kind == 'U':
+        parsed, fast = _ascii_digits_to_int(values)
+    else:
+        parsed = np.zeros(len(values), dtype=np.int64)
+        fast = np.zeros(len(values), dtype=bool)
+    valid = fast.copy()
+
+    # Restantes (sinais, espaços, objetos mistos...): int() em cada valor distinto
+    slow = np.flatnonzero(~fast)
+    if not len(slow):
+        return parsed, valid
+    codes, uniques = pd.factorize(values[slow].astype(object), use_na_sentinel=False)
+    slow_parsed = np.zeros(len(uniques), dtype=np.int64)
+    slow_valid = np.zeros(len(uniques), dtype=bool)
+    for i, value in enumerate(uniques):
+        number = _parse_one(value)
+        if number is None:
+            continue
+        if not -2**63 <= number < 2**63:
+            return None
+        slow_parsed[i] = number
+        slow_valid[i] = True
+    parsed[slow] = slow_parsed[codes]
+    valid[slow] = slow_valid[codes]
+    return parsed, valid
+
+
+def _range_texts(group_codes, numbers):
+    """Intervalos por grupo: (código do grupo de cada intervalo, textos), ordenados."""
+    if not len(numbers):
+        return group_codes[:0], []
+    order = np.lexsort((numbers, group_codes))
+    groups, numbers = group_codes[order], numbers[order]
+    distinct = np.ones(len(numbers), dtype=bool)
+    distinct[1:] = (groups[1:] != groups[:-1]) | (numbers[1:] != numbers[:-1])
+    groups, numbers = groups[distinct], numbers[distinct]
+
+    starts = np.ones(len(numbers), dtype=bool)
+    starts[1:] = (groups[1:] != groups[:-1]) | (np.diff(numbers) != 1)
+    start_idx = np.flatnonzero(starts)
+    end_idx = np.append(start_idx[1:] - 1, len(numbers) - 1)
+    starts, ends = numbers[start_idx], numbers[end_idx]
+    texts = list(map(str, starts.tolist()))
+    is_range = np.flatnonzero(starts != ends)
+    for i, end in zip(is_range.tolist(), ends[is_range].tolist()):
+        texts[i] = f"{texts[i]} a {end}"
+    return groups[start_idx], texts
+
+
+def _format_loop(invoice_numbers):
+    """Versão em ciclo (referência do benchmark e caminho para números > int64)."""
+    numeric_invoices = sorted({n for n in map(_parse_one, invoice_numbers) if n is not None})
+    if not numeric_invoices:
+        return ", ".join(sorted({str(x) for x in invoice_numbers}))
+
+    ranges = []
+    start_range = numeric_invoices[0]
+    for prev, current in zip(numeric_invoices, numeric_invoices[1:]):
+        if current != prev + 1:
+            ranges.append(str(start_range) if start_range == prev else f"{start_range} a {prev}")
+            start_range = current
+    end_range = numeric_invoices[-1]
+    ranges.append(str(start_range) if start_range == end_range else f"{start_range} a {end_range}")
+    return ", ".join(ranges)
+
+
+def _as_value_array(invoice_numbers):
+    if hasattr(invoice_numbers, '__array__'):
+        return np.asarray(invoice_numbers)
+    values = np.empty(len(invoice_numbers), dtype=object)
+    values[:] = list(invoice_numbers)
+    return values
+
+
+def _format_coded(values, group_codes, n_groups):
+    """Texto de cada grupo (códigos 0..n_groups-1) de uma só vez."""
+    texts = [""] * n_groups
+    parsed = _parse_invoice_numbers(values)
+    if parsed is None:
+        # Números acima de int64: caminho em Python, grupo a grupo
+        for code in range(n_groups):
+            members = values[group_codes == code].tolist()
+            texts[code] = _format_loop(members) if members else ""
+        return texts
+    numbers, valid = parsed
+
+    range_groups, range_texts = _range_texts(group_codes[valid], numbers[valid])
+    bounds = np.flatnonzero(np.diff(range_groups)) + 1
+    for codes, chunk in zip(np.split(range_groups, bounds), np.split(np.asarray(range_texts, dtype=object), bounds)):
+        if len(codes):
+            texts[codes[0]] = ", ".join(chunk)
+
+    # Grupos sem nenhum número: valores distintos como texto
+    has_numbers = np.zeros(n_groups, dtype=bool)
+    has_numbers[group_codes[valid]] = True
+    has_members = np.zeros(n_groups, dtype=bool)
+    has_members[group_codes] = True
+    for code in np.flatnonzero(has_members & ~has_numbers):
+        texts[code] = ", ".join(sorted({str(x) for x in values[group_codes == code].tolist()}))
+    return texts
+
+
+def format_invoice_number_groups(invoice_numbers, group_keys):
+    """
+    Comprime várias listas de uma vez (p.ex. as colunas de um groupby):
+    invoice_numbers[i] pertence ao grupo group_keys[i]. Devolve {grupo: texto}
+    pela ordem de primeira ocorrência dos grupos.
+    """
+    values = _as_value_array(invoice_numbers)
+    if not isinstance(group_keys, (np.ndarray, pd.Series, pd.Index)) or np.asarray(group_keys).ndim != 1:
+        group_keys = pd.Series(list(group_keys), dtype=object)
+    group_codes, group_uniques = pd.factorize(group_keys, use_na_sentinel=False)
+    if not len(values):
+        return dict.fromkeys(group_uniques, "")
+    return dict(zip(group_uniques, _format_coded(values, group_codes, len(group_uniques))))
+
+
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def _format_frozen(frozen_numbers):
+    return _format_single(frozen_numbers)
+
+
+def _format_single(invoice_numbers):
+    values = _as_value_array(invoice_numbers)
+    return _format_coded(values, np.zeros(len(values), dtype=np.intp), 1)[0]
+
+
+def format_invoice_numbers(invoice_numbers):
+    """Lista de números de NFS-e -> texto com intervalos ("1 a 3, 7")."""
+    if hasattr(invoice_numbers, 'tolist'):
+        invoice_numbers = invoice_numbers.tolist()
+    if not invoice_numbers:
+        return ""
+    try:
+        return _format_frozen(tuple(invoice_numbers))
+    except TypeError:  # elementos não hasheáveis: sem cache
+        return _format_single(list(invoice_numbers))
+
+
+def _benchmark(n_invoices=20000, n_groups=200, repeat=5):
+    rng = np.random.default_rng(0)
+    # Numeração sequencial com ~5% de saltos, 1% sem número; grupos = blocos contíguos (meses/autos)
+    numbers = (np.cumsum(1 + (rng.random(n_invoices) < 0.05)) + 1000).astype(str)
+    numbers[rng.choice(n_invoices, n_invoices // 100, replace=False)] = "S/N"
+    groups = np.sort(rng.integers(0, n_groups, n_invoices))
+    lists = [numbers[groups == g].tolist() for g in range(n_groups)]
+
+    def best(fn):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - t0)
+        return min(times), out
+
+    rows = []
+    t_loop, ref = best(lambda: _format_loop(numbers.tolist()))
+    t_np, new = best(lambda: _format_single(numbers))
+    assert ref == new
+    _format_frozen.cache_clear()
+    t_cached, cached = best(lambda: format_invoice_numbers(numbers))
+    assert ref == cached
+    rows += [("lista única, ciclo", t_loop), ("lista única, numpy", t_np), ("lista única, memoizada", t_cached)]
+
+    t_loop_g, ref_g = best(lambda: [_format_loop(lst) for lst in lists])
+    t_batch, new_g = best(lambda: format_invoice_number_groups(numbers, groups))
+    assert ref_g == [new_g.get(g, "") for g in range(n_groups)]
+    rows += [(f"{n_groups} grupos, ciclo", t_loop_g), (f"{n_groups} grupos, lote numpy", t_batch)]
+
+    print(f"format_invoice_numbers: {n_invoices} notas (melhor de {repeat})")
+    for label, seconds in rows:
+        print(f"  {label:<28} {seconds * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    _benchmark(*(int(a) for a in sys.argv[1:3]))
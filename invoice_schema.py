@@ -0,0 +1,102 @@
+# --- FILE: invoice_schema.py ---
+"""
+Esquema canónico do DataFrame de notas.
+
+Colunas de texto muito repetidas (regime, natureza, pagamento, código/descrição
+da atividade, status e as colunas ref_* do motor de regras) ficam como
+'category': cada linha guarda só um código inteiro e as cópias do frame
+(regras, assistente, geração) ficam muito mais leves. Valores monetários/
+alíquotas ficam float64 e as datas datetime64[ns].
+
+Como as categorias são poucas, a normalização de texto corre sobre os valores
+distintos (transform_values / map_values) e não sobre cada linha.
+"""
+
+import numpy as np
+import pandas as pd
+from app.constants import Columns
+
+STATUS_LEGAL_VALUES = ['OK', 'Decadente_Pago', 'Decadente', 'Prescrito']
+STATUS_MANUAL_VALUES = ['', 'Local_Tomador', 'Ignored']
+
+# Coluna -> categorias fixas (None = as que aparecem nos dados)
+CATEGORY_COLUMNS = {
+    'REGIME DE TRIBUTAÇÃO': None,
+    'NATUREZA DA OPERAÇÃO': None,
+    'ISS RETIDO': None,
+    'PAGAMENTO': None,
+    Columns.ACTIVITY_CODE: None,
+    Columns.ACTIVITY_DESC: None,
+    'status_manual': STATUS_MANUAL_VALUES,
+    Columns.STATUS_LEGAL: STATUS_LEGAL_VALUES,
+    'ref_activity_desc': None,
+    'ref_deducao': None,
+    'ref_retencao': None,
+    'ref_local': None,
+    'ref_isencao': None,
+    'ref_imunidade': None,
+}
+FLOAT_COLUMNS = [Columns.VALUE, 'VALOR DEDUÇÃO', Columns.RATE, 'DESCONTO INCONDICIONAL',
+                 'VALOR_ORIGINAL', Columns.CORRECT_RATE, 'ref_correct_rate']
+DATETIME_COLUMNS = [Columns.ISSUE_DATE, 'DT. CANCELAMENTO']
+
+
+def _as_category(series, fixed_categories=None):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categorical = series
+    else:
+        # Mixed object columns (e.g. codes read as int and str) are compared as text downstream
+        values = series.astype(object)
+        if pd.api.types.infer_dtype(values, skipna=True).startswith('mixed'):
+            values = values.where(values.isna(), values.astype(str))
+        categorical = values.astype('category')
+    if fixed_categories:
+        missing = [c for c in fixed_categories if c not in categorical.cat.categories]
+        if missing:
+            categorical = categorical.cat.add_categories(missing)
+    return categorical
+
+
+def apply_invoice_schema(df):
+    """Converts (in place) the known columns to the canonical dtypes; returns df."""
+    for col, fixed in CATEGORY_COLUMNS.items():
+        if col in df.columns:
+            df[col] = _as_category(df[col], fixed)
+    for col in FLOAT_COLUMNS:
+        if col in df.columns and df[col].dtype != np.float64:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float64)
+    for col in DATETIME_COLUMNS:
+        if col in df.columns and not pd.api.types.is_datetime64_ns_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col], errors='coerce').astype('datetime64[ns]')
+    return df
+
+
+def transform_values(series, fn):
+    """
+    Applies `fn` (Series of distinct values -> same-length result) once per
+    distinct value and broadcasts the result back to the rows.
+    """
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    result = np.asarray(fn(pd.Series(np.asarray(uniques, dtype=object))))
+    return pd.Series(result[codes], index=series.index)
+
+
+def map_values(series, mapping, default):
+    """Series.map(mapping).fillna(default), computed on the distinct values."""
+    return transform_values(series, lambda u: u.map(mapping).fillna(default))
+
+
+def as_text(series, na=""):
+    """String view of a column (NaN -> `na`) without expanding categoricals row by row."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        lookup = np.append(np.asarray(series.cat.categories.astype(str), dtype=object), na)
+        return pd.Series(lookup[series.cat.codes.to_numpy()], index=series.index)
+    return series.fillna(na).astype(str)
+
+
+def set_values(df, rows, col, value):
+    """df.loc[rows, col] = value, adding `value` to the categories first if needed."""
+    if (col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype)
+            and not pd.isna(value) and value not in df[col].cat.categories):
+        df[col] = df[col].cat.add_categories([value])
+    df.loc[rows, col] = value
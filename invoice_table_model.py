@@ -0,0 +1,311 @@
+# --- FILE: app/invoice_table_model.py ---
+"""
+Shared model/view support for the invoice tables (review wizard, activity
+review, detail viewer, relabeling): a virtual table model with cached display
+strings and a filter index with cached string columns / masks.
+"""
+
+import numpy as np
+import pandas as pd
+from PySide6.QtCore import QAbstractTableModel, Qt, QModelIndex
+from PySide6.QtGui import QColor
+from .constants import Columns
+from invoice_schema import as_text
+
+
+def _format_brl_number(val):
+    return f"{val:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+def _format_rate(val):
+    return f"{val:,.2f}"
+
+def _format_issue_date(val):
+    return val.strftime('%d/%m/%Y') if hasattr(val, 'strftime') else str(val)
+
+def _format_rule_details(val):
+    return "; ".join(map(str, val)) if isinstance(val, list) else str(val)
+
+def _is_truthy(val):
+    """bool() that also accepts arrays (non-empty == True); NaN counts as empty."""
+    if isinstance(val, float) and np.isnan(val):
+        return False
+    try:
+        return bool(val)
+    except ValueError:
+        return len(val) > 0
+
+
+class InvoiceTableModel(QAbstractTableModel):
+    """
+    Virtual table model over an invoice DataFrame.
+
+    Display strings are precomputed per column, one block of view rows at a time
+    (the first data() call inside a block formats it), and row status (decadent /
+    ignored / has-rule) is kept in NumPy arrays, so every data() call is a plain
+    array lookup. rowCount() is always the full row count: select-all and the
+    bulk actions see every row, not only the ones already scrolled into view.
+
+    Like a filter proxy, the model can show a subset of the frame: view rows map
+    to frame positions (set_row_positions), without rebuilding any cached strings.
+    Sorting (header click) only reorders those positions.
+    """
+    FORMAT_BATCH_SIZE = 2000
+
+    HEADER_MAP = {
+        Columns.INVOICE_NUMBER: "Nº Nota", Columns.ISSUE_DATE: "Data Emissão",
+        Columns.VALUE: "Valor (R$)", Columns.RATE: "Alíq. Decl.",
+        Columns.CORRECT_RATE: "Alíq. Corr.", Columns.SERVICE_DESCRIPTION: "Discriminação",
+        Columns.STATUS_LEGAL: "Status Legal", Columns.BROKEN_RULE_DETAILS: "Infrações"
+    }
+
+    COLUMN_FORMATTERS = {
+        Columns.VALUE: _format_brl_number,
+        Columns.RATE: _format_rate,
+        Columns.CORRECT_RATE: _format_rate,
+        Columns.ISSUE_DATE: _format_issue_date,
+        Columns.BROKEN_RULE_DETAILS: _format_rule_details,
+    }
+
+    def __init__(self, df, visible_columns, parent=None, row_positions=None):
+        super().__init__(parent)
+        self._df = df
+        self._visible_columns = list(visible_columns)
+        self._sort_state = None  # (column, Qt.SortOrder) re-applied on set_row_positions
+        n_rows = len(df)
+
+        # Original DataFrame index per row (returned on UserRole for selection logic)
+        self._index_values = df.index.tolist()
+
+        # Display strings: one object array per visible column, filled on demand
+        self._display = [np.empty(n_rows, dtype=object) for _ in self._visible_columns]
+        self._formatted = np.zeros(n_rows, dtype=bool)
+
+        self._rule_col = (self._visible_columns.index(Columns.BROKEN_RULE_DETAILS)
+                          if Columns.BROKEN_RULE_DETAILS in self._visible_columns else -1)
+        self._is_decadent = np.zeros(n_rows, dtype=bool)
+        self._is_ignored = np.zeros(n_rows, dtype=bool)
+        self._has_rule = np.zeros(n_rows, dtype=bool)
+        self._compute_status(np.arange(n_rows))
+
+        # Colors
+        self.color_decadent = QColor(80, 80, 80)
+        self.color_rule = QColor(100, 92, 63)
+        self.color_ignored = QColor(220, 220, 220)
+        self.color_text_ignored = QColor(100, 100, 100)
+
+        self._rows = np.arange(n_rows) if row_positions is None else np.asarray(row_positions, dtype=np.intp)
+
+    def is_compatible(self, df, visible_columns):
+        """True if this model can be reused for `df` with these columns."""
+        return (self._df is df and len(self._index_values) == len(df)
+                and self._visible_columns == list(visible_columns))
+
+    def _compute_status(self, positions):
+        df = self._df
+        if Columns.STATUS_LEGAL in df.columns:
+            self._is_decadent[positions] = df[Columns.STATUS_LEGAL].iloc[positions].isin(['Decadente', 'Prescrito']).to_numpy()
+        if 'status_manual' in df.columns:
+            self._is_ignored[positions] = (df['status_manual'].iloc[positions] == 'Ignored').to_numpy()
+        if self._rule_col >= 0:
+            details = df[Columns.BROKEN_RULE_DETAILS].iloc[positions]
+            self._has_rule[positions] = np.fromiter((_is_truthy(v) for v in details), dtype=bool, count=len(details))
+
+    def _format_column(self, col_name, positions):
+        values = self._df[col_name].iloc[positions]
+        is_na = values.isna().to_numpy()
+        formatter = self.COLUMN_FORMATTERS.get(col_name, str)
+
+        if col_name == Columns.ISSUE_DATE and pd.api.types.is_datetime64_any_dtype(values):
+            formatted = values.dt.strftime('%d/%m/%Y').to_numpy(dtype=object)
+        else:
+            formatted = np.empty(len(values), dtype=object)
+            for i, (val, na) in enumerate(zip(values.to_numpy(dtype=object), is_na)):
+                if na:
+                    continue
+                try:
+                    formatted[i] = formatter(val)
+                except (TypeError, ValueError):
+                    formatted[i] = str(val)
+        formatted[is_na] = ""
+        return formatted
+
+    def _format_block(self, view_row):
+        """Formats the frame rows (not yet cached) of the block of view rows containing `view_row`."""
+        start = view_row - view_row % self.FORMAT_BATCH_SIZE
+        positions = self._rows[start:start + self.FORMAT_BATCH_SIZE]
+        missing = positions[~self._formatted[positions]]
+        if len(missing):
+            for col_pos, col_name in enumerate(self._visible_columns):
+                self._display[col_pos][missing] = self._format_column(col_name, missing)
+            self._formatted[missing] = True
+
+    def display_text(self, view_row, column):
+        src_row = self._rows[view_row]
+        if not self._formatted[src_row]:
+            self._format_block(view_row)
+        return self._display[column][src_row]
+
+    def _sorted(self, positions):
+        if self._sort_state is None or not len(positions):
+            return positions
+        column, order = self._sort_state
+        values = self._df[self._visible_columns[column]].iloc[positions].reset_index(drop=True)
+        ascending = order == Qt.AscendingOrder
+        try:
+            order_idx = values.sort_values(ascending=ascending, kind='stable', na_position='last').index
+        except TypeError:
+            order_idx = values.astype(str).sort_values(ascending=ascending, kind='stable').index
+        return positions[order_idx.to_numpy()]
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if not 0 <= column < len(self._visible_columns):
+            return
+        self._sort_state = (column, order)
+        self.set_row_positions(self._rows)
+
+    def set_row_positions(self, positions):
+        """Shows only the given frame positions (in order). Cached strings are reused."""
+        self.beginResetModel()
+        self._rows = self._sorted(np.asarray(positions, dtype=np.intp))
+        self.endResetModel()
+
+    def refresh_rows(self, index_labels):
+        """Re-reads status and display strings for rows whose frame values changed."""
+        positions = self._df.index.get_indexer_for(list(index_labels))
+        positions = positions[positions >= 0]
+        if not len(positions):
+            return
+        # Re-formatted on the next data() call of their block
+        self._formatted[positions] = False
+        self._compute_status(positions)
+        if len(self._rows):
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self._rows) - 1, self.columnCount() - 1))
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self._visible_columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        src_row = self._rows[index.row()]
+        col_idx = index.column()
+
+        # 1. Display Data (Text)
+        if role == Qt.DisplayRole or role == Qt.ToolTipRole:
+            return self.display_text(index.row(), col_idx)
+
+        # 2. Background Color (Status Logic)
+        elif role == Qt.BackgroundRole:
+            if self._is_decadent[src_row]:
+                return self.color_decadent
+            if self._is_ignored[src_row]:
+                return self.color_ignored
+            if col_idx == self._rule_col and self._has_rule[src_row]:
+                return self.color_rule
+
+        # 3. Foreground Color (Text Color)
+        elif role == Qt.ForegroundRole:
+            if self._is_ignored[src_row]:
+                return self.color_text_ignored
+
+        # 4. UserRole: Return the Original DataFrame Index (Vital for selection logic)
+        elif role == Qt.UserRole:
+            return self._index_values[src_row]
+
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            col_name = self._visible_columns[section]
+            return self.HEADER_MAP.get(col_name, col_name)
+        return None
+
+
+class InvoiceFilterIndex:
+    """
+    Filtering support over the wizard's invoice frame: string columns are
+    converted (and lowered) once, and "contains" masks are cached per
+    (column, text). Typing one more character only scans the rows that
+    matched the previous text.
+    """
+    MAX_CACHED_MASKS = 64
+
+    def __init__(self, df):
+        self.df = df
+        self._n_rows = len(df)
+        self._text = {}
+        self._lower = {}
+        self._masks = {}
+        self._years = None
+
+    def is_compatible(self, df):
+        return self.df is df and self._n_rows == len(df)
+
+    def invalidate_columns(self, columns):
+        for col in columns:
+            self._text.pop(col, None)
+            self._lower.pop(col, None)
+            if col == Columns.ISSUE_DATE:
+                self._years = None
+        self._masks = {k: v for k, v in self._masks.items() if k[0] not in columns}
+
+    def text_column(self, col):
+        """Values as shown by the header filter dialog (NaN -> '')."""
+        if col not in self._text:
+            self._text[col] = as_text(self.df[col]).to_numpy()
+        return self._text[col]
+
+    def lower_column(self, col):
+        if col not in self._lower:
+            self._lower[col] = self.df[col].astype(str).str.lower()
+        return self._lower[col]
+
+    def contains_mask(self, col, text):
+        if col not in self.df.columns:
+            return np.ones(self._n_rows, dtype=bool)
+        key = (col, text)
+        mask = self._masks.get(key)
+        if mask is not None:
+            return mask
+
+        lowered = self.lower_column(col)
+        prefix_mask = None
+        for i in range(len(text) - 1, 0, -1):
+            prefix_mask = self._masks.get((col, text[:i]))
+            if prefix_mask is not None:
+                break
+        if prefix_mask is None:
+            mask = lowered.str.contains(text, regex=False, na=False).to_numpy()
+        else:
+            mask = np.zeros(self._n_rows, dtype=bool)
+            candidates = np.flatnonzero(prefix_mask)
+            mask[candidates] = lowered.iloc[candidates].str.contains(text, regex=False, na=False).to_numpy()
+
+        if len(self._masks) >= self.MAX_CACHED_MASKS:
+            self._masks.pop(next(iter(self._masks)))
+        self._masks[key] = mask
+        return mask
+
+    def values_mask(self, col, allowed_values):
+        if col not in self.df.columns:
+            return np.ones(self._n_rows, dtype=bool)
+        return np.isin(self.text_column(col), list(allowed_values))
+
+    def equals_mask(self, col, value):
+        if col not in self.df.columns:
+            return np.zeros(self._n_rows, dtype=bool)
+        return (self.df[col] == value).to_numpy()
+
+    def years(self):
+        if self._years is None:
+            dates = self.df[Columns.ISSUE_DATE]
+            if not pd.api.types.is_datetime64_any_dtype(dates):
+                dates = pd.to_datetime(dates, errors='coerce')
+            self._years = dates.dt.year.to_numpy(dtype=float)
+        return self._years
@@ -0,0 +1,89 @@
+# --- FILE: legal_deadlines.py ---
+"""
+Prazos legais por nota (CTN), calculados de uma vez com aritmética inteira de
+datetime64[M]/[Y] (sem DateOffset, que num Series corre elemento a elemento):
+
+    Art. 150 (pago)     -> fim do mês de emissão + 5 anos     (Decadente_Pago se ref > prazo)
+    Art. 173 (infração) -> 1 de janeiro do ano de emissão + 6 (Decadente se ref >= prazo)
+    Art. 174 (IDD)      -> dia 20 do mês de emissão + 5 anos   (Prescrito se ref >= prazo)
+
+Os prazos dependem só das datas; a data de referência (hoje por omissão) entra
+apenas na comparação, o que permite simulações "e se" sem recalcular nada.
+"""
+
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+ART150_MONTHS = 5 * 12
+ART173_YEARS = 6
+ART174_MONTHS = 5 * 12
+ART174_DUE_DAY = 20  # último dia do mês anterior + 20 dias
+
+
+def reference_day(reference_date=None):
+    """Data de referência como datetime64[D] (hoje se None)."""
+    if reference_date is None:
+        reference_date = datetime.now().date()
+    return np.datetime64(pd.Timestamp(reference_date).date(), 'D')
+
+
+def _days_in_month(months):
+    return (months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')
+
+
+class LegalDeadlines:
+    """Prazos dos Art. 150/173/174 (datetime64[D], NaT se a data falta) de uma coluna de datas."""
+
+    def __init__(self, dates):
+        issue_days = np.asarray(pd.to_datetime(dates, errors='coerce'), dtype='datetime64[ns]').astype('datetime64[D]')
+        valid = ~np.isnat(issue_days)
+        n = len(issue_days)
+        self.art150 = np.full(n, np.datetime64('NaT'), dtype='datetime64[D]')
+        self.art173 = self.art150.copy()
+        self.art174 = self.art150.copy()
+        if not valid.any():
+            return
+
+        # Os prazos só dependem do dia de emissão: calcula-os uma vez para cada dia
+        # do intervalo coberto (alguns milhares) e distribui por indexação.
+        day_numbers = issue_days.view(np.int64)
+        first_day = day_numbers[valid].min()
+        positions = day_numbers[valid] - first_day
+        span_days = np.arange(first_day, first_day + positions.max() + 1).astype('datetime64[D]')
+        months = span_days.astype('datetime64[M]')
+        one_day = np.timedelta64(1, 'D')
+
+        # MonthEnd(0) + DateOffset(years=5): dia limitado ao tamanho do mês de destino (fev.)
+        target = months + ART150_MONTHS
+        last_day = np.minimum(_days_in_month(months), _days_in_month(target))
+        art150 = target.astype('datetime64[D]') + last_day - one_day
+
+        art173 = (span_days.astype('datetime64[Y]') + ART173_YEARS).astype('datetime64[D]')
+
+        art174 = ((months + ART174_MONTHS).astype('datetime64[D]')
+                  + np.timedelta64(ART174_DUE_DAY - 1, 'D'))
+
+        self.art150[valid] = art150[positions]
+        self.art173[valid] = art173[positions]
+        self.art174[valid] = art174[positions]
+
+    def decadente_pago(self, reference_date=None):
+        """Art. 150: pagamento homologado tacitamente (prazo já ultrapassado)."""
+        return reference_day(reference_date) > self.art150
+
+    def decadente(self, reference_date=None):
+        """Art. 173: direito de lançar a infração extinto."""
+        return reference_day(reference_date) >= self.art173
+
+    def prescrito(self, reference_date=None):
+        """Art. 174: cobrança do valor declarado e não pago prescrita."""
+        return reference_day(reference_date) >= self.art174
+
+
+def mark_paid_decadence(df, is_paid_mask, reference_date=None, date_col='DATA EMISSÃO'):
+    """'status_legal' = 'Decadente_Pago' nas notas pagas fora do prazo do Art. 150 (in place)."""
+    mask = np.asarray(is_paid_mask, dtype=bool) & LegalDeadlines(df[date_col]).decadente_pago(reference_date)
+    if mask.any():
+        df.loc[mask, 'status_legal'] = 'Decadente_Pago'
+    return df
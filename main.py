@@ -3,21 +3,21 @@
 import os
 import pandas as pd
 import numpy as np
-from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from pandas.tseries.offsets import MonthEnd
 import sys
 import rules_engine
 from data_loader import create_context_for_generation
 # ❌ REMOVIDO: from report_generator import generate_simple_document, generate_report, convert_to_pdf
-from description_analyzer import DescriptionAnalyzer
+# ⚠️ description_analyzer (spaCy) é importado só dentro de perform_description_analysis
 # ❌ REMOVIDO: from pdf_reports_generator import generate_detailed_pdfs
 import traceback
 import logging
 from collections import defaultdict
 from utils import resource_path
+from conflict_resolution import rank_conflicts, resolve_conflicts
+from invoice_schema import apply_invoice_schema, map_values
+from legal_deadlines import mark_paid_decadence
 from app.pgdas_loader import _load_and_process_pgdas
-from pandas.tseries.offsets import MonthEnd, DateOffset # ✅ Import DateOffset
 import time
 # --- Local Imports for Configuration ---
 from app.config import (
@@ -83,15 +83,8 @@ def load_activity_data():
 
 
 # ... (função load_and_prepare_invoices permanece igual) ...
-def _find_column_by_synonyms(columns, targets):
-    """Helper to find a column name given a list of synonyms."""
-    upper_cols = {str(c).upper().strip(): c for c in columns}
-    for t in targets:
-        if t.upper() in upper_cols:
-            return upper_cols[t.upper()]
-    return None
-
-def load_and_prepare_invoices(master_filepath, invoices_filepath, company_cnpj, status_callback=None, auto_resolve_conflicts=True):
+def load_and_prepare_invoices(master_filepath, invoices_filepath, company_cnpj, status_callback=None, auto_resolve_conflicts=True,
+                              reference_date=None):
     emit = status_callback.emit if status_callback else print
     try:
         emit("🔄 Carregando e preparando dados das Notas Fiscais...")
@@ -152,81 +145,22 @@ def load_and_prepare_invoices(master_filepath, invoices_filepath, company_cnpj,
             # 1. Remove Exact Duplicates
             company_invoices.drop_duplicates(inplace=True)
 
-            # --- 🚀 NEW SMART SORT LOGIC START ---
-            
-            # Helper 1: Find RPS Column
-            rps_col = _find_column_by_synonyms(company_invoices.columns, ['Nº RPS', 'RPS', 'NO RPS', 'NUMERO RPS'])
-            
-            # Helper 2: Find Regime Column
-            regime_col = _find_column_by_synonyms(company_invoices.columns, ['REGIME DE TRIBUTAÇÃO', 'REGIME', 'REGIME TRIBUTACAO'])
-
-            # Helper 3: Find Description Column
-            desc_synonyms = ['DISCRIMINAÇÃO DOS SERVIÇOS', 'DISCRIMINACAO DOS SERVICOS', 'DESCRIÇÃO', 'DESC']
-            desc_col = _find_column_by_synonyms(company_invoices.columns, desc_synonyms)
-
-            # Create sorting scores (0 = Good/Keep, 1 = Bad/Remove)
-            
-            # A. RPS Criteria: If RPS == 1, it is "Bad" (1). Else "Good" (0).
-            if rps_col:
-                # Convert to numeric safely, handle strings "1" or ints 1
-                company_invoices['_tmp_rps_val'] = pd.to_numeric(company_invoices[rps_col], errors='coerce').fillna(0)
-                company_invoices['_sort_rps_bad'] = np.where(company_invoices['_tmp_rps_val'] == 1, 1, 0)
-                company_invoices.drop(columns=['_tmp_rps_val'], inplace=True)
-            else:
-                company_invoices['_sort_rps_bad'] = 0 # Neutral if column missing
-
-            # B. Regime Criteria: If "Optante pelo Simples", it is "Bad" (1).
-            if regime_col:
-                company_invoices['_sort_regime_bad'] = company_invoices[regime_col].astype(str).apply(
-                    lambda x: 1 if "Optante pelo Simples Nacional" in x else 0
-                )
-            else:
-                company_invoices['_sort_regime_bad'] = 0
-
-            # C. Description Length (Tie breaker)
-            if desc_col:
-                company_invoices['_desc_len'] = company_invoices[desc_col].astype(str).str.len()
-            else:
-                company_invoices['_desc_len'] = 0
-
-            # D. Apply Sort
-            # Priority:
-            # 1. Number (Group together)
-            # 2. RPS Badness (Ascending -> 0 comes before 1. So NON-RPS-1 stays at top)
-            # 3. Regime Badness (Ascending -> 0 comes before 1. So NON-Simples stays at top)
-            # 4. Aliquot (Descending -> Higher Aliquot stays at top)
-            # 5. Value (Descending -> Higher Value stays at top)
-            
-            company_invoices.sort_values(
-                by=[unique_col, '_sort_rps_bad', '_sort_regime_bad', 'ALÍQUOTA', 'VALOR', '_desc_len'], 
-                ascending=[True, True, True, False, False, False], 
-                inplace=True
-            )
-            
-            # Cleanup temp sort columns
-            company_invoices.drop(columns=['_sort_rps_bad', '_sort_regime_bad', '_desc_len'], inplace=True)
-            
-            # --- 🚀 NEW SMART SORT LOGIC END ---
+            # 2. Rank duplicated numbers (RPS!=1 > Regime!=Simples > Maior Alíquota > Maior Valor)
+            conflict_count = rank_conflicts(company_invoices, unique_col)
 
             # 3. Handle Conflicts
-            # duplicated(keep='first') marks duplicates except for the first occurrence.
-            # Since we sorted the "Best" one to the top, keep='first' works perfectly.
-            duplicates_mask = company_invoices.duplicated(subset=[unique_col], keep='first')
-            all_conflicts_mask = company_invoices.duplicated(subset=[unique_col], keep=False)
-
-            if all_conflicts_mask.any():
+            if conflict_count:
                 if auto_resolve_conflicts:
-                    # 'first' keeps the top sorted row (Best RPS, Best Regime, Best Aliquot)
-                    company_invoices.drop_duplicates(subset=[unique_col], keep='first', inplace=True)
+                    # Keeps the rank-1 row of each group (Best RPS, Best Regime, Best Aliquot)
+                    company_invoices = resolve_conflicts(company_invoices)
                     diff = initial_count - len(company_invoices)
                     if diff > 0: emit(f"   - 🧹 Auto-Resolução: {diff} duplicatas removidas (Prioridade: RPS!=1 > Regime!=Simples > Maior Alíquota).")
                     company_invoices['_is_conflict'] = False
                 else:
-                    # Mark all involved rows as conflicts so the user can choose in the Dialog
-                    company_invoices['_is_conflict'] = all_conflicts_mask
+                    # '_is_conflict' / '_conflict_rank' ficam para o DuplicateReviewDialog
                     emit(f"   - ⚠️ Detetados conflitos para revisão.")
             else:
-                company_invoices['_is_conflict'] = False
+                company_invoices.drop(columns=['_conflict_rank'], inplace=True)
 
         # --- Final Calcs ---
         company_invoices['VALOR_ORIGINAL'] = company_invoices['VALOR']
@@ -237,18 +171,16 @@ def load_and_prepare_invoices(master_filepath, invoices_filepath, company_cnpj,
                                                     .str.replace(r'\D', '', regex=True)
                                                     .str.strip().str.pad(4, side='left', fillchar='0'))
             
-        # Decadence Logic
-        today = pd.to_datetime(datetime.now().date())
+        # Decadence Logic (Art. 150, see legal_deadlines)
         if 'PAGAMENTO' not in company_invoices.columns: company_invoices['PAGAMENTO'] = 'Não'
         company_invoices['PAGAMENTO'].fillna('Não', inplace=True)
         is_paid_mask = company_invoices['PAGAMENTO'].str.strip().str.lower().isin(['sim', 'idd'])
         
         company_invoices['status_legal'] = 'OK'
-        paid_invoices_mask = is_paid_mask & company_invoices['DATA EMISSÃO'].notna()
-        if paid_invoices_mask.any():
-            cutoff = company_invoices.loc[paid_invoices_mask, 'DATA EMISSÃO'] + MonthEnd(0) + DateOffset(years=5)
-            mask_dec = today > cutoff
-            company_invoices.loc[mask_dec[mask_dec].index, 'status_legal'] = 'Decadente_Pago'
+        mark_paid_decadence(company_invoices, is_paid_mask, reference_date)
+
+        # Canonical dtypes (categoricals for the repeated text columns)
+        apply_invoice_schema(company_invoices)
 
         emit("✅ Preparação das notas concluída.")
         return company_invoices
@@ -287,9 +219,10 @@ def perform_description_analysis(company_invoices_df, status_callback=None):
     if 'correct_rate' not in company_invoices_df:
         company_invoices_df['correct_rate'] = np.nan
     
-    company_invoices_df['activity_desc'] = company_invoices_df['CÓDIGO DA ATIVIDADE'].map(desc_map).fillna('N/A')
-    company_invoices_df['correct_rate'] = company_invoices_df['CÓDIGO DA ATIVIDADE'].map(rate_map).fillna(0.0)
+    company_invoices_df['activity_desc'] = map_values(company_invoices_df['CÓDIGO DA ATIVIDADE'], desc_map, 'N/A').astype('category')
+    company_invoices_df['correct_rate'] = map_values(company_invoices_df['CÓDIGO DA ATIVIDADE'], rate_map, 0.0).astype(float)
 
+    from description_analyzer import DescriptionAnalyzer  # Lazy: evita importar spaCy na geração
     analyzer = DescriptionAnalyzer()
     if status_callback:
         analyzer.progress.connect(status_callback)
@@ -307,7 +240,7 @@ def perform_description_analysis(company_invoices_df, status_callback=None):
     return df_with_ai
 
 # ... (função perform_rules_analysis permanece igual) ...
-def perform_rules_analysis(company_invoices_df, idd_mode=False):
+def perform_rules_analysis(company_invoices_df, idd_mode=False, reference_date=None, split_by_year=False):
     """
     Revised to use Vectorized Rules Engine.
     Significantly faster than previous list-of-dicts iteration.
@@ -346,12 +279,12 @@ def perform_rules_analysis(company_invoices_df, idd_mode=False):
     analyzed_df = rules_engine.process_invoices_vectorized(
         invoices_for_analysis, 
         aliquotas_lookup, 
+        today=reference_date,
         idd_mode=idd_mode
     )
 
-    # Group results
-    violating_invoices = analyzed_df[analyzed_df['primary_infraction_group'] != 'compliant']
-    infraction_groups = {key: group for key, group in violating_invoices.groupby('primary_infraction_group')}
+    # Group results (optionally one group per emission year, in the same pass)
+    infraction_groups = rules_engine.build_infraction_groups(analyzed_df, split_by_year=split_by_year)
 
     return infraction_groups, analyzed_df
 
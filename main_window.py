@@ -15,6 +15,7 @@ from PySide6.QtGui import QAction, QIcon, QDesktopServices, QFont
 import json 
 from datetime import datetime 
 from main import load_activity_data
+from cadastro_repository import CADASTRO_DTYPES, get_cadastro_path, get_cadastro_repository
 # ✅ Import SESSION_FILE_PREFIX to handle session cleanup
 from .constants import Columns, APP_NAME, SESSION_FILE_PREFIX, APP_VERSION
 # ✅ Importar os novos workers (incluindo SituacaoExtractorWorker e AutomaticIDDWorker)
@@ -22,7 +23,9 @@ from .workers import (AIPrepWorker, RulesPrepWorker, AIAnalysisWorker, Generatio
                       SimplesReaderWorker, SimplesDownloaderWorker, DatabaseExtractorWorker,
                       SituacaoExtractorWorker, UpdateCheckerWorker, UpdateDownloaderWorker,
                       AutomaticIDDWorker, DeckerWorker, AnalysisScannerWorker, MultiYearPrepWorker,
-                      NewsFetcherWorker) # <--- ADD DeckerWorker
+                      NewsFetcherWorker, WorkspaceSaveWorker, list_multi_year_files) # <--- ADD DeckerWorker
+from .workspace_store import WorkspaceStore, UNCHANGED
+from .excel_export import export_frame
 from .relabeling_dialog import RelabelingWindow
 from .review_wizard import ReviewWizard 
 from .settings_dialog import SettingsDialog
@@ -36,10 +39,10 @@ from .generation_summary_dialog import GenerationSummaryDialog
 # ✅ Importar o novo diálogo de Ferramentas
 from app.ferramentas.qt_dialogs import GetFolderAndYearsDialog, CNPJSelectionDialog # Importado CNPJSelectionDialog
 from app.workers import UpdateCheckerWorker
-from app.updater import Updater
 from app.constants import APP_VERSION
 from app.activity_review_dialog import ActivityReviewDialog
 from .duplicate_review_dialog import DuplicateReviewDialog # ✅ Import New Dialog
+from conflict_resolution import resolve_conflicts
 
 
 class AuditApp(QMainWindow):
@@ -61,11 +64,20 @@ class AuditApp(QMainWindow):
         
         self.infraction_groups = {}
         self.activity_list = []
+
+        # Workspace da empresa (retomar a análise sem reler os Excel)
+        self._workspace = None
+        self._workspace_source_paths = []
+        self._workspace_sources = None
+        self._workspace_written = {}  # frame -> object last sent to disk (clean/groups/dams are only ever replaced)
+        self._workspace_job = None  # (QThread, WorkspaceSaveWorker) writing right now
+        self._workspace_queue = []  # saves waiting for the running one
         
         self.df_empresas = pd.DataFrame(columns=[
             Columns.CNPJ, Columns.RAZAO_SOCIAL, Columns.IMU, 
             Columns.ENDERECO, Columns.CEP, Columns.EPAF_NUMERO
         ])
+        self.cadastro_repo = None
         self.activity_data = {}
         
         self.workflow_state = {
@@ -129,8 +141,7 @@ class AuditApp(QMainWindow):
         try:
             df = pd.DataFrame(columns=columns)
             # Saving to sheet 'Empresas' as that is the default expected by load_companies
-            with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-                df.to_excel(writer, sheet_name='Empresas', index=False)
+            export_frame(filepath, df, sheet_name='Empresas')
             
             self.log_text_edit.append(f"✅ Modelo criado com sucesso em: {filepath}")
             QMessageBox.information(self, "Sucesso", f"Modelo criado em:\n{filepath}")
@@ -381,11 +392,9 @@ class AuditApp(QMainWindow):
                     
                     if possible_imu:
                         # Find CNPJ in Master DF
-                        master_clean_imus = self.df_empresas[Columns.IMU].astype(str).str.replace(r'\D', '', regex=True)
-                        matches = self.df_empresas[master_clean_imus == possible_imu]
+                        row = self.cadastro_repo.get_by_imu(possible_imu) if self.cadastro_repo else None
                         
-                        if not matches.empty:
-                            row = matches.iloc[0]
+                        if row is not None:
                             # Check if PDF exists
                             pdf_exists = len(list(folder.glob("*_Comunicado.pdf"))) > 0
                             
@@ -500,10 +509,8 @@ class AuditApp(QMainWindow):
                     # Try finding in Master File
                     if possible_imu:
                         # Match by IMU (ignoring punctuation in master)
-                        master_imus = self.df_empresas[Columns.IMU].astype(str).str.replace(r'\D', '', regex=True)
-                        matches = self.df_empresas[master_imus == possible_imu]
-                        if not matches.empty:
-                            matched_row = matches.iloc[0]
+                        if self.cadastro_repo:
+                            matched_row = self.cadastro_repo.get_by_imu(possible_imu)
                     
                     # If found in master, look for Invoice Excel inside
                     if matched_row is not None:
@@ -750,6 +757,7 @@ class AuditApp(QMainWindow):
         # or inside a thread if we want a progress bar. 
         # For simplicity, let's run it carefully.
         try:
+            from app.updater import Updater
             updater = Updater()
             # Defining a simple callback to update log/status
             def update_status(msg):
@@ -892,7 +900,7 @@ class AuditApp(QMainWindow):
         self.log_text_edit = QTextEdit(); self.log_text_edit.setReadOnly(True); log_layout.addWidget(self.log_text_edit)
         log_group.setLayout(log_layout); main_layout.addWidget(log_group, 1)
 
-    def _get_cadastro_path(self, master_path): return f"{os.path.splitext(master_path)[0]}_cadastro{os.path.splitext(master_path)[1]}"
+    def _get_cadastro_path(self, master_path): return get_cadastro_path(master_path)
     
     def load_auditor_info(self):
         """Loads auditor info from config into the UI."""
@@ -957,16 +965,14 @@ class AuditApp(QMainWindow):
 
     def load_companies(self, file_path):
         cp = self._get_cadastro_path(file_path)
-        sc = {Columns.CNPJ: str, Columns.RAZAO_SOCIAL: str, Columns.IMU: str, Columns.ENDERECO: str, Columns.CEP: str, Columns.EPAF_NUMERO: str}
+        sc = CADASTRO_DTYPES
         try:
-            df = pd.read_excel(cp, dtype=sc) if os.path.exists(cp) else None
-            if df is None and os.path.exists(file_path):
+            if not os.path.exists(cp) and os.path.exists(file_path):
                 xls = pd.ExcelFile(file_path)
-                if 'Empresas' in xls.sheet_names: df = pd.read_excel(file_path, sheet_name='Empresas', dtype=sc); df.to_excel(cp, index=False)
-            self.df_empresas = df if df is not None else pd.DataFrame(columns=sc.keys())
-            for col in sc: 
-                if col not in self.df_empresas.columns: self.df_empresas[col] = ''
-                self.df_empresas[col] = self.df_empresas[col].fillna('').astype(str)
+                if 'Empresas' in xls.sheet_names: pd.read_excel(file_path, sheet_name='Empresas', dtype=sc).to_excel(cp, index=False)
+            # ✅ Cadastro em cache (indexado por CNPJ/IMU, relido só se o ficheiro mudar)
+            self.cadastro_repo = get_cadastro_repository(cp)
+            self.df_empresas = self.cadastro_repo.load()
             
             # ⚠️ NOTE: We are NOT stripping CNPJ here anymore to preserve formatting for display/lookup
             # If your 'main.py' expects stripped, we will strip it ONLY when passing to the worker.
@@ -984,6 +990,7 @@ class AuditApp(QMainWindow):
             self.update_cadastro_display()
             
         except Exception as e:
+            self.cadastro_repo = None
             self.df_empresas = pd.DataFrame(columns=sc.keys()); self.company_combo.clear()
 
     def prepare_add_new_company(self, cnpj_to_add=None):
@@ -1000,10 +1007,9 @@ class AuditApp(QMainWindow):
 
     def update_cadastro_display(self):
         cnpj = self.company_combo.currentData()
-        if cnpj and self.df_empresas is not None:
-            row = self.df_empresas[self.df_empresas[Columns.CNPJ] == cnpj]
-            if not row.empty:
-                d = row.iloc[0].to_dict()
+        if cnpj and self.cadastro_repo is not None:
+            d = self.cadastro_repo.get_by_cnpj(cnpj)
+            if d is not None:
                 self.razao_social_edit.setText(d.get(Columns.RAZAO_SOCIAL,'')); self.cnpj_edit.setText(d.get(Columns.CNPJ,''))
                 self.imu_edit.setText(d.get(Columns.IMU,'')); self.endereco_edit.setText(d.get(Columns.ENDERECO,''))
                 self.cep_edit.setText(d.get(Columns.CEP,'')); self.epaf_numero_edit.setText(d.get(Columns.EPAF_NUMERO,''))
@@ -1026,24 +1032,15 @@ class AuditApp(QMainWindow):
             # Determine if existing or new based on cleaned comparison, but save what is in text box
             clean_current = re.sub(r'\D', '', cur_cnpj)
             
-            # Find based on cleaned version
-            idx = self.df_empresas.index[self.df_empresas[Columns.CNPJ].astype(str).str.replace(r'\D', '', regex=True) == clean_current]
-            
             data = {Columns.RAZAO_SOCIAL: self.razao_social_edit.text(), Columns.CNPJ: cur_cnpj,
                     Columns.IMU: self.imu_edit.text(), Columns.ENDERECO: self.endereco_edit.text(),
                     Columns.CEP: self.cep_edit.text(), Columns.EPAF_NUMERO: self.epaf_numero_edit.text()}
             
-            new_comp = False
-            if not idx.empty:
-                # Update existing
-                for k,v in data.items(): self.df_empresas.loc[idx[0], k] = v
-                # Update combo item text
-                ci = self.company_combo.findData(self.df_empresas.loc[idx[0], Columns.CNPJ]) # Find by old data if possible, might be tricky if key changed
-                
-                # Simpler: just reload list logic or update current
-                # Since we match by Data, and Data is CNPJ, if CNPJ changed we have a problem.
-                # For now, assume CNPJ edit creates new or updates in place. 
-                
+            # Existing vs new is decided by the repository (cleaned CNPJ comparison)
+            self.cadastro_repo = get_cadastro_repository(cp)
+            new_comp = self.cadastro_repo.upsert(data)
+            self.df_empresas = self.cadastro_repo.frame
+            if not new_comp:
                 # Re-find index in combo by iterating (safe way)
                 for i in range(self.company_combo.count()):
                     item_clean_cnpj = re.sub(r'\D', '', str(self.company_combo.itemData(i)))
@@ -1053,12 +1050,10 @@ class AuditApp(QMainWindow):
                         break
 
             else:
-                new_comp = True
-                self.df_empresas = pd.concat([self.df_empresas, pd.DataFrame([data])], ignore_index=True)
                 self.company_combo.addItem(f"{data[Columns.RAZAO_SOCIAL]} ({cur_cnpj})", userData=cur_cnpj)
                 self.company_combo.setCurrentIndex(self.company_combo.count()-1)
             
-            self.df_empresas.to_excel(cp, index=False)
+            self.cadastro_repo.save()
             self.statusBar().showMessage("Salvo.", 3000)
             self.cnpj_edit.setReadOnly(False); self.save_cadastro_button.setText("Salvar Alterações")
             if new_comp: self.on_company_selection_change(self.company_combo.currentIndex())
@@ -1125,6 +1120,7 @@ class AuditApp(QMainWindow):
             
             # Invalidate Rules State so user knows to run them again
             self.workflow_state['rules'] = 'pending' 
+            self._save_workspace()
             self.update_button_states()
 
     def update_log_from_thread(self, msg): self.log_text_edit.append(msg)
@@ -1186,7 +1182,8 @@ class AuditApp(QMainWindow):
             self.company_invoices_df = None
             self.infraction_groups = {}
             self.activity_list = []
-            self._temp_multi_year_dams_path = None
+            self._temp_multi_year_dams = None
+            self._workspace = None  # the saved workspace stays on disk
             # Resetar o estado do fluxo de trabalho
             self.workflow_state = {
                 'load': 'pending', 
@@ -1251,7 +1248,9 @@ class AuditApp(QMainWindow):
         if not cc: QMessageBox.warning(self, "Erro", "CNPJ Inválido"); return
         
         # To be safe, let's try to pass the FORMATTED version first (since that's what's in your cadastro now)
-        self._temp_multi_year_dams_path = None
+        self._temp_multi_year_dams = None
+        if self._offer_workspace_resume(cc, [self.invoices_file_path_edit.text()]):
+            return
         self.log_text_edit.append(f"--- Carregar Notas (CNPJ Alvo: {cc}) ---")
         self.statusBar().showMessage("A carregar...")
         self._start_worker_thread(AIPrepWorker, 'load', self.master_file_path_edit.text(), self.invoices_file_path_edit.text(), cc, on_finished_slot=self.on_invoices_loaded)
@@ -1279,25 +1278,22 @@ class AuditApp(QMainWindow):
                 QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
             )
             
+            indices_to_keep = None  # None -> rank-1 version of each number
             if reply == QMessageBox.StandardButton.Yes:
                 # Open Dialog
                 dialog = DuplicateReviewDialog(df, parent=self)
                 if dialog.exec():
                     # Get cleaned list of indices
                     indices_to_keep = dialog.get_resolved_indices()
-                    df = df.loc[indices_to_keep].copy()
                     self.log_text_edit.append("✅ Revisão de duplicatas aplicada manualmente.")
                 else:
                     self.log_text_edit.append("⚠️ Revisão cancelada. Mantendo seleção automática padrão.")
-                    # Fallback to smart sort drop (first)
-                    df.drop_duplicates(subset=['NÚMERO'], keep='first', inplace=True)
             else:
                 # User chose NO -> Auto Resolve
                 self.log_text_edit.append("ℹ️ Mantendo seleção automática (Maior Valor/Alíquota).")
-                df.drop_duplicates(subset=['NÚMERO'], keep='first', inplace=True)
                 
-            # Clean up temp column
-            df.drop(columns=['_is_conflict'], inplace=True)
+            # Keep the chosen/default rows and clean up temp columns
+            df = resolve_conflicts(df, indices_to_keep)
 
         # ✅ Store BOTH Clean and Working copies (Standard Logic)
         self.clean_invoices_df = df.copy()
@@ -1306,6 +1302,7 @@ class AuditApp(QMainWindow):
         self.workflow_state['load'] = 'completed'
         self.workflow_state['rules'] = 'pending'
         self.workflow_state['review'] = 'pending'
+        self._save_workspace()
         self.update_button_states()
 
     def start_rules_analysis_thread(self):
@@ -1342,6 +1339,7 @@ class AuditApp(QMainWindow):
         # ✅ Logic to delete session file REMOVED. We rely on ReviewWizard.load_session to handle it.
         self.workflow_state['rules'] = 'completed'
         self.workflow_state['review'] = 'pending'
+        self._save_workspace()
         self.update_button_states()
 
     def start_ai_analysis_thread(self):
@@ -1354,6 +1352,7 @@ class AuditApp(QMainWindow):
         self.company_invoices_df = df # Update working copy
         self.log_text_edit.append("✅ IA concluída.")
         self.workflow_state['ai'] = 'completed'; self.workflow_state['relabel'] = 'pending'
+        self._save_workspace()
         self.update_button_states()
 
     def open_relabeling_window(self):
@@ -1366,6 +1365,7 @@ class AuditApp(QMainWindow):
             self.log_text_edit.append("✅ Relabeling feito. Re-execute regras.")
             self.workflow_state['relabel'] = 'completed'
             self.workflow_state['rules'] = 'stale' # Mark rules as stale
+            self._save_workspace()
             self.update_button_states()
 
     def start_generation_thread(self, final_data, preview_context, numero_multa, dam_filepath, pgdas_folder_path, output_dir_override, encerramento_version, company_imu):        
@@ -1390,7 +1390,7 @@ class AuditApp(QMainWindow):
     def load_multi_year_invoices(self):
         self.log_text_edit.clear()
 
-        self._temp_multi_year_dams_path = None
+        self._temp_multi_year_dams = None
         
         # 1. Ask for folder FIRST (Moved up)
         folder_path = QFileDialog.getExistingDirectory(self, "Selecione a Pasta com Ficheiros dos Anos", "")
@@ -1429,6 +1429,10 @@ class AuditApp(QMainWindow):
             QMessageBox.warning(self, "Erro", "Não foi possível detectar a empresa automaticamente.\n\nSelecione a empresa manualmente na lista acima ou verifique se os arquivos na pasta contêm o CNPJ correto."); 
             return
 
+        invoice_files, dam_files = list_multi_year_files(folder_path)
+        if invoice_files and self._offer_workspace_resume(cc, invoice_files + dam_files):
+            return
+
         self.log_text_edit.append(f"--- Carregar Multi-Ano (CNPJ: {cc}) ---")
         self.statusBar().showMessage("Consolidando arquivos...")
         
@@ -1441,14 +1445,14 @@ class AuditApp(QMainWindow):
             on_finished_slot=self.on_multi_year_loaded
         )
 
-    def on_multi_year_loaded(self, df, dams_path):
+    def on_multi_year_loaded(self, df, dams_frame):
         if df.empty:
             self.log_text_edit.append("❌ Erro: DataFrame consolidado vazio.")
             self.workflow_state['load'] = 'pending'
             self.update_button_states()
             return
 
-        self._temp_multi_year_dams_path = None
+        self._temp_multi_year_dams = None
         # ✅ CHECK FOR CONFLICTS (Same logic as on_invoices_loaded)
         if '_is_conflict' in df.columns and df['_is_conflict'].any():
             conflict_count = df[df['_is_conflict']]['NÚMERO'].nunique()
@@ -1464,21 +1468,19 @@ class AuditApp(QMainWindow):
                 QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
             )
             
+            indices_to_keep = None
             if reply == QMessageBox.StandardButton.Yes:
                 dialog = DuplicateReviewDialog(df, parent=self)
                 if dialog.exec():
                     indices_to_keep = dialog.get_resolved_indices()
-                    df = df.loc[indices_to_keep].copy()
                     self.log_text_edit.append("✅ Revisão de duplicatas aplicada manualmente.")
                 else:
                     self.log_text_edit.append("⚠️ Revisão cancelada. Usando automático.")
-                    # Default: keep first (sorted best)
-                    df.drop_duplicates(subset=['NÚMERO'], keep='first', inplace=True)
             else:
                 self.log_text_edit.append("ℹ️ Mantendo seleção automática.")
-                df.drop_duplicates(subset=['NÚMERO'], keep='first', inplace=True)
                 
-            df.drop(columns=['_is_conflict'], inplace=True)
+            # Default: rank-1 version of each number
+            df = resolve_conflicts(df, indices_to_keep)
 
         self.clean_invoices_df = df.copy()
         self.company_invoices_df = df.copy()
@@ -1486,23 +1488,174 @@ class AuditApp(QMainWindow):
         self.log_text_edit.append(f"📊 Total de Notas: {len(df)}")
         self.invoices_file_path_edit.setText(f"[Multi-Ano] {len(df)} registros")
         
-        if dams_path:
-            self._temp_multi_year_dams_path = dams_path 
-            self.log_text_edit.append(f"💰 DAMs consolidados vinculados.")
+        if dams_frame is not None:
+            self._temp_multi_year_dams = dams_frame  # in-memory DAM frame (no temp CSV)
+            self.log_text_edit.append(f"💰 DAMs consolidados vinculados ({len(dams_frame)} pagamentos avulsos).")
 
         self.workflow_state['load'] = 'completed'
         self.workflow_state['rules'] = 'pending'
         self.workflow_state['review'] = 'pending'
+        self._save_workspace()
+        self.update_button_states()
+
+    # --- Workspace (retomar análise) ---
+
+    def _offer_workspace_resume(self, cnpj, source_paths):
+        """
+        Prepares the company workspace for the given source files and, if a saved
+        one exists for exactly these (unchanged) files, offers to resume it.
+        The master (controle) file is tracked too: new rates there make the saved analysis stale.
+        Returns True if the saved state was restored (no reload needed).
+        """
+        store = WorkspaceStore(cnpj)
+        self._workspace = store
+        self._workspace_source_paths = [p for p in source_paths + [self.master_file_path_edit.text()] if p]
+        self._workspace_sources = None
+        self._workspace_written = {}
+
+        meta = store.read_meta()
+        if not meta:
+            return False
+        saved_paths = {entry.get("path") for entry in meta.get("sources", [])}
+        if saved_paths != {os.path.abspath(p) for p in self._workspace_source_paths}:
+            return False
+        if not store.is_fresh(meta):
+            self.log_text_edit.append("ℹ️ Análise salva desatualizada (ficheiros de origem alterados). A recarregar do Excel.")
+            return False
+
+        reply = QMessageBox.question(
+            self,
+            "Retomar Análise",
+            f"Existe uma análise salva desta empresa ({meta.get('timestamp', '')}).<br><br>"
+            "Deseja retomá-la (sem reler os ficheiros)?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
+        )
+        if reply != QMessageBox.StandardButton.Yes:
+            return False
+
+        data = store.load()
+        if data is None:
+            self.log_text_edit.append("⚠️ Não foi possível ler a análise salva. A recarregar do Excel.")
+            return False
+
+        self._workspace_sources = meta["sources"]
+        clean_df = data["clean"] if data["clean"] is not None else data["working"]
+        working_df = data["working"] if data["working"] is not None else clean_df
+        self.clean_invoices_df = clean_df
+        self.company_invoices_df = working_df.copy()
+        self.infraction_groups = data["groups"]
+        self._temp_multi_year_dams = data["dams"]
+
+        for step in self.workflow_state:
+            self.workflow_state[step] = meta.get("workflow_state", {}).get(step, 'pending')
+        self.workflow_state['review'] = 'pending'
+        # What was just read is what is on disk: the next save only rewrites the working copy
+        self._workspace_written = {key: obj for key, obj in self._workspace_frames().items() if key != 'working_df'}
+
+        if len(source_paths) > 1:
+            self.invoices_file_path_edit.setText(f"[Multi-Ano] {len(working_df)} registros")
+        self.log_text_edit.append(f"✅ Análise retomada do workspace: {len(working_df)} notas, {len(self.infraction_groups)} grupos.")
         self.update_button_states()
+        return True
+
+    def _workspace_frames(self):
+        return {
+            "clean_df": self.clean_invoices_df,
+            "working_df": self.company_invoices_df,
+            # Groups only while they match the working copy (rules not pending/stale)
+            "infraction_groups": self.infraction_groups if self.workflow_state.get('rules') == 'completed' else None,
+            "dams_df": getattr(self, '_temp_multi_year_dams', None),
+        }
+
+    def _save_workspace(self):
+        """
+        Snapshots the current analysis in a background worker (best effort: failures only log).
+        Only frames replaced since the last save are pickled again; the working copy is edited
+        in place (relabels, review), so it is always rewritten.
+        """
+        if self._workspace is None or self.clean_invoices_df is None:
+            return
+        frames = {}
+        for key, obj in self._workspace_frames().items():
+            if key != 'working_df' and key in self._workspace_written and self._workspace_written[key] is obj:
+                frames[key] = UNCHANGED
+                continue
+            self._workspace_written[key] = obj
+            # Copies: the worker must not see edits made while it is pickling
+            if isinstance(obj, pd.DataFrame):
+                obj = obj.copy()
+            elif isinstance(obj, dict):
+                obj = {name: df.copy() for name, df in obj.items()}
+            frames[key] = obj
+
+        job = (self._workspace, list(self._workspace_source_paths), dict(self.workflow_state), frames)
+        if self._workspace_queue and self._workspace_queue[-1][0] is job[0]:
+            # Not started yet: merge into it (a frame still UNCHANGED here keeps the queued snapshot)
+            queued = self._workspace_queue[-1][3]
+            frames = {key: queued[key] if obj is UNCHANGED else obj for key, obj in frames.items()}
+            self._workspace_queue[-1] = job[:3] + (frames,)
+        else:
+            self._workspace_queue.append(job)
+        if self._workspace_job is None:
+            self._start_next_workspace_save()
+
+    def _start_next_workspace_save(self):
+        if not self._workspace_queue:
+            return
+        store, source_paths, workflow_state, frames = self._workspace_queue.pop(0)
+        sources = self._workspace_sources if store is self._workspace else None
+        thread = QThread()
+        worker = WorkspaceSaveWorker(store, source_paths, workflow_state, frames, sources)
+        worker.moveToThread(thread)
+        self._workspace_job = (thread, worker)
+
+        thread.started.connect(worker.run)
+        worker.finished.connect(self.on_workspace_saved)
+        worker.error.connect(self.on_workspace_save_error)
+
+        worker.finished.connect(thread.quit)
+        worker.error.connect(thread.quit)
+        worker.finished.connect(worker.deleteLater)
+        worker.error.connect(worker.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        thread.finished.connect(self.on_workspace_save_thread_finished)
+
+        thread.start()
+
+    def on_workspace_saved(self, store, sources):
+        # Described sources are reused so the next save skips the sha1 of the Excel files
+        if store is self._workspace:
+            self._workspace_sources = sources
+
+    def on_workspace_save_error(self, message):
+        logging.warning(message)
+        # Unknown state on disk: the next save rewrites every frame
+        self._workspace_written = {}
+
+    def on_workspace_save_thread_finished(self):
+        self._workspace_job = None
+        self._start_next_workspace_save()
+
+    def closeEvent(self, event):
+        # The last step of the analysis must reach the disk before the app exits
+        if self._workspace_job is not None:
+            self._workspace_job[0].wait()
+        for store, source_paths, workflow_state, frames in self._workspace_queue:
+            try:
+                store.save(source_paths, workflow_state, **frames)
+            except Exception as e:
+                logging.warning(f"Falha ao gravar o workspace: {e}")
+        self._workspace_queue = []
+        super().closeEvent(event)
 
     def open_review_wizard(self):
         if self.company_invoices_df is None or self.company_invoices_df.empty: 
             QMessageBox.warning(self,"Aviso","Carregue notas."); return
         
-        # ✅ UPDATE: Check for multi-year temp path
-        found_dam_path = getattr(self, '_temp_multi_year_dams_path', None)
+        # ✅ UPDATE: Multi-year DAMs are consolidated in memory (DataFrame) 
+        found_dam_path = getattr(self, '_temp_multi_year_dams', None)
         
-        if not found_dam_path:
+        if found_dam_path is None:
             # (Original logic for single file)
             try:
                 invoices_path = self.invoices_file_path_edit.text()
@@ -1553,7 +1706,7 @@ class AuditApp(QMainWindow):
                 if QMessageBox.question(self, "Sem Autos", "Gerar sem autos?", QMessageBox.StandardButton.Yes|QMessageBox.StandardButton.No) == QMessageBox.StandardButton.No: return
 
             nm = ""
-            dp = rw.fine_page.dam_filepath_edit.text()
+            dp = rw.fine_page.dam_source()
             pp = rw.fine_page.pgdas_folder_path_edit.text()
             
             # Modal for version selection is fine here because the Wizard is technically "done"
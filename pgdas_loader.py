@@ -4,10 +4,10 @@ import re
 import glob
 import os
 import logging
-from PyPDF2 import PdfReader
 
 def _read_pdf_text(file_path: str) -> str:
     # ... (this function remains the same)
+    from PyPDF2 import PdfReader  # Lazy: só quando há PDFs do PGDAS para ler
     try:
         text = ""
         with open(file_path, "rb") as pdf_file:
@@ -71,6 +71,35 @@ def _extract_declaration_number(document_text: str) -> str | None:
     return None
 # ✅ --- END: New function ---
 
+# Per-file parse cache: (path, mtime_ns, size) -> (iss_value, pa_date, declaration_number)
+_PGDAS_FILE_CACHE = {}
+_PGDAS_FILE_CACHE_MAX = 1024
+
+
+def _parse_pgdas_file(pdf_path):
+    """
+    Reads one PGDASD PDF and returns (iss_value, pa_date, declaration_number), or None if it has no text.
+    Results are cached by path + mtime/size, so reopening a session does not re-read unchanged PDFs.
+    """
+    st = os.stat(pdf_path)
+    cache_key = (os.path.abspath(pdf_path), st.st_mtime_ns, st.st_size)
+    cached = _PGDAS_FILE_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    document_text = _read_pdf_text(pdf_path)
+    if not document_text:
+        # Not cached: an unreadable PDF may be a file still being copied
+        return None
+
+    result = (_extract_iss_value(document_text),
+              _extract_pa_date(document_text),
+              _extract_declaration_number(document_text))
+    if len(_PGDAS_FILE_CACHE) >= _PGDAS_FILE_CACHE_MAX:
+        _PGDAS_FILE_CACHE.pop(next(iter(_PGDAS_FILE_CACHE)))
+    _PGDAS_FILE_CACHE[cache_key] = result
+    return result
+
 def _load_and_process_pgdas(folder_path, status_callback=None):
     """
     Reads all PGDASD PDFs, extracts ISS, PA date, and Declaration Number.
@@ -93,13 +122,11 @@ def _load_and_process_pgdas(folder_path, status_callback=None):
     for pdf_path in pdf_files:
         filename = os.path.basename(pdf_path)
         try:
-            document_text = _read_pdf_text(pdf_path)
-            if not document_text:
+            parsed = _parse_pgdas_file(pdf_path)
+            if parsed is None:
                 continue
 
-            iss_value = _extract_iss_value(document_text)
-            pa_date = _extract_pa_date(document_text)
-            declaration_number = _extract_declaration_number(document_text) # ✅ Extract number
+            iss_value, pa_date, declaration_number = parsed
 
             if iss_value is not None and pa_date:
                 # Get current data or defaults
@@ -1,14 +1,93 @@
 # --- FILE: app/relabeling_dialog.py ---
 
+import numpy as np
 import pandas as pd
 from PySide6.QtWidgets import (QDialog, QVBoxLayout, QGroupBox, QHBoxLayout, 
-                               QLabel, QComboBox, QPushButton, QTableWidget, 
-                               QTableWidgetItem, QHeaderView, QCompleter,
+                               QLabel, QComboBox, QPushButton, QTableView, 
+                               QHeaderView, QCompleter,
                                QCheckBox, QTextEdit, QSplitter) # ✅ Import QTextEdit and QSplitter
-from PySide6.QtCore import Qt, QSize
+from PySide6.QtCore import Qt, QSize, QAbstractListModel, QModelIndex
 from PySide6.QtGui import QColor
 
 from .constants import Columns
+from .invoice_table_model import InvoiceTableModel
+from invoice_schema import set_values
+
+ACTIVITY_DESC_COL = 'activity_desc'
+ACTIVITY_ALERT_COL = 'activity_alert'
+
+
+class ActivityListModel(QAbstractListModel):
+    """
+    Every (code, description) of the activity table as one virtual list, for the
+    editable combo + contains-completer (no per-item Qt objects). Aliquots are
+    looked up by (code, description) in a dict instead of scanning the table.
+    """
+
+    def __init__(self, activity_data, parent=None):
+        super().__init__(parent)
+        self.labels = []
+        self.keys = []
+        self.aliquots = {}
+        for code, activities in sorted(activity_data.items()):
+            for description, aliquot, _ in activities:
+                self.labels.append(f"{code} - [{aliquot:.2f}%] {description}")
+                self.keys.append((code, description))
+                self.aliquots.setdefault((code, description), aliquot)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.labels)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.labels[index.row()]
+        if role == Qt.UserRole:
+            return self.keys[index.row()]
+        return None
+
+    def aliquot_for(self, code, description):
+        return self.aliquots.get((code, description), 0.0)
+
+
+def _truncate_description(val):
+    return str(val)[:200] + "..."
+
+
+class RelabelInvoiceModel(InvoiceTableModel):
+    """Shared invoice model with the relabeling columns; rows with any alert are highlighted."""
+    HEADER_MAP = {
+        Columns.ACTIVITY_CODE: "CÓDIGO ORIGINAL",
+        ACTIVITY_DESC_COL: ACTIVITY_DESC_COL.replace('_', ' ').title(),
+        Columns.CORRECT_RATE: "ALÍQUOTA CORRETA (%)",
+        ACTIVITY_ALERT_COL: "ALERTA DE ATIVIDADE",
+    }
+    COLUMN_FORMATTERS = {
+        Columns.SERVICE_DESCRIPTION: _truncate_description, # Truncate in table
+        Columns.CORRECT_RATE: lambda v: f"{v:.2f}",
+    }
+
+    def __init__(self, df, visible_columns, alert_mask, parent=None, row_positions=None):
+        super().__init__(df, visible_columns, parent=parent, row_positions=row_positions)
+        self.alert_mask = alert_mask  # shared with the window (updated in place)
+        self.alert_color = QColor(100, 92, 63) # Use the same color for both alerts
+        self._rate_col = self._visible_columns.index(Columns.CORRECT_RATE)
+        self._desc_col = self._visible_columns.index(Columns.SERVICE_DESCRIPTION)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        src_row = self._rows[index.row()]
+        if role == Qt.BackgroundRole:
+            # ✅ Color row if *either* alert is present
+            return self.alert_color if self.alert_mask[src_row] else None
+        if role == Qt.ToolTipRole and index.column() == self._desc_col:
+            return str(self._df[Columns.SERVICE_DESCRIPTION].iat[src_row])
+        if role == Qt.TextAlignmentRole and index.column() == self._rate_col:
+            return int(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        return super().data(index, role)
+
 
 class RelabelingWindow(QDialog):
     def __init__(self, df_invoices, activity_data, parent=None):
@@ -16,9 +95,30 @@ class RelabelingWindow(QDialog):
         self.setWindowTitle("Revisão de Atividade e Localização") # ✅ New Title
         self.setMinimumSize(1100, 650)
         self.setWindowState(Qt.WindowState.WindowMaximized)
+        # Edited copy (returned on save, discarded on cancel)
         self.df = df_invoices.copy()
         self.activity_data = activity_data
         self.tomador_indices = [] # ✅ For Request 3
+        self.activity_desc_col = ACTIVITY_DESC_COL
+        
+        # ✅ --- START: Add New Column ---
+        self.columns = [
+            Columns.INVOICE_NUMBER, Columns.SERVICE_DESCRIPTION, Columns.ACTIVITY_CODE,
+            self.activity_desc_col,
+            Columns.CORRECT_RATE, 
+            ACTIVITY_ALERT_COL, # <-- NEW
+            Columns.LOCATION_ALERT
+        ]
+        # ✅ --- END: Add New Column ---
+        defaults = {self.activity_desc_col: 'N/A', Columns.CORRECT_RATE: 0.0}
+        for col in self.columns:
+            if col not in self.df.columns:
+                self.df[col] = defaults.get(col, '')
+        
+        # Row state as arrays over self.df positions
+        self._is_tomador = np.zeros(len(self.df), dtype=bool)
+        self._has_alert = np.zeros(len(self.df), dtype=bool)
+        self._update_alerts(np.arange(len(self.df)))
         
         main_layout = QVBoxLayout(self)
         
@@ -32,12 +132,10 @@ class RelabelingWindow(QDialog):
         self.activity_combo.setInsertPolicy(QComboBox.InsertPolicy.NoInsert)
         self.activity_combo.lineEdit().setPlaceholderText("Digite para procurar...")
 
-        for code, activities in sorted(self.activity_data.items()):
-            for description, aliquot, _ in activities:
-                display_text = f"{code} - [{aliquot:.2f}%] {description}"
-                self.activity_combo.addItem(display_text, userData=(code, description))
+        self.activity_model = ActivityListModel(self.activity_data, self)
+        self.activity_combo.setModel(self.activity_model)
         
-        completer = QCompleter(self.activity_combo.model(), self)
+        completer = QCompleter(self.activity_model, self)
         completer.setFilterMode(Qt.MatchFlag.MatchContains)
         completer.setCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
         self.activity_combo.setCompleter(completer)
@@ -68,28 +166,18 @@ class RelabelingWindow(QDialog):
         # ✅ --- START: Splitter (Table + Full Text) ---
         splitter = QSplitter(Qt.Orientation.Vertical)
         
-        self.table = QTableWidget()
-        self.activity_desc_col = 'activity_desc'
-        
-        # ✅ --- START: Add New Column ---
-        self.columns = [
-            Columns.INVOICE_NUMBER, Columns.SERVICE_DESCRIPTION, "CÓDIGO ORIGINAL",
-            self.activity_desc_col.replace('_', ' ').title(),
-            "ALÍQUOTA CORRETA (%)", 
-            "ALERTA DE ATIVIDADE", # <-- NEW
-            Columns.LOCATION_ALERT
-        ]
-        # ✅ --- END: Add New Column ---
-        
-        self.table.setColumnCount(len(self.columns))
-        self.table.setHorizontalHeaderLabels(self.columns)
-        self.table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
-        self.table.setEditTriggers(QTableWidget.EditTriggers.NoEditTriggers)
+        self.table = QTableView()
+        self.table.verticalHeader().setVisible(False)
+        self.table.setSelectionBehavior(QTableView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QTableView.EditTriggers.NoEditTriggers)
         self.table.setAlternatingRowColors(True)
         self.table.setSortingEnabled(True)
         self.table.horizontalHeader().setStretchLastSection(True)
         
-        self.table.itemSelectionChanged.connect(self._show_details_for_selected_row)
+        self.model = RelabelInvoiceModel(self.df, self.columns, self._has_alert, parent=self.table,
+                                         row_positions=self._visible_positions())
+        self.table.setModel(self.model)
+        self.table.selectionModel().selectionChanged.connect(self._show_details_for_selected_row)
         
         splitter.addWidget(self.table)
         # ✅ --- END: Splitter (Table + Full Text) ---
@@ -115,7 +203,26 @@ class RelabelingWindow(QDialog):
         
         self.populate_table()
 
-    def _show_details_for_selected_row(self):
+    def _update_alerts(self, positions):
+        """Recomputes the 'has alert' flag (Local or Atividade) for the given rows."""
+        rows = self.df.iloc[positions]
+        has_alert = np.zeros(len(positions), dtype=bool)
+        for col in (Columns.LOCATION_ALERT, ACTIVITY_ALERT_COL):
+            has_alert |= (rows[col].fillna('').astype(str).str.strip() != '').to_numpy()
+        self._has_alert[positions] = has_alert
+
+    def _visible_positions(self):
+        # Exclude rows already marked as 'Local Tomador'
+        mask = ~self._is_tomador
+        if self.filter_checkbox.isChecked():
+            mask &= self._has_alert
+        return np.flatnonzero(mask)
+
+    def _selected_indices(self):
+        return [self.model.data(row_index, Qt.ItemDataRole.UserRole)
+                for row_index in self.table.selectionModel().selectedRows()]
+
+    def _show_details_for_selected_row(self, *args):
         """Populates the text box with the full description."""
         selected_rows = self.table.selectionModel().selectedRows()
         if not selected_rows:
@@ -123,119 +230,51 @@ class RelabelingWindow(QDialog):
             return
             
         # Get the first selected row
-        first_row_model_index = selected_rows[0]
-        original_index = self.table.item(first_row_model_index.row(), 0).data(Qt.ItemDataRole.UserRole)
+        original_index = self.model.data(selected_rows[0], Qt.ItemDataRole.UserRole)
         
         # Get full description from the original DataFrame
         full_description = self.df.loc[original_index].get(Columns.SERVICE_DESCRIPTION, "Descrição não encontrada.")
-        self.details_text_edit.setText(full_description)
+        self.details_text_edit.setText(str(full_description))
 
     def populate_table(self):
-        self.table.setSortingEnabled(False)
-        self.table.clearContents()
+        """Re-filters the rows shown (the model keeps its cached strings)."""
         self.details_text_edit.clear()
-        
-        # --- Filter Logic ---
-        df_to_show = self.df
-        
-        # Exclude rows already marked as 'Local Tomador'
-        df_to_show = df_to_show[~df_to_show.index.isin(self.tomador_indices)]
-        
-        if self.filter_checkbox.isChecked():
-            # ✅ --- START: Update Filter Logic ---
-            mask_loc_alert = df_to_show.get(Columns.LOCATION_ALERT, '').astype(str).str.strip() != ''
-            mask_act_alert = df_to_show.get('activity_alert', '').astype(str).str.strip() != ''
-            final_mask = mask_loc_alert | mask_act_alert
-            df_to_show = df_to_show[final_mask]
-            # ✅ --- END: Update Filter Logic ---
-
-        self.table.setRowCount(df_to_show.shape[0])
-        alert_color = QColor(100, 92, 63) # Use the same color for both alerts
-
-        for row_idx, (index, row_data) in enumerate(df_to_show.iterrows()):
-            location_alert_text = str(row_data.get(Columns.LOCATION_ALERT, ''))
-            has_location_alert = bool(location_alert_text)
-            
-            # ✅ --- START: Get New Alert Text ---
-            activity_alert_text = str(row_data.get('activity_alert', ''))
-            has_activity_alert = bool(activity_alert_text)
-            # ✅ --- END: Get New Alert Text ---
-            
-            original_code = str(row_data.get(Columns.ACTIVITY_CODE, ''))
-            correct_aliquot = row_data.get(Columns.CORRECT_RATE, 0.0)
-            activity_desc = str(row_data.get(self.activity_desc_col, 'N/A'))
-
-            items = {
-                0: str(row_data.get(Columns.INVOICE_NUMBER, '')),
-                1: str(row_data.get(Columns.SERVICE_DESCRIPTION, ''))[:200] + "...", # Truncate in table
-                2: original_code,
-                3: activity_desc,
-                4: f"{correct_aliquot:.2f}",
-                5: activity_alert_text, # ✅ New item
-                6: location_alert_text  # ✅ Index shifted
-            }
-            
-            for col_idx, text in items.items():
-                item = QTableWidgetItem(text)
-                item.setData(Qt.ItemDataRole.UserRole, index) # Store the ORIGINAL index
-                
-                if col_idx == 1: # Service Description
-                    item.setToolTip(str(row_data.get(Columns.SERVICE_DESCRIPTION, '')))
-                else:
-                    item.setToolTip(text)
-                
-                # ✅ Color row if *either* alert is present
-                if has_location_alert or has_activity_alert:
-                    item.setBackground(alert_color)
-
-                if col_idx == 4: # Aliquota
-                    item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
-                self.table.setItem(row_idx, col_idx, item)
-        
-        self.table.setSortingEnabled(True)
+        self.model.set_row_positions(self._visible_positions())
         self.table.resizeColumnsToContents()
         self.table.setColumnWidth(1, 400) # Description
         self.table.setColumnWidth(3, 300) # Activity Desc
         self.table.setColumnWidth(5, 300) # Activity Alert
 
     def relabel_selected(self):
-        selected_rows = self.table.selectionModel().selectedRows()
-        if not selected_rows: return
+        indices = self._selected_indices()
+        if not indices: return
         
         selected_data = self.activity_combo.currentData()
         if not selected_data:
             return
         
         new_code, selected_description = selected_data
-        
-        new_aliquot = 0.0
-        for description, aliquot, _ in self.activity_data.get(new_code, []):
-            if description == selected_description:
-                new_aliquot = aliquot
-                break
+        new_aliquot = self.activity_model.aliquot_for(new_code, selected_description)
 
-        for row_model_index in selected_rows:
-            original_index = self.table.item(row_model_index.row(), 0).data(Qt.ItemDataRole.UserRole)
-            self.df.loc[original_index, Columns.ACTIVITY_CODE] = new_code
-            self.df.loc[original_index, Columns.CORRECT_RATE] = new_aliquot
-            self.df.loc[original_index, self.activity_desc_col] = selected_description
-            # ✅ Clear the alert, since it has been manually reviewed
-            self.df.loc[original_index, 'activity_alert'] = ""
-        
-        self.populate_table() # Re-draws the table (which will re-filter)
+        set_values(self.df, indices, Columns.ACTIVITY_CODE, new_code)
+        self.df.loc[indices, Columns.CORRECT_RATE] = new_aliquot
+        set_values(self.df, indices, self.activity_desc_col, selected_description)
+        # ✅ Clear the alert, since it has been manually reviewed
+        self.df.loc[indices, ACTIVITY_ALERT_COL] = ""
+
+        # Only the edited rows are re-read (alerts, cached strings); then re-filter
+        self._update_alerts(self.df.index.get_indexer_for(indices))
+        self.model.refresh_rows(indices)
+        self.populate_table()
 
     def _mark_as_tomador(self):
         """Marks selected invoices as 'Local Tomador' and removes them from the view."""
-        selected_rows = self.table.selectionModel().selectedRows()
-        if not selected_rows: return
-        
-        indices_to_mark = []
-        for row_model_index in selected_rows:
-            original_index = self.table.item(row_model_index.row(), 0).data(Qt.ItemDataRole.UserRole)
-            indices_to_mark.append(original_index)
+        indices_to_mark = self._selected_indices()
+        if not indices_to_mark: return
             
         self.tomador_indices.extend(indices_to_mark)
         self.tomador_indices = list(set(self.tomador_indices)) # Remove duplicates
+        self._is_tomador[self.df.index.get_indexer_for(indices_to_mark)] = True
         
         # Refresh the table, which will now exclude these indices
         self.populate_table() 
@@ -1,7 +1,7 @@
 # --- FILE: app/review_wizard.py ---
 
 import pandas as pd
-import json
+import numpy as np
 import os
 from datetime import datetime
 from PySide6.QtWidgets import (QDialog, QTabWidget, QDialogButtonBox, QVBoxLayout, 
@@ -14,7 +14,7 @@ from PySide6.QtWidgets import (QDialog, QTabWidget, QDialogButtonBox, QVBoxLayou
                                QMenu, QCompleter)
 from PySide6.QtCore import Qt, QLocale, QStringListModel # ✅ Import QStringListModel
 from PySide6.QtGui import QColor, QDoubleValidator, QAction
-from PySide6.QtCore import QThread,  QSize
+from PySide6.QtCore import QThread,  QSize, QTimer
 from PySide6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
                                QPushButton, QTableWidget, QTableWidgetItem, 
                                QHeaderView, QCheckBox, QMessageBox)
@@ -24,6 +24,7 @@ import tempfile # <--- ADD THIS IMPORT AT THE TOP
 # --- Local Application Imports ---
 from .widgets import NumericTableWidgetItem, DateTableWidgetItem, ColumnSelectionDialog, SORT_ROLE
 from .constants import Columns, SESSION_FILE_PREFIX
+from .session_store import SessionStore, SessionJournal, AUTOSAVE_INTERVAL_MS
 from document_parts import formatar_texto_multa
 from .infraction_correction_dialog import InfractionCorrectionDialog
 from .new_auto_dialog import NewAutoDialog
@@ -37,112 +38,70 @@ from .auto_text_dialog import AutoTextDialog
 import logging
 from statistics import mode # ✅ Import mode
 from document_parts import formatar_texto_multa, format_invoice_numbers
+from invoice_schema import as_text, set_values
+from .credit_ledger import CreditLedger, DAM, PGDAS, month_label
+from .excel_export import StreamingExcelWriter, PERCENT_FORMAT
 import hashlib
-import copy  # ✅ Required for deepcopy of list-based credits
-from .workers import ValidationExtractorWorker # <--- Import the new worker
+from .workers import ValidationExtractorWorker, PaymentSourcesWorker # <--- Import the new worker
 from app.excel_filter import FilterableHeaderView
+from .invoice_table_model import InvoiceTableModel, InvoiceFilterIndex
+from .auto_membership import (EMPTY_POSITIONS, positions_of, auto_positions, has_invoices,
+                              auto_frame, auto_labels, add_positions, union_positions)
 
-from PySide6.QtCore import QAbstractTableModel, Qt, QModelIndex
+from PySide6.QtCore import Qt
 from PySide6.QtGui import QColor, QBrush
 from PySide6.QtWidgets import QTableView
 
-class InvoiceTableModel(QAbstractTableModel):
-    def __init__(self, df, visible_columns, parent=None):
-        super().__init__(parent)
-        self._df = df
-        self._visible_columns = visible_columns
-        
-        # Pre-calculate column indices for speed
-        self._col_indices = [df.columns.get_loc(c) for c in visible_columns]
-        
-        # Colors
-        self.color_decadent = QColor(80, 80, 80)
-        self.color_rule = QColor(100, 92, 63)
-        self.color_ignored = QColor(220, 220, 220)
-        self.color_text_ignored = QColor(100, 100, 100)
+class AssignedInvoiceTracker:
+    """
+    Per-row counter of how many autos hold each invoice of the wizard frame.
+    Moves update it incrementally (add/remove); any other change to the autos
+    is detected through a cheap signature and triggers a rebuild.
+    """
 
-    def rowCount(self, parent=QModelIndex()):
-        return len(self._df)
+    def __init__(self, df):
+        self.df = df
+        self._counts = np.zeros(len(df), dtype=np.int32)
+        self._signature = None
 
-    def columnCount(self, parent=QModelIndex()):
-        return len(self._visible_columns)
+    def is_compatible(self, df):
+        return self.df is df and len(self._counts) == len(df)
 
-    def data(self, index, role=Qt.DisplayRole):
-        if not index.isValid():
-            return None
+    @staticmethod
+    def _signature_of(autos):
+        # Position arrays are never modified in place, so the array objects identify the
+        # contents. They are kept (not their id()) so a freed address can't be reused
+        return [(auto_id, auto_positions(a)) for auto_id, a in autos.items()]
 
-        row_idx = index.row()
-        col_name = self._visible_columns[index.column()]
+    @staticmethod
+    def _same_signature(new, old):
+        return (old is not None and len(new) == len(old)
+                and all(new_id == old_id and new_pos is old_pos
+                        for (new_id, new_pos), (old_id, old_pos) in zip(new, old)))
 
-        # 1. Display Data (Text)
-        if role == Qt.DisplayRole or role == Qt.ToolTipRole:
-            val = self._df.iloc[row_idx][col_name]
+    def add(self, positions):
+        np.add.at(self._counts, positions, 1)
 
-            # 1. Handle Lists/Arrays (The cause of your crash)
-            try:
-                # If val is an array, this line raises ValueError
-                if pd.isna(val):
-                    return ""
-            except ValueError:
-                # If we catch the error, it means 'val' is an array/list.
-                # Arrays are rarely "NA", so we treat it as valid data.
-                pass
-            
-            if col_name == Columns.VALUE:
-                return f"{val:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-            elif col_name in [Columns.RATE, Columns.CORRECT_RATE]:
-                return f"{val:,.2f}"
-            elif col_name == Columns.ISSUE_DATE:
-                return val.strftime('%d/%m/%Y') if hasattr(val, 'strftime') else str(val)
-            elif col_name == Columns.BROKEN_RULE_DETAILS:
-                 return "; ".join(map(str, val)) if isinstance(val, list) else str(val)
-            return str(val)
-
-        # 2. Background Color (Status Logic)
-        elif role == Qt.BackgroundRole:
-            # We access the full row safely to check status columns
-            # Note: We use the underlying dataframe index to get specific status columns
-            # Using .iloc is faster for sequential access in views
-            
-            # Optimization: Check status columns only if they exist
-            status_legal = self._df.iloc[row_idx].get(Columns.STATUS_LEGAL)
-            if status_legal in ['Decadente', 'Prescrito']:
-                return self.color_decadent
-
-            # Check for ignored status (Manual)
-            status_manual = self._df.iloc[row_idx].get('status_manual')
-            if status_manual == 'Ignored':
-                return self.color_ignored
-
-            # Check for Broken Rules
-            if col_name == Columns.BROKEN_RULE_DETAILS:
-                val = self._df.iloc[row_idx][col_name]
-                if val: # If list is not empty
-                    return self.color_rule
-
-        # 3. Foreground Color (Text Color)
-        elif role == Qt.ForegroundRole:
-             if self._df.iloc[row_idx].get('status_manual') == 'Ignored':
-                 return self.color_text_ignored
-
-        # 4. UserRole: Return the Original DataFrame Index (Vital for selection logic)
-        elif role == Qt.UserRole:
-            return self._df.index[row_idx]
+    def remove(self, positions):
+        np.subtract.at(self._counts, positions, 1)
+        np.maximum(self._counts, 0, out=self._counts)
 
-        return None
+    def commit(self, autos):
+        """Accepts the current autos as in sync after incremental add/remove calls."""
+        self._signature = self._signature_of(autos)
 
-    def headerData(self, section, orientation, role=Qt.DisplayRole):
-        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
-            col_name = self._visible_columns[section]
-            # Simple map for nicer headers
-            header_map = {
-                Columns.INVOICE_NUMBER: "Nº Nota", Columns.ISSUE_DATE: "Data Emissão",
-                Columns.VALUE: "Valor (R$)", Columns.RATE: "Alíq. Decl.",
-                Columns.CORRECT_RATE: "Alíq. Corr.", Columns.SERVICE_DESCRIPTION: "Discriminação",
-                Columns.STATUS_LEGAL: "Status Legal", Columns.BROKEN_RULE_DETAILS: "Infrações"
-            }
-            return header_map.get(col_name, col_name)
-        return None
+    def sync(self, autos):
+        signature = self._signature_of(autos)
+        if self._same_signature(signature, self._signature):
+            return
+        self._counts[:] = 0
+        for auto_data in autos.values():
+            self.add(auto_positions(auto_data))
+        self._signature = signature
+
+    @property
+    def assigned_mask(self):
+        return self._counts > 0
 
 def normalize_dam_dataframe(df):
     """
@@ -234,6 +193,69 @@ def format_summary_label(df, value_col=Columns.VALUE, iss_value=None, iss_label=
         
     return label
 
+def compute_auto_iss_original(assigned_df, auto_data):
+    """
+    ISS calculated for an auto's invoices (same rules as the Preview page).
+    Target rate per invoice, by priority:
+      1. monthly override (Page 3)  2. IDD auto -> declared rate
+      3. invoice 'correct_rate' > 0  4. declared rate > 0  5. auto default
+    Paid invoices ('Sim'/'IDD') only owe the positive rate difference.
+    """
+    if assigned_df is None or assigned_df.empty:
+        return 0.0
+
+    n = len(assigned_df)
+    def num_col(name, default=0.0):
+        if name in assigned_df.columns:
+            return pd.to_numeric(assigned_df[name], errors='coerce').to_numpy(dtype=float)
+        return np.full(n, default)
+
+    monthly_overrides = auto_data.get('monthly_overrides', {})
+    motive = auto_data.get('motive', '')
+    first_row = assigned_df.iloc[0]
+
+    default_aliquota_pct = 5.0 # default
+    if auto_data.get('user_defined_aliquota') is not None:
+        default_aliquota_pct = auto_data['user_defined_aliquota']
+    elif 'correct_rate' in assigned_df.columns and pd.notna(first_row.get('correct_rate')):
+        default_aliquota_pct = first_row.get('correct_rate')
+    elif (motive.startswith('IDD (Não Pago)') or motive.startswith('Alíquota incorreta')) and pd.notna(first_row.get(Columns.RATE)):
+        default_aliquota_pct = first_row.get(Columns.RATE)
+
+    is_idd_auto = auto_data.get('rule_name') == 'idd_nao_pago'
+
+    dates = assigned_df['DATA EMISSÃO']
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates, errors='coerce')
+    periods = dates.dt.strftime('%m/%Y')
+
+    declared = num_col(Columns.RATE)
+    correct = num_col('correct_rate', np.nan)
+    has_override = periods.isin(list(monthly_overrides.keys())).to_numpy()
+    override_rate = periods.map(monthly_overrides).to_numpy(dtype=float)
+
+    target_rate = np.select(
+        [has_override,
+         np.full(n, is_idd_auto),
+         ~np.isnan(correct) & (correct > 0),
+         declared > 0],
+        [override_rate, declared, correct, declared],
+        default=float(default_aliquota_pct)
+    )
+
+    deducao = np.nan_to_num(num_col('VALOR DEDUÇÃO'), nan=0.0)
+    valor = num_col('VALOR') - deducao
+    if 'PAGAMENTO' in assigned_df.columns:
+        payment_status = assigned_df['PAGAMENTO'].astype(str).str.strip().str.lower()
+    else:
+        payment_status = pd.Series('não', index=assigned_df.index)
+    is_paid = payment_status.isin(['sim', 'idd']).to_numpy()
+
+    aliquota_dec = target_rate / 100.0
+    difference_iss = (aliquota_dec - declared / 100.0) * valor
+    iss_original = np.where(is_paid, np.where(difference_iss > 0, difference_iss, 0.0), aliquota_dec * valor)
+    return float(np.nansum(iss_original))
+
 class ReviewWizard(QDialog):
     def __init__(self, all_invoices_df, infraction_groups, company_cnpj, 
                  company_razao_social, company_imu, company_epaf_initial, 
@@ -262,7 +284,9 @@ class ReviewWizard(QDialog):
         self.company_epaf_initial = company_epaf_initial
 
         self.dam_payments_map = {}; self.pgdas_payments_map = {}
-        self.preview_context = {}; self.available_credits_map = {} 
+        self._payment_jobs = []  # (QThread, PaymentSourcesWorker) still running
+        self._payment_versions = {'dam': 0, 'pgdas': 0}  # bumped on every new DAM/PGDAS source
+        self.preview_context = {}; self.credit_ledger = CreditLedger() 
         self.fine_text_final = ""; self.fine_value_final = ""
 
         # ✅ NEW: Dirty Flag (Controls when to re-run heavy calculations)
@@ -288,7 +312,10 @@ class ReviewWizard(QDialog):
         }
         
         sanitized_cnpj = "".join(filter(str.isdigit, self.company_cnpj))
-        self.session_filepath = f"{SESSION_FILE_PREFIX}{sanitized_cnpj}.json"
+        self.session_store = SessionStore(f"{SESSION_FILE_PREFIX}{sanitized_cnpj}")
+        self.session_filepath = self.session_store.snapshot_path
+        self.session_journal = SessionJournal()
+        self._session_ids_cache = {}  # auto_id -> (positions, invoice_ids)
 
         # 2. Create Pages
         self.assignment_page = AssignmentPage(self)
@@ -348,9 +375,19 @@ class ReviewWizard(QDialog):
         self.assignment_page.epaf_numero_edit.textChanged.connect(self.update_subtitle) 
         self.update_tab_states()
 
-        if dam_file_path and os.path.exists(dam_file_path):
+        if isinstance(dam_file_path, pd.DataFrame):
+            self.fine_page.load_dam_frame_programmatically(dam_file_path)
+        elif dam_file_path and os.path.exists(dam_file_path):
             self.fine_page.load_dam_file_programmatically(dam_file_path)
 
+        # Autosave (diário): só começa já se não houver sessão salva por restaurar
+        if not self.session_store.exists():
+            self.session_journal.reset(self._session_state())
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.setInterval(AUTOSAVE_INTERVAL_MS)
+        self.autosave_timer.timeout.connect(self.autosave_session)
+        self.autosave_timer.start()
+
     def force_load_session(self):
         """Called by button click to explicitly restore."""
         self.load_session(silent=False)
@@ -418,13 +455,13 @@ class ReviewWizard(QDialog):
         if match:
             return int(match.group(1))
             
-        # 2. Try to infer from existing invoices in the DataFrame
-        df = auto_data.get('df')
-        if isinstance(df, pd.DataFrame) and not df.empty:
-            if 'DATA EMISSÃO' in df.columns:
+        # 2. Try to infer from the auto's first invoice
+        positions = auto_positions(auto_data)
+        if len(positions):
+            if 'DATA EMISSÃO' in self.all_invoices_df.columns:
                 try:
                     # Return the year of the first invoice found
-                    first_date = pd.to_datetime(df['DATA EMISSÃO'].iloc[0], errors='coerce')
+                    first_date = pd.to_datetime(self.all_invoices_df['DATA EMISSÃO'].iloc[positions[0]], errors='coerce')
                     if pd.notna(first_date):
                         return first_date.year
                 except:
@@ -461,7 +498,7 @@ class ReviewWizard(QDialog):
 
             self.autos[auto_id] = {
                 'motive': group_name, 
-                'df': group_df.copy(),
+                'positions': positions_of(self.all_invoices_df, group_df.index),
                 'auto_text': '',
                 'rule_name': rule_name 
             }
@@ -475,14 +512,25 @@ class ReviewWizard(QDialog):
         except Exception as e:
             QMessageBox.critical(self, "Erro ao Salvar", f"Não foi possível salvar a sessão:\n{e}")
 
-    def save_session(self):
+    def _auto_invoice_ids(self, auto_id, positions):
+        """Invoice numbers of an auto, recomputed only when its positions array is replaced."""
+        cached = self._session_ids_cache.get(auto_id)
+        if cached is not None and cached[0] is positions:
+            return cached[1]
+        invoice_ids = []
+        if len(positions) and Columns.INVOICE_NUMBER in self.all_invoices_df.columns:
+            invoice_ids = self.all_invoices_df[Columns.INVOICE_NUMBER].iloc[positions].astype(str).str.strip().tolist()
+        self._session_ids_cache[auto_id] = (positions, invoice_ids)
+        return invoice_ids
+
+    def _session_state(self):
         fines_list = self.fine_page.get_fines_data()
         
         session_data = {
             "timestamp": datetime.now().isoformat(),
             "autos": {},
             "multas": fines_list,
-            "dam_filepath": self.fine_page.dam_filepath_edit.text(),
+            "dam_filepath": self.fine_page.dam_session_path(),
             "pgdas_folder_path": self.fine_page.pgdas_folder_path_edit.text(),
             "texto_multa": self.fine_page.fine_text_edit.toPlainText(),
             # ✅ CHANGED: Read from AssignmentPage
@@ -490,37 +538,54 @@ class ReviewWizard(QDialog):
         }
         
         for auto_id, data in self.autos.items():
-            df = data.get('df')
-            invoice_ids = [] 
-            if isinstance(df, pd.DataFrame) and not df.empty:
-                if Columns.INVOICE_NUMBER in df.columns:
-                    invoice_ids = df[Columns.INVOICE_NUMBER].astype(str).str.strip().tolist()
-            
             session_data["autos"][auto_id] = {
                 "motive": data["motive"],
                 "rule_name": data.get("rule_name", ""),
-                "invoice_ids": invoice_ids,
+                "invoice_ids": self._auto_invoice_ids(auto_id, auto_positions(data)),
                 "user_defined_aliquota": data.get("user_defined_aliquota"),
                 "user_defined_credito": data.get("user_defined_credito"),
                 "auto_text": data.get("auto_text", ""),
                 "monthly_overrides": data.get("monthly_overrides", {})
             }
-            
+
+        for stale_id in self._session_ids_cache.keys() - self.autos.keys():
+            del self._session_ids_cache[stale_id]
+        return session_data
+
+    def save_session(self):
+        """Full snapshot (compact .npz); also folds any pending journal into it."""
+        session_data = self._session_state()
         try:
-            with open(self.session_filepath, 'w', encoding='utf-8') as f:
-                json.dump(session_data, f, indent=4)
+            self.session_store.write_snapshot(session_data)
+            self.session_journal.reset(session_data)
         except Exception as e:
             print(f"Error saving session: {e}")
             raise e
 
+    def autosave_session(self):
+        """Appends only the edits since the last save/autosave to the session journal."""
+        if not self.session_journal.active:
+            return
+        try:
+            session_data = self._session_state()
+            entries = self.session_journal.diff(session_data)
+            if not entries:
+                return
+            if self.session_store.has_base():
+                self.session_store.append(entries)
+            else:
+                # Nothing on disk to replay the journal on: first autosave writes the snapshot
+                self.session_store.write_snapshot(session_data)
+        except Exception as e:
+            logging.warning(f"Autosave da sessão falhou: {e}")
+
     def load_session(self, silent=False):
-        if not os.path.exists(self.session_filepath):
+        if not self.session_store.exists():
             if not silent: QMessageBox.information(self, "Sem Sessão", "Não foi encontrado nenhum ficheiro de sessão salvo para este CNPJ.")
             return False
 
         try:
-            with open(self.session_filepath, 'r', encoding='utf-8') as f:
-                session_data = json.load(f)
+            session_data = self.session_store.read()
 
             if not silent:
                 ts = session_data.get("timestamp", "Data desconhecida")
@@ -534,29 +599,24 @@ class ReviewWizard(QDialog):
 
             self.autos = {}
             max_id_num = 0
-            invoice_map = {str(row[Columns.INVOICE_NUMBER]).strip(): idx 
-                           for idx, row in self.all_invoices_df.iterrows()}
+            number_index, row_positions = self._invoice_number_lookup()
             restored_count = 0
             
             for auto_id, data in session_data.get("autos", {}).items():
-                saved_ids = data.get("invoice_ids", []) 
-                valid_indices = []
-                for inv_num in saved_ids:
-                    if inv_num in invoice_map:
-                        valid_indices.append(invoice_map[inv_num])
-                
-                auto_df = self.all_invoices_df.loc[valid_indices] if valid_indices else pd.DataFrame()
+                saved_ids = [str(n).strip() for n in data.get("invoice_ids", [])]
+                found = number_index.get_indexer(saved_ids) if saved_ids else np.empty(0, dtype=np.intp)
+                valid_positions = row_positions[found[found >= 0]].astype(np.intp, copy=False)
                 
                 self.autos[auto_id] = {
                     "motive": data["motive"],
                     "rule_name": data.get("rule_name"),
-                    "df": auto_df,
+                    "positions": valid_positions,
                     "user_defined_aliquota": data.get("user_defined_aliquota"),
                     "user_defined_credito": data.get("user_defined_credito"),
                     "auto_text": data.get("auto_text", ""),
                     "monthly_overrides": data.get("monthly_overrides", {})
                 }
-                restored_count += len(valid_indices)
+                restored_count += len(valid_positions)
                 try:
                     num = int(auto_id.replace("AUTO-", ""))
                     if num >= max_id_num: max_id_num = num
@@ -578,18 +638,25 @@ class ReviewWizard(QDialog):
             
             dam_path = session_data.get("dam_filepath", "")
             pgdas_path = session_data.get("pgdas_folder_path", "")
-            self.fine_page.dam_filepath_edit.setText(dam_path)
+            if dam_path == self.session_store.dams_path and os.path.exists(dam_path):
+                # Multi-Ano DAMs saved with the session go straight back into memory
+                self.fine_page.load_dam_frame_programmatically(self.session_store.read_dam_frame(), session_path=dam_path)
+                dam_path = ""
+            elif dam_path and os.path.exists(dam_path):
+                self.fine_page.dam_frame = None  # a saved DAM file replaces the in-memory DAMs
+            elif dam_path and self.fine_page.dam_frame is None:
+                # Older sessions only saved the '[Multi-Ano]' label (or the file is gone): nothing to re-read
+                msg = (f"Os DAMs desta sessão não foram encontrados:\n{dam_path}\n\n"
+                       "Carregue novamente os DAMs (Multi-Ano) para incluir os créditos no cálculo.")
+                logging.warning(msg)
+                if not silent: QMessageBox.warning(self, "DAMs em Falta", msg)
+                dam_path = ""
+            if self.fine_page.dam_frame is None:
+                self.fine_page.dam_filepath_edit.setText(dam_path)
             self.fine_page.pgdas_folder_path_edit.setText(pgdas_path)
             
-            if dam_path and os.path.exists(dam_path):
-                try: self.dam_payments_map = _load_and_process_dams(dam_path)
-                except: pass
-            if pgdas_path and os.path.exists(pgdas_path):
-                try:
-                    class DummyEmitter:
-                        def emit(self, m): pass
-                    self.pgdas_payments_map = _load_and_process_pgdas(pgdas_path, DummyEmitter())
-                except: pass
+            # DAM/PGDAS are re-read in the background; the preview is recalculated when they arrive
+            self._reload_payment_sources(dam_path, pgdas_path)
 
             self.assignment_page.refresh_autos_list()
             self.assignment_page.refresh_all_tables()
@@ -597,6 +664,8 @@ class ReviewWizard(QDialog):
             
             # ✅ Force recalculation next time Preview is opened so it uses the loaded values
             self.mark_dirty() 
+            # The restored state is what is on disk: autosave journals from here on
+            self.session_journal.reset(self._session_state())
 
             if not silent:
                 QMessageBox.information(self, "Sucesso", f"Sessão restaurada. {restored_count} notas re-associadas aos autos.")
@@ -606,6 +675,73 @@ class ReviewWizard(QDialog):
             if not silent: QMessageBox.warning(self, "Erro", f"Falha ao carregar sessão: {e}")
             return False
 
+    def _invoice_number_lookup(self):
+        """
+        Returns (number_index, row_positions): a unique pd.Index of normalized invoice
+        numbers and, for each entry, its row position in all_invoices_df.
+        Duplicated numbers resolve to the last row (same as the old dict-based map).
+        """
+        df = self.all_invoices_df
+        cache_key = (id(df), len(df))
+        if getattr(self, '_invoice_lookup_cache', (None,))[0] != cache_key:
+            numbers = df[Columns.INVOICE_NUMBER].astype(str).str.strip()
+            keep = ~numbers.duplicated(keep='last').to_numpy()
+            self._invoice_lookup_cache = (cache_key, pd.Index(numbers.to_numpy()[keep]), np.flatnonzero(keep))
+        return self._invoice_lookup_cache[1], self._invoice_lookup_cache[2]
+
+    def set_dam_payments(self, dam_map):
+        """New DAM credits; restore jobs started before this no longer overwrite them."""
+        self.dam_payments_map = dam_map
+        self._payment_versions['dam'] += 1
+
+    def set_pgdas_payments(self, pgdas_map):
+        self.pgdas_payments_map = pgdas_map
+        self._payment_versions['pgdas'] += 1
+
+    def _reload_payment_sources(self, dam_path, pgdas_path):
+        if not (dam_path and os.path.exists(dam_path)) and not (pgdas_path and os.path.exists(pgdas_path)):
+            return
+
+        # A newer restore supersedes the running ones
+        self._payment_versions['dam'] += 1
+        self._payment_versions['pgdas'] += 1
+        tag = (self._payment_versions['dam'], self._payment_versions['pgdas'])
+
+        thread = QThread()
+        worker = PaymentSourcesWorker(dam_path, pgdas_path, tag)
+        worker.moveToThread(thread)
+        # Keep references alive until the thread ends (a second restore may start before the first finishes)
+        job = (thread, worker)
+        self._payment_jobs.append(job)
+
+        thread.started.connect(worker.run)
+        worker.finished.connect(self.on_payment_sources_loaded)
+        worker.error.connect(lambda msg: print(msg))
+
+        worker.finished.connect(thread.quit)
+        worker.error.connect(thread.quit)
+        worker.finished.connect(worker.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        thread.finished.connect(lambda: self._payment_jobs.remove(job) if job in self._payment_jobs else None)
+
+        thread.start()
+
+    def on_payment_sources_loaded(self, dam_map, pgdas_map, tag):
+        # Sources loaded (or another restore started) after this job began take precedence
+        dam_version, pgdas_version = tag
+        if dam_version != self._payment_versions['dam']: dam_map = {}
+        if pgdas_version != self._payment_versions['pgdas']: pgdas_map = {}
+        if not dam_map and not pgdas_map:
+            return
+        if dam_map: self.dam_payments_map = dam_map
+        if pgdas_map: self.pgdas_payments_map = pgdas_map
+        print(f"✅ Sessão: {len(dam_map)} competências DAM e {len(pgdas_map)} meses PGDAS recarregados.")
+
+        # Credits changed: recalculate now if the preview is on screen, otherwise on next visit
+        self.mark_dirty()
+        if self.tab_widget.currentWidget() == self.preview_page:
+            self.preview_page.initializePage()
+
     def accept(self):
         if hasattr(self, 'preview_page'):
             self.preview_page._read_tables_into_context()
@@ -629,40 +765,45 @@ class ReviewWizard(QDialog):
         # ✅ CHANGED: Read from AssignmentPage
         self.preview_context['epaf_numero'] = self.assignment_page.epaf_numero_edit.text()
         
+        self.autosave_timer.stop()
         self.save_session()
         super().accept()
 
+    def reject(self):
+        # Compact on close: pending edits go to the journal, then the journal into the snapshot
+        self.autosave_timer.stop()
+        self.autosave_session()
+        try:
+            self.session_store.compact()
+        except Exception as e:
+            logging.warning(f"Não foi possível compactar a sessão: {e}")
+        super().reject()
+
     def get_final_data_for_confirmation(self):
         """
         Gets the data format needed for calculations and final context building,
         including flags for split autos.
         """
         final_data = {}
+        df = self.all_invoices_df
         for auto_id, auto_data in self.autos.items():
-            df = auto_data.get('df') 
+            positions = auto_positions(auto_data)
 
             motive_text = auto_data['motive']
             base_rule = auto_data.get('rule_name', self.motive_to_rule_map.get(motive_text.split(' (')[0], motive_text))
 
-            if isinstance(df, pd.DataFrame):
-                invoice_list = df.index.tolist()
-                df_is_empty = df.empty
-                first_row_data = df.iloc[0] if not df_is_empty else {}
-            else:
-                invoice_list = []
-                df_is_empty = True
-                first_row_data = {}
-
             correct_aliquota_val = auto_data.get('user_defined_aliquota')
             
-            if correct_aliquota_val is None and not df_is_empty:
-                if 'correct_rate' in df.columns and pd.notna(first_row_data.get('correct_rate')):
-                    correct_aliquota_val = first_row_data.get('correct_rate')
+            if correct_aliquota_val is None and len(positions) and 'correct_rate' in df.columns:
+                first_rate = df['correct_rate'].iloc[positions[0]]
+                if pd.notna(first_rate):
+                    correct_aliquota_val = first_rate
 
             correct_aliquota_str = f"{correct_aliquota_val:.2f}" if correct_aliquota_val is not None else "5.00"
 
             data_entry = {
-                'invoices': invoice_list, 
+                'invoices': auto_labels(df, auto_data).tolist(), 
+                'positions': positions,
                 'auto_id': auto_id,
                 'rule_name': base_rule,
                 'motive_text': motive_text,
@@ -689,12 +830,10 @@ class ReviewWizard(QDialog):
         pgdas_map = self.pgdas_payments_map 
 
         all_valid_dates = []
-        for auto_info in final_data.values():
-            invoice_indices = auto_info.get('invoices', [])
-            if not invoice_indices: continue
-            df_inv = company_invoices_df.loc[invoice_indices].copy()
-            df_inv['DATA EMISSÃO'] = pd.to_datetime(df_inv['DATA EMISSÃO'], errors='coerce')
-            all_valid_dates.extend(df_inv['DATA EMISSÃO'].dropna().tolist())
+        assigned_positions = union_positions(self.autos)
+        if len(assigned_positions):
+            issue_dates = pd.to_datetime(company_invoices_df['DATA EMISSÃO'].iloc[assigned_positions], errors='coerce')
+            all_valid_dates.extend(issue_dates.dropna().tolist())
         for date_str in pgdas_map.keys():
             try: all_valid_dates.append(pd.to_datetime(date_str, format='%m/%Y'))
             except (ValueError, TypeError): pass
@@ -712,17 +851,15 @@ class ReviewWizard(QDialog):
             for month in range(1, 13):
                all_periods_list.append(pd.Period(year=current_year, month=month, freq='M'))
 
-        self.available_credits_map = {
-            'DAM': copy.deepcopy(dam_map),
-            'PGDAS': {k: v[0] for k, v in pgdas_map.items()}
-        }
+        # Créditos DAM/PGDAS: alocados num único lote depois de calcular todos os autos
+        self.credit_ledger = CreditLedger(dam_map, pgdas_map)
+        pending_credits = []  # (auto, mês, competência, ISS líquido) pela ordem de alocação
 
         autos_context = []
         for auto_key, auto_info in final_data.items():
             target_year = self._get_auto_year(auto_key)
             monthly_override_map = auto_info.get('monthly_overrides', {})
-            invoice_indices = auto_info.get('invoices', [])
-            df_invoices = company_invoices_df.loc[invoice_indices].copy()
+            df_invoices = company_invoices_df.iloc[auto_info['positions']].copy()
             df_invoices['DATA EMISSÃO'] = pd.to_datetime(df_invoices['DATA EMISSÃO'], errors='coerce')
             df_invoices.dropna(subset=['DATA EMISSÃO'], inplace=True)
             df_invoices['_month_str'] = df_invoices['DATA EMISSÃO'].dt.strftime('%m/%Y')
@@ -753,7 +890,6 @@ class ReviewWizard(QDialog):
                 df_invoices['_target_rate_group'] = default_aliquota_pct
 
             dados_anuais = []
-            dam_pago_auto_total = 0; das_pago_auto_total = 0; total_iss_final_calc = 0
             total_base_auto = 0.0; total_iss_bruto_auto = 0.0
             total_iss_pago_auto = 0.0; total_iss_liquido_auto = 0.0
 
@@ -763,7 +899,6 @@ class ReviewWizard(QDialog):
                         continue 
 
                 period_str_mm_yyyy = period_key.strftime('%m/%Y')
-                period_str_m_yyyy = f"{period_key.month}/{period_key.year}"
 
                 month_mask = (df_invoices['DATA EMISSÃO'].dt.to_period('M') == period_key)
                 df_month = df_invoices[month_mask]
@@ -782,12 +917,6 @@ class ReviewWizard(QDialog):
                         group = df_month[df_month['_target_rate_group'] == rate_val]
                         current_target_rate = rate_val
 
-                    dams_list = self.available_credits_map['DAM'].get(period_str_m_yyyy, [])
-                    available_dam_total = sum(d['val'] for d in dams_list)
-                    
-                    available_pgdas = self.available_credits_map['PGDAS'].get(period_str_mm_yyyy, 0.0)
-                    pgdas_decl_num = pgdas_map.get(period_str_mm_yyyy, (0.0, "-"))[1]
-
                     base_calculo = 0.0; iss_correto_bruto = 0.0
                     iss_declarado_pago = 0.0; iss_liquido_calc = 0.0
                     monthly_invoice_data = []
@@ -830,32 +959,12 @@ class ReviewWizard(QDialog):
                     else:
                         aliquota_declarada_display = "-"; aliquota_display = "-"
 
-                    dam_utilizado = min(iss_liquido_calc, available_dam_total)
-                    used_dam_codes = []
-                    remainder_to_deduct = dam_utilizado
-                    for dam_obj in dams_list:
-                        if remainder_to_deduct <= 0.0001: break
-                        if dam_obj['val'] > 0:
-                            deduct = min(dam_obj['val'], remainder_to_deduct)
-                            dam_obj['val'] -= deduct 
-                            remainder_to_deduct -= deduct
-                            used_dam_codes.append(dam_obj['code'])
-                    
-                    dam_ident_str = ", ".join(sorted(set(used_dam_codes))) if used_dam_codes else "-"
-                    iss_restante = iss_liquido_calc - dam_utilizado
-                    pgdas_utilizado = min(iss_restante, available_pgdas)
-                    iss_apurado_op = max(0, iss_liquido_calc - dam_utilizado - pgdas_utilizado)
-
-                    self.available_credits_map['PGDAS'][period_str_mm_yyyy] = available_pgdas - pgdas_utilizado
-                    dam_pago_auto_total += dam_utilizado
-                    das_pago_auto_total += pgdas_utilizado
-                    total_iss_final_calc += iss_apurado_op
                     total_base_auto += base_calculo
                     total_iss_bruto_auto += iss_correto_bruto
                     total_iss_pago_auto += iss_declarado_pago
                     total_iss_liquido_auto += iss_liquido_calc
 
-                    dados_anuais.append({
+                    mes_data = {
                         'mes_ano': period_str_mm_yyyy,
                         'base_calculo': base_calculo,
                         'aliquota_display': aliquota_display,
@@ -867,11 +976,13 @@ class ReviewWizard(QDialog):
                         'iss_apurado_liquido': iss_liquido_calc,
                         'iss_apurado': iss_liquido_calc, 
                         'base_calculo_op': base_calculo,
-                        'iss_apurado_op': iss_apurado_op,
-                        'dam_iss_pago': dam_utilizado, 'dam_identificacao': dam_ident_str,
-                        'das_iss_pago': pgdas_utilizado, 'das_identificacao': pgdas_decl_num if pgdas_utilizado > 0 else "-",
+                        'iss_apurado_op': iss_liquido_calc,
+                        'dam_iss_pago': 0.0, 'dam_identificacao': "-",
+                        'das_iss_pago': 0.0, 'das_identificacao': "-",
                         '_monthly_invoices_data': monthly_invoice_data, 
-                    })
+                    }
+                    dados_anuais.append(mes_data)
+                    pending_credits.append((auto_key, mes_data, period_key, iss_liquido_calc))
 
             if total_base_auto > 0.001:
                 total_effective_aliquota_pct = (total_iss_liquido_auto / total_base_auto) * 100.0
@@ -892,8 +1003,8 @@ class ReviewWizard(QDialog):
                 'motivo': { 'tipo': auto_info.get('rule_name', 'desconhecido') },
                 'auto_text': auto_info.get('auto_text', ''),
                 'is_split_diff': auto_info.get('is_split_diff', False),
-                'tem_pagamento_das': das_pago_auto_total > 0,
-                'tem_pagamento_dam': dam_pago_auto_total > 0,
+                'tem_pagamento_das': False,
+                'tem_pagamento_dam': False,
                 'totais': {
                     'base_calculo': total_base_auto,
                     'iss_apurado_bruto': total_iss_bruto_auto,
@@ -901,9 +1012,9 @@ class ReviewWizard(QDialog):
                     'iss_apurado_liquido': total_iss_liquido_auto,
                     'iss_apurado': total_iss_liquido_auto,
                     'base_calculo_op': total_base_auto,
-                    'iss_apurado_op': total_iss_final_calc,
-                    'das_iss_pago': das_pago_auto_total,
-                    'dam_iss_pago': dam_pago_auto_total,
+                    'iss_apurado_op': 0.0,
+                    'das_iss_pago': 0.0,
+                    'dam_iss_pago': 0.0,
                     '_total_aliquota_display': total_aliquota_display 
                 },
                 'dados_anuais': dados_anuais,
@@ -913,17 +1024,36 @@ class ReviewWizard(QDialog):
             }
             autos_context.append(auto_data)
 
+        # --- Credit allocation (DAM first, PGDAS on what is left, in auto/period order) ---
+        if pending_credits:
+            owners = [p[0] for p in pending_credits]
+            periods = [p[2] for p in pending_credits]
+            iss_liquido = np.array([p[3] for p in pending_credits], dtype=np.float64)
+            dam_used, dam_idents = self.credit_ledger.allocate_many(DAM, periods, iss_liquido, owners)
+            das_used, das_idents = self.credit_ledger.allocate_many(PGDAS, periods, iss_liquido - dam_used, owners)
+            iss_op = np.maximum(0, iss_liquido - dam_used - das_used)
+            for i, (_, mes_data, _, _) in enumerate(pending_credits):
+                mes_data.update({
+                    'dam_iss_pago': float(dam_used[i]), 'dam_identificacao': dam_idents[i],
+                    'das_iss_pago': float(das_used[i]), 'das_identificacao': das_idents[i],
+                    'iss_apurado_op': float(iss_op[i]),
+                })
+        for auto_data in autos_context:
+            meses = auto_data['dados_anuais']
+            totais = auto_data['totais']
+            totais['dam_iss_pago'] = sum(m['dam_iss_pago'] for m in meses)
+            totais['das_iss_pago'] = sum(m['das_iss_pago'] for m in meses)
+            totais['iss_apurado_op'] = sum(m['iss_apurado_op'] for m in meses)
+            auto_data['tem_pagamento_dam'] = totais['dam_iss_pago'] > 0
+            auto_data['tem_pagamento_das'] = totais['das_iss_pago'] > 0
+
         # --- Build Summary ---
         summary_autos_list = []
         total_credito_autos = 0.0
         nfs_numbers_map = {}
         for auto_key, auto_info in final_data.items():
-            invoice_indices = auto_info.get('invoices', [])
-            if invoice_indices:
-                invoice_numbers = company_invoices_df.loc[invoice_indices, Columns.INVOICE_NUMBER].astype(str).tolist()
-                nfs_numbers_map[auto_key] = invoice_numbers
-            else:
-                nfs_numbers_map[auto_key] = []
+            positions = auto_info['positions']
+            nfs_numbers_map[auto_key] = company_invoices_df[Columns.INVOICE_NUMBER].iloc[positions].astype(str).tolist()
 
         for auto in autos_context:
             auto_total_credito = auto.get('totais', {}).get('iss_apurado_op', 0.0)
@@ -970,10 +1100,7 @@ class ReviewWizard(QDialog):
         
         self.preview_context = {
             'autos': autos_context,
-            'available_credits_startup': {
-                'DAM': copy.deepcopy(dam_map), 
-                'PGDAS': {k: v[0] for k, v in pgdas_map.items()}
-            },
+            'credit_ledger': self.credit_ledger,
             'summary': summary_data  
         }
         return self.preview_context
@@ -983,7 +1110,13 @@ class AssignmentPage(QWidget):
     def __init__(self, wizard):
         super().__init__()
         self.wizard = wizard
-        self.current_available_df = pd.DataFrame() 
+        # Available table = positions into wizard.all_invoices_df (proxy-style filtering)
+        self._available_positions = np.array([], dtype=np.intp)
+        self._available_base_positions = self._available_positions  # before the header filters
+        self._available_model = None
+        self._filter_index = None
+        self._assigned_tracker = None
+        self._iss_summary_cache = {}  # auto_id -> (positions, cache_key, ISS calculado)
         
         self.assigned_filters = []
         self.available_filters = []
@@ -1245,10 +1378,7 @@ class AssignmentPage(QWidget):
     def isComplete(self):
         if not self.wizard.autos:
             return False
-        return any(
-            isinstance(data.get('df'), pd.DataFrame) and not data['df'].empty 
-            for data in self.wizard.autos.values()
-        )
+        return any(has_invoices(data) for data in self.wizard.autos.values())
     
     def edit_auto_text(self):
         current_item = self.autos_list_widget.currentItem()
@@ -1267,12 +1397,11 @@ class AssignmentPage(QWidget):
             QMessageBox.critical(self, "Erro", f"Não foi possível encontrar dados para o auto {auto_id}: {e}")
             return
 
-        df_invoices = auto_data_original.get('df')
-        
-        if not isinstance(df_invoices, pd.DataFrame) or df_invoices.empty:
+        if not has_invoices(auto_data_original):
             QMessageBox.warning(self, "Texto Não Disponível", 
                                 "Atribua notas fiscais a este auto antes de gerar o texto.")
             return
+        df_invoices = auto_frame(self.wizard.all_invoices_df, auto_data_original)
 
         # --- ✅ START: Aliquot Override Logic for Dialog ---
         try:
@@ -1353,13 +1482,10 @@ class AssignmentPage(QWidget):
             QMessageBox.warning(self, "Ação Inválida", "Esta ação só é válida para autos de 'Alíquota Incorreta'.")
             return
 
-        df_invoices = original_auto_data.get('df')
-        
-        # ✅ --- START FIX: Check if df_invoices is a DataFrame before checking empty ---
-        if not isinstance(df_invoices, pd.DataFrame) or df_invoices.empty:
-        # ✅ --- END FIX ---
+        if not has_invoices(original_auto_data):
             QMessageBox.warning(self, "Ação Inválida", "O auto selecionado não contém notas fiscais para dividir.")
             return
+        df_invoices = auto_frame(self.wizard.all_invoices_df, original_auto_data)
 
         # **Crucial Check:** Ensure NO other infractions exist on ANY invoice in this auto
         for index, row in df_invoices.iterrows():
@@ -1404,7 +1530,7 @@ class AssignmentPage(QWidget):
             self.wizard.auto_counter += 1
             new_idd_data = {
                 'motive': 'IDD (Alíq. Declarada)',
-                'df': df_invoices.copy(), # Use the same invoices
+                'positions': auto_positions(original_auto_data), # Use the same invoices
                 'rule_name': 'idd_nao_pago', # Use standard IDD rule name
                 # Store the DECLARED rate as the 'correct' rate for THIS auto's calculation context
                 'user_defined_aliquota': declared_rate,
@@ -1417,7 +1543,7 @@ class AssignmentPage(QWidget):
             self.wizard.auto_counter += 1
             new_diff_data = {
                 'motive': 'Diferença Alíquota',
-                'df': df_invoices.copy(), # Use the same invoices
+                'positions': auto_positions(original_auto_data), # Use the same invoices
                 'rule_name': 'diferenca_aliquota', # Define a new internal rule name
                 # Store the CORRECT rate for THIS auto's calculation context
                 'user_defined_aliquota': correct_rate,
@@ -1525,32 +1651,31 @@ class AssignmentPage(QWidget):
         
         on_change_slot() # Re-apply filters
 
+    def _active_text_filters(self, filter_list):
+        """[(column, lowered text, keep_matches)] for the filter rows with text."""
+        active = []
+        for f in filter_list:
+            filter_text = f["edit"].text().strip().lower()
+            if filter_text:
+                active.append((f["combo"].currentText(), filter_text, f["logic"].currentText() == "Contém"))
+        return active
+
     def _apply_filters_to_df(self, df, filter_list):
         """Helper to apply filters to a DataFrame with negative logic."""
         if df is None or df.empty:
             return df
-            
-        filtered_df = df.copy()
-        
-        for f in filter_list:
-            column_name = f["combo"].currentText()
-            filter_text = f["edit"].text().strip().lower()
-            logic_mode = f["logic"].currentText() # ✅ Get "Contém" or "Não Contém"
-            
-            if filter_text and column_name in filtered_df.columns:
+
+        mask = np.ones(len(df), dtype=bool)
+        for column_name, filter_text, keep_matches in self._active_text_filters(filter_list):
+            if column_name in df.columns:
                 try:
-                    # Create the boolean mask (True where match found)
-                    mask = filtered_df[column_name].astype(str).str.lower().str.contains(filter_text, na=False)
-                    
-                    if logic_mode == "Contém":
-                        filtered_df = filtered_df[mask]   # Keep matches
-                    else:
-                        filtered_df = filtered_df[~mask]  # Keep NON-matches (Invert)
-                        
+                    # True where match found
+                    matches = df[column_name].astype(str).str.lower().str.contains(filter_text, regex=False, na=False).to_numpy()
+                    mask &= matches if keep_matches else ~matches
                 except Exception as e:
                     print(f"Error filtering column {column_name}: {e}")
-                    
-        return filtered_df
+
+        return df if mask.all() else df[mask]
 
     # --- Public Slots for Buttons ---
     def add_assigned_filter_row(self):
@@ -1560,7 +1685,7 @@ class AssignmentPage(QWidget):
             self.assigned_filters, 
             self.refresh_all_tables,
             # ✅ Passa uma *função* que obtém o DF atual
-            lambda: self.wizard.autos.get(self.get_current_auto_id(), {}).get('df', pd.DataFrame())
+            lambda: auto_frame(self.wizard.all_invoices_df, self.wizard.autos.get(self.get_current_auto_id(), {}))
         )
 
     def add_available_filter_row(self):
@@ -1574,56 +1699,84 @@ class AssignmentPage(QWidget):
         )
     # ✅ --- END: New Filter/Column Helper Methods ---
 
+    @property
+    def current_available_df(self):
+        """Rows currently shown in the 'Available' table (materialized on demand)."""
+        return self.wizard.all_invoices_df.iloc[self._available_positions]
+
+    def _get_filter_index(self):
+        df = self.wizard.all_invoices_df
+        if self._filter_index is None or not self._filter_index.is_compatible(df):
+            self._filter_index = InvoiceFilterIndex(df)
+        return self._filter_index
+
+    def _get_assigned_tracker(self):
+        df = self.wizard.all_invoices_df
+        if self._assigned_tracker is None or not self._assigned_tracker.is_compatible(df):
+            self._assigned_tracker = AssignedInvoiceTracker(df)
+        self._assigned_tracker.sync(self.wizard.autos)
+        return self._assigned_tracker
+
+    def _invoices_changed(self, indices, columns):
+        """Call after editing cells of wizard.all_invoices_df so cached strings/masks follow."""
+        if self._filter_index is not None:
+            self._filter_index.invalidate_columns(columns)
+        if self._available_model is not None:
+            self._available_model.refresh_rows(indices)
+        self.available_invoices_table.horizontalHeader().invalidate_values(columns)
+
     def populate_available_table(self):
-        all_assigned_indices = pd.Index([])
-        
-        # ✅ --- START FIX: Check if 'df' is a DataFrame before accessing .index ---
-        for auto_data in self.wizard.autos.values():
-            df = auto_data.get('df')
-            if isinstance(df, pd.DataFrame): # Check if it's a DataFrame
-                all_assigned_indices = all_assigned_indices.union(df.index)
-        # ✅ --- END FIX ---
+        all_df = self.wizard.all_invoices_df
+        filter_index = self._get_filter_index()
 
-        available_df = self.wizard.all_invoices_df.drop(all_assigned_indices, errors='ignore')
+        # 1. Not assigned to any auto (maintained incrementally)
+        mask = ~self._get_assigned_tracker().assigned_mask
 
         if not self.show_ignored_chk.isChecked():
-            # Ensure column exists
-            if 'status_manual' not in available_df.columns:
-                available_df['status_manual'] = ''
-            
-            available_df = available_df[available_df['status_manual'] != 'Ignored']
+            mask &= ~filter_index.equals_mask('status_manual', 'Ignored')
 
+        # 2. Only invoices from the current auto's year
         current_auto_id = self.get_current_auto_id()
         target_year = self.wizard._get_auto_year(current_auto_id) # Use the helper we just made
-        
-        # Ensure DATA EMISSÃO is proper format in available_df
-        if not available_df.empty:
-             if not pd.api.types.is_datetime64_any_dtype(available_df['DATA EMISSÃO']):
-                 available_df['DATA EMISSÃO'] = pd.to_datetime(available_df['DATA EMISSÃO'], errors='coerce')
+        if target_year is not None and len(all_df):
+            mask &= filter_index.years() == target_year
 
-        if target_year is not None and not available_df.empty:
-            # Filter: Show only invoices from 'target_year'
-            available_df = available_df[available_df['DATA EMISSÃO'].dt.year == target_year]
+        # 3. Text filters ("Contém" / "Não Contém") on cached lowered columns
+        for column_name, filter_text, keep_matches in self._active_text_filters(self.available_filters):
+            matches = filter_index.contains_mask(column_name, filter_text)
+            mask &= matches if keep_matches else ~matches
 
-        # ✅ --- START: Apply new dynamic filters ---
-        available_df = self._apply_filters_to_df(available_df, self.available_filters)
-        # ✅ --- END: Apply new dynamic filters ---
+        # Value lists of the header filters come from here (before step 4), so a filtered
+        # column still lists every value and its filter can be widened again
+        self._available_base_positions = np.flatnonzero(mask)
 
-        self.current_available_df = available_df.copy()
-        
-        self.available_invoices_table.horizontalHeader().set_dataframe(available_df)
-        self.available_invoices_table.column_mapping = self.wizard.visible_columns # Sync mapping
+        # 4. Excel-style header filters
+        header = self.available_invoices_table.horizontalHeader()
+        for col_idx, allowed in getattr(header, 'filters', {}).items():
+            if col_idx < len(self.wizard.visible_columns):
+                mask &= filter_index.values_mask(self.wizard.visible_columns[col_idx], allowed)
 
-        self.populate_table_with_df(self.available_invoices_table, available_df)
-        
-        # ❌ REMOVED: The manual iteration loop that caused the crash.
-        # The InvoiceTableModel (lines 80-92) now handles the gray background/text color 
-        # automatically based on 'status_manual' == 'Ignored'.
-        
+        self._available_positions = np.flatnonzero(mask)
+
+        # Reuse the model (and its cached strings) while the frame/columns are the same
+        table = self.available_invoices_table
+        if self._available_model is None or not self._available_model.is_compatible(all_df, self.wizard.visible_columns) \
+                or table.model() is not self._available_model:
+            self._available_model = InvoiceTableModel(all_df, self.wizard.visible_columns, parent=table,
+                                                      row_positions=self._available_positions)
+            table.setModel(self._available_model)
+        else:
+            self._available_model.set_row_positions(self._available_positions)
+
+        # Value counts come from the full frame's cached per-column codes, restricted to the rows before header filters
+        header.set_dataframe(all_df, row_positions=lambda: self._available_base_positions)
+        table.column_mapping = self.wizard.visible_columns # Sync mapping
+
+        summary_df = all_df[[Columns.VALUE, Columns.RATE]].iloc[self._available_positions]
         iss_declarado = 0.0
-        if not available_df.empty:
-            iss_declarado = ((available_df[Columns.VALUE] * available_df[Columns.RATE]) / 100.0).sum()
-        self.available_summary_label.setText(format_summary_label(available_df, iss_value=iss_declarado, iss_label="ISS Declarado"))
+        if not summary_df.empty:
+            iss_declarado = ((summary_df[Columns.VALUE] * summary_df[Columns.RATE]) / 100.0).sum()
+        self.available_summary_label.setText(format_summary_label(summary_df, iss_value=iss_declarado, iss_label="ISS Declarado"))
 
     def populate_table_with_df(self, table, df):
         if df is None: 
@@ -1647,83 +1800,29 @@ class AssignmentPage(QWidget):
         if current_auto_id and current_auto_id in self.wizard.autos:
             auto_data = self.wizard.autos[current_auto_id]
             
-            # ✅ --- START FIX: Check if 'df' is a DataFrame before proceeding ---
-            assigned_df = auto_data.get('df') # Use .get for safety
-
-            # Check if it's actually a DataFrame before proceeding
-            if not isinstance(assigned_df, pd.DataFrame):
-                 assigned_df = pd.DataFrame(columns=self.wizard.all_invoices_df.columns)
-            # ✅ --- END FIX ---
+            # Rows of the auto, materialized from the wizard frame only for display
+            positions = auto_positions(auto_data)
+            assigned_df = auto_frame(self.wizard.all_invoices_df, auto_data)
             
             if not assigned_df.empty:
-                # --- START: Updated Aliquot/Tax Calculation Logic (Matches Preview Page) ---
-                
-                # 1. Get the saved monthly overrides (from Page 3)
-                monthly_overrides = auto_data.get('monthly_overrides', {})
-
-                # 2. Get the default "correct" aliquot for this auto (Fallback)
-                first_row = assigned_df.iloc[0]
-                default_aliquota_pct = 5.0 # default
-                if auto_data.get('user_defined_aliquota') is not None:
-                    default_aliquota_pct = auto_data['user_defined_aliquota']
-                elif 'correct_rate' in assigned_df.columns and pd.notna(first_row.get('correct_rate')):
-                    default_aliquota_pct = first_row.get('correct_rate')
-                elif (auto_data['motive'].startswith('IDD (Não Pago)') or 
-                      auto_data['motive'].startswith('Alíquota incorreta')) and pd.notna(first_row.get(Columns.RATE)):
-                    default_aliquota_pct = first_row.get(Columns.RATE)
-                
-
-                is_idd_auto = auto_data.get('rule_name') == 'idd_nao_pago'
-
-                # 3. Apply calculation logic row-by-row
-                temp_df = assigned_df.copy() 
-                temp_df['iss_original_calculado'] = 0.0
-                
-                if not pd.api.types.is_datetime64_any_dtype(temp_df['DATA EMISSÃO']):
-                     temp_df['DATA EMISSÃO'] = pd.to_datetime(temp_df['DATA EMISSÃO'], errors='coerce')
-
-                for idx, row in temp_df.iterrows():
-                    period_str = row['DATA EMISSÃO'].strftime('%m/%Y') if pd.notna(row['DATA EMISSÃO']) else None
-                    target_rate = default_aliquota_pct 
-
-                    # Priority 1: Manual Override (from Page 3)
-                    if period_str in monthly_overrides:
-                        target_rate = monthly_overrides[period_str]
-                    # ✅ CHANGE: Priority 2: Force IDD to Declared Rate (ALÍQUOTA)
-                    elif is_idd_auto:
-                        target_rate = row.get('ALÍQUOTA', 0)
-                    # Priority 3: Specific 'correct_rate' on Invoice (Normal Flow)
-                    elif 'correct_rate' in temp_df.columns and pd.notna(row['correct_rate']) and row['correct_rate'] > 0:
-                        target_rate = row['correct_rate']
-                    # Priority 4: Declared Rate (Fallback)
-                    elif row.get('ALÍQUOTA', 0) > 0:
-                         target_rate = row.get('ALÍQUOTA')
-                    
-                    aliquota_dec = target_rate / 100.0
-
-                    # 5. Calculate ISS for this row using the final aliquot
-                    declared_rate_decimal = row.get('ALÍQUOTA', 0.0) / 100.0
-                    raw_valor = row.get('VALOR', 0.0)
-                    deducao = row.get('VALOR DEDUÇÃO', 0.0)
-                    if pd.isna(deducao): deducao = 0.0
-                    valor = raw_valor - deducao
-                    payment_status = str(row.get('PAGAMENTO', 'Não')).strip().lower()
-                    is_paid = payment_status in ['sim', 'idd']
-                    
-                    invoice_iss_original = 0.0
-                    if is_paid:
-                        aliquota_difference = aliquota_dec - declared_rate_decimal
-                        invoice_iss_original = max(0, aliquota_difference * valor)
-                    else: 
-                        invoice_iss_original = aliquota_dec * valor
-                        
-                    temp_df.loc[idx, 'iss_original_calculado'] = invoice_iss_original
-                
-                calculated_iss_original = temp_df['iss_original_calculado'].sum()
-                # --- END: Updated Aliquot/Tax Calculation Logic ---
+                # Cached per auto until its positions array is replaced or overrides/aliquota change
+                cache_key = (tuple(sorted(auto_data.get('monthly_overrides', {}).items())),
+                             auto_data.get('user_defined_aliquota'), auto_data.get('motive'),
+                             auto_data.get('rule_name'))
+                cached = self._iss_summary_cache.get(current_auto_id)
+                if cached is not None and cached[0] is positions and cached[1] == cache_key:
+                    calculated_iss_original = cached[2]
+                else:
+                    calculated_iss_original = compute_auto_iss_original(assigned_df, auto_data)
+                    self._iss_summary_cache[current_auto_id] = (positions, cache_key, calculated_iss_original)
         
         # ✅ --- START: Apply filters to ASSIGNED table ---
         filtered_assigned_df = self._apply_filters_to_df(assigned_df, self.assigned_filters)
+        assigned_header = self.assigned_invoices_table.horizontalHeader()
+        for col_idx, allowed in getattr(assigned_header, 'filters', {}).items():
+            col_name = self.wizard.visible_columns[col_idx] if col_idx < len(self.wizard.visible_columns) else None
+            if col_name in filtered_assigned_df.columns:
+                filtered_assigned_df = filtered_assigned_df[as_text(filtered_assigned_df[col_name]).isin(allowed)]
         self.populate_table_with_df(self.assigned_invoices_table, filtered_assigned_df)
         # ✅ --- END: Apply filters ---
         
@@ -1756,29 +1855,11 @@ class AssignmentPage(QWidget):
         return table
 
     def apply_excel_filters(self, col_index, allowed_values):
-        table = self.available_invoices_table
-        model = table.model()
-        
-        if not model: return
-        
-        # Access the raw DF directly from the model for speed
-        df = model._df 
-        
-        # Iterate DataFrame rows efficiently
-        for row_idx in range(len(df)):
-            should_show = True
-            
-            # Check against active filters
-            for f_col_idx, allowed in table.horizontalHeader().filters.items():
-                # Get value from DF safely
-                col_name = self.wizard.visible_columns[f_col_idx]
-                val = str(df.iloc[row_idx][col_name])
-                
-                if val not in allowed:
-                    should_show = False
-                    break
-            
-            table.setRowHidden(row_idx, not should_show)
+        # Header filters are part of the table masks; just re-run the right table
+        if self.sender() is self.assigned_invoices_table.horizontalHeader():
+            self.refresh_all_tables()
+        else:
+            self.populate_available_table()
 
     def mark_as_ignored(self):
         """
@@ -1791,10 +1872,9 @@ class AssignmentPage(QWidget):
             return
 
         # Update DataFrame
-        for idx in indices:
-            self.wizard.all_invoices_df.at[idx, 'status_manual'] = 'Ignored'
-            # Optional: Clear any existing auto assignment just in case
-            # (Though if it's in available table, it shouldn't be assigned)
+        set_values(self.wizard.all_invoices_df, indices, 'status_manual', 'Ignored')
+        # (Rows in the available table have no auto assignment to clear)
+        self._invoices_changed(indices, ['status_manual'])
 
         # Refresh
         self.populate_available_table()
@@ -1862,7 +1942,7 @@ class AssignmentPage(QWidget):
 
         self.refresh_all_tables() # Refresh tables as usual
 
-    def create_new_auto(self, invoices_df=None):
+    def create_new_auto(self, invoice_indices=None):
         dialog = NewAutoDialog(self)
         dialog.auto_id_edit.setText(f"AUTO-{self.wizard.auto_counter:03d}")
         
@@ -1878,12 +1958,10 @@ class AssignmentPage(QWidget):
             
             rule_name = self.wizard.motive_to_rule_map.get(motive, 'regra_desconhecida')
             
-            df = invoices_df if invoices_df is not None else pd.DataFrame(columns=self.wizard.all_invoices_df.columns)
-            
             new_auto_data = {
                 'motive': motive, 
                 'rule_name': rule_name, 
-                'df': df,
+                'positions': positions_of(self.wizard.all_invoices_df, invoice_indices),
                 'user_defined_credito': data.get('user_defined_credito'),
                 'auto_text': ''
             }
@@ -2001,15 +2079,14 @@ class AssignmentPage(QWidget):
                 new_details = current_details
             self.wizard.all_invoices_df.at[index, Columns.BROKEN_RULE_DETAILS] = new_details
 
-        invoices_to_add = self.wizard.all_invoices_df.loc[indices_to_move]
-        
-        current_auto_df = self.wizard.autos[auto_id].get('df')
-        if not isinstance(current_auto_df, pd.DataFrame): 
-             current_auto_df = pd.DataFrame(columns=invoices_to_add.columns)
-
-        combined_df = pd.concat([current_auto_df, invoices_to_add])
-        self.wizard.autos[auto_id]['df'] = combined_df[~combined_df.index.duplicated(keep='first')]
+        tracker = self._get_assigned_tracker()
+        current_positions = auto_positions(self.wizard.autos[auto_id])
+        combined = add_positions(current_positions, positions_of(self.wizard.all_invoices_df, indices_to_move))
+        self.wizard.autos[auto_id]['positions'] = combined
         self.wizard.autos[auto_id]['auto_text'] = ''
+        tracker.add(combined[len(current_positions):])
+        tracker.commit(self.wizard.autos)
+        self._invoices_changed(indices_to_move, ['primary_infraction_group', Columns.BROKEN_RULE_DETAILS])
         
         self.refresh_all_tables()
         
@@ -2040,11 +2117,13 @@ class AssignmentPage(QWidget):
             self.wizard.all_invoices_df.at[index, 'primary_infraction_group'] = new_primary_group
             self.wizard.all_invoices_df.at[index, Columns.BROKEN_RULE_DETAILS] = new_details
 
-        current_df = self.wizard.autos[auto_id].get('df')
-        if isinstance(current_df, pd.DataFrame):
-            self.wizard.autos[auto_id]['df'] = current_df.drop(indices_to_remove, errors='ignore')
-        else:
-            self.wizard.autos[auto_id]['df'] = pd.DataFrame() 
+        tracker = self._get_assigned_tracker()
+        current_positions = auto_positions(self.wizard.autos[auto_id])
+        removed = np.isin(current_positions, positions_of(self.wizard.all_invoices_df, indices_to_remove))
+        tracker.remove(current_positions[removed])
+        self.wizard.autos[auto_id]['positions'] = current_positions[~removed]
+        tracker.commit(self.wizard.autos)
+        self._invoices_changed(indices_to_remove, ['primary_infraction_group', Columns.BROKEN_RULE_DETAILS])
         
         self.wizard.autos[auto_id]['auto_text'] = ''
         self.refresh_all_tables()
@@ -2078,13 +2157,13 @@ class AssignmentPage(QWidget):
             infractions_to_keep = dialog.get_infractions_to_keep()
             for index in unique_indices:
                 affected_auto_id = None
+                invoice_position = positions_of(self.wizard.all_invoices_df, [index])
                 
                 for auto_id, auto_data in self.wizard.autos.items():
-                    # ✅ --- START FIX: Check if 'df' is a DataFrame before checking index/dropping ---
-                    df = auto_data.get('df')
-                    if isinstance(df, pd.DataFrame) and index in df.index:
-                        auto_data['df'] = df.drop(index)
-                    # ✅ --- END FIX ---
+                    positions = auto_positions(auto_data)
+                    in_auto = np.isin(positions, invoice_position)
+                    if in_auto.any():
+                        auto_data['positions'] = positions[~in_auto]
                         affected_auto_id = auto_id
                         break
                 
@@ -2107,17 +2186,11 @@ class AssignmentPage(QWidget):
                         target_auto_id = self.create_new_auto() 
                     
                     if target_auto_id:
-                        invoice_to_move = self.wizard.all_invoices_df.loc[[index]]
-                        
-                        # ✅ --- START FIX: Check if 'df' is a DataFrame before concat ---
-                        target_df = self.wizard.autos[target_auto_id].get('df')
-                        if not isinstance(target_df, pd.DataFrame):
-                            target_df = pd.DataFrame(columns=invoice_to_move.columns)
-                        self.wizard.autos[target_auto_id]['df'] = pd.concat([target_df, invoice_to_move])
-                        # ✅ --- END FIX ---
-                        
-                        self.wizard.autos[target_auto_id]['auto_text'] = ''
+                        target_data = self.wizard.autos[target_auto_id]
+                        target_data['positions'] = add_positions(auto_positions(target_data), invoice_position)
+                        target_data['auto_text'] = ''
 
+            self._invoices_changed(unique_indices, ['primary_infraction_group', Columns.BROKEN_RULE_DETAILS])
             self.refresh_all_tables()
             if hasattr(self.wizard, 'fine_page'):
                 self.wizard.fine_page.update_fine_text()
@@ -2162,30 +2235,27 @@ class AssignmentPage(QWidget):
 
     def view_assigned_details(self):
         auto_id = self.get_current_auto_id()
-        df = pd.DataFrame()
+        positions = EMPTY_POSITIONS
         if auto_id and auto_id in self.wizard.autos:
-            # ✅ --- START FIX: Check if 'df' is a DataFrame ---
-            df_check = self.wizard.autos[auto_id].get('df')
-            if isinstance(df_check, pd.DataFrame):
-                df = df_check
-            # ✅ --- END FIX ---
+            positions = auto_positions(self.wizard.autos[auto_id])
         
-        if df.empty:
+        if not len(positions):
             QMessageBox.information(self, "Sem Notas", "Nenhuma nota atribuída a este auto para ver em detalhe.")
             return
         
         all_cols = self.wizard.all_invoices_df.columns.tolist()
-        dialog = InvoiceDetailViewerDialog(df, all_cols, self)
+        dialog = InvoiceDetailViewerDialog(self.wizard.all_invoices_df, all_cols, self, row_positions=positions)
         dialog.exec()
 
     def view_available_details(self):
-        df = self.current_available_df
-        if df.empty:
+        if not len(self._available_positions):
             QMessageBox.information(self, "Sem Notas", "Nenhuma nota disponível para ver em detalhe (ou o filtro está muito restrito).")
             return
         
         all_cols = self.wizard.all_invoices_df.columns.tolist()
-        dialog = InvoiceDetailViewerDialog(df, all_cols, self)
+        # Full frame + visible positions: the viewer shares the rows without copying them
+        dialog = InvoiceDetailViewerDialog(self.wizard.all_invoices_df, all_cols, self,
+                                           row_positions=self._available_positions)
         dialog.exec()
 
     def flag_available_infraction(self):
@@ -2194,9 +2264,7 @@ class AssignmentPage(QWidget):
             QMessageBox.warning(self, "Nenhuma Nota Selecionada", "Por favor, selecione uma ou mais notas da tabela 'Notas Disponíveis' para flagar.")
             return
 
-        invoices_df = self.wizard.all_invoices_df.loc[indices_to_flag]
-        
-        new_auto_id = self.create_new_auto(invoices_df=invoices_df)
+        new_auto_id = self.create_new_auto(invoice_indices=indices_to_flag)
         
         if new_auto_id:
             new_motive = self.wizard.autos[new_auto_id].get('motive', 'compliant')
@@ -2210,6 +2278,7 @@ class AssignmentPage(QWidget):
             
             self.wizard.autos[new_auto_id]['auto_text'] = ''
             
+            self._invoices_changed(indices_to_flag, ['primary_infraction_group', Columns.BROKEN_RULE_DETAILS])
             self.refresh_all_tables()
 
             if hasattr(self.wizard, 'fine_page'):
@@ -2226,20 +2295,20 @@ class AssignmentPage(QWidget):
         if not filepath:
             return
 
+        money_columns = [Columns.VALUE, 'VALOR DEDUÇÃO', 'DESCONTO INCONDICIONAL']
+        formats = {Columns.RATE: PERCENT_FORMAT}
         try:
-            with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
+            # Write-only: cada folha é serializada ao ser escrita (sem o workbook inteiro em memória)
+            with StreamingExcelWriter(filepath) as book:
                 self.populate_available_table() 
                 if not self.current_available_df.empty:
-                    self.current_available_df.to_excel(writer, sheet_name="Notas Nao Autuadas", index=False)
+                    book.add_frame("Notas Nao Autuadas", self.current_available_df, formats, money_columns=money_columns)
                 
                 for auto_id, auto_data in self.wizard.autos.items():
-                    df = auto_data.get('df')
-                    # ✅ --- START FIX: Check if 'df' is a DataFrame before exporting ---
-                    if isinstance(df, pd.DataFrame) and not df.empty:
-                    # ✅ --- END FIX ---
+                    if has_invoices(auto_data):
+                        df = auto_frame(self.wizard.all_invoices_df, auto_data)
                         sheet_name = auto_id.replace(":", "").replace("/", "-").replace(" ", "_")
-                        sheet_name = sheet_name[:31] 
-                        df.to_excel(writer, sheet_name=sheet_name, index=False)
+                        book.add_frame(sheet_name, df, formats, money_columns=money_columns)
                         
             QMessageBox.information(self, "Exportação Concluída", f"Os autos de infração foram exportados com sucesso para:\n{filepath}")
         except Exception as e:
@@ -2248,12 +2317,7 @@ class AssignmentPage(QWidget):
     def isComplete(self):
         if not self.wizard.autos:
             return False
-        # ✅ --- START FIX: Check if 'df' is a DataFrame before checking .empty ---
-        return any(
-            isinstance(data.get('df'), pd.DataFrame) and not data['df'].empty 
-            for data in self.wizard.autos.values()
-        )
-        # ✅ --- END FIX ---
+        return any(has_invoices(data) for data in self.wizard.autos.values())
 
 # --- Page 2: Fine Details ---
 
@@ -2261,6 +2325,8 @@ class FineDetailsPage(QWidget):
     def __init__(self, wizard):
         super().__init__()
         self.wizard = wizard
+        self.dam_frame = None  # DAMs consolidados em memória (Multi-Ano); tem prioridade sobre o caminho
+        self._dam_frame_session_path = None  # cópia do dam_frame gravada com a sessão
 
         main_page_layout = QVBoxLayout(self)
 
@@ -2417,11 +2483,40 @@ class FineDetailsPage(QWidget):
         if self.fines_table.rowCount() == 0:
             self.add_fine_row()
 
+    def dam_source(self):
+        """In-memory DAM frame (Multi-Ano) or the DAM file path shown in the field."""
+        return self.dam_frame if self.dam_frame is not None else self.dam_filepath_edit.text()
+
+    def dam_session_path(self):
+        """
+        DAM source to save in the session. The in-memory frame is written once
+        next to the snapshot, since the '[Multi-Ano]' label cannot be re-read.
+        """
+        if self.dam_frame is None:
+            return self.dam_filepath_edit.text()
+        if self._dam_frame_session_path is None:
+            try:
+                self._dam_frame_session_path = self.wizard.session_store.write_dam_frame(self.dam_frame)
+            except Exception as e:
+                logging.warning(f"Não foi possível gravar os DAMs Multi-Ano com a sessão: {e}")
+                return ""
+        return self._dam_frame_session_path
+
+    def load_dam_frame_programmatically(self, dam_frame, session_path=None):
+        """DAMs consolidated by MultiYearPrepWorker: used directly, no file round-trip."""
+        self.dam_frame = dam_frame
+        self._dam_frame_session_path = session_path
+        self.dam_filepath_edit.setText(f"[Multi-Ano] {len(dam_frame)} DAMs consolidados em memória")
+        self.wizard.set_dam_payments(_load_and_process_dams(dam_frame))
+        print(f"✅ Auto-loaded DAMs: {len(self.wizard.dam_payments_map)} records (in memory)")
+        self.wizard.mark_dirty()
+
     def load_dam_file_programmatically(self, file_path):
+        self.dam_frame = None
         self.dam_filepath_edit.setText(file_path)
         try:
             if os.path.exists(file_path):
-                self.wizard.dam_payments_map = _load_and_process_dams(file_path)
+                self.wizard.set_dam_payments(_load_and_process_dams(file_path))
                 print(f"✅ Auto-loaded DAMs: {len(self.wizard.dam_payments_map)} records from {file_path}")
                 # ✅ MARK DIRTY (DAMs affect calculation)
                 self.wizard.mark_dirty()
@@ -2499,10 +2594,11 @@ class FineDetailsPage(QWidget):
             full_df.to_csv(temp.name, sep=',', index=False)
             temp.close()
 
+            self.dam_frame = None
             self.dam_filepath_edit.setText(temp.name)
             
             # Load
-            self.wizard.dam_payments_map = _load_and_process_dams(temp.name)
+            self.wizard.set_dam_payments(_load_and_process_dams(temp.name))
             
             count = sum(len(v) for v in self.wizard.dam_payments_map.values())
             QMessageBox.information(self, "DAMs Carregados", 
@@ -2523,7 +2619,7 @@ class FineDetailsPage(QWidget):
                 class DummyEmitter:
                     def emit(self, msg): print(msg)
                 
-                self.wizard.pgdas_payments_map = _load_and_process_pgdas(folder_path, DummyEmitter())
+                self.wizard.set_pgdas_payments(_load_and_process_pgdas(folder_path, DummyEmitter()))
                 QMessageBox.information(self, "PGDAS Carregados", f"{len(self.wizard.pgdas_payments_map)} pagamentos PGDAS carregados.")
             except Exception as e:
                 QMessageBox.critical(self, "Erro ao Ler PGDAS", f"Não foi possível processar a pasta: {e}")
@@ -2531,17 +2627,14 @@ class FineDetailsPage(QWidget):
     def update_fine_text(self):
         # ... (Existing logic for instrumental fines extraction remains the same) ...
         
-        all_assigned_invoices = [
-            auto_data['df'] for auto_data in self.wizard.autos.values() 
-            if isinstance(auto_data.get('df'), pd.DataFrame) and not auto_data['df'].empty
-        ]
+        assigned_positions = union_positions(self.wizard.autos)
         
-        if not all_assigned_invoices:
+        if not len(assigned_positions):
             self.fine_text_edit.clear()
             self.meses_multa_label.setText("Meses com infrações: Nenhuma nota atribuída.")
             return
             
-        combined_df = pd.concat(all_assigned_invoices).drop_duplicates(subset=[Columns.INVOICE_NUMBER])
+        combined_df = self.wizard.all_invoices_df.iloc[assigned_positions].drop_duplicates(subset=[Columns.INVOICE_NUMBER])
         
         instrumental_causes = [
             'Dedução indevida', 'Regime incorreto', 'Isenção/Imunidade Indevida', 
@@ -2709,49 +2802,13 @@ class PreviewPage(QWidget):
         if not context: return
 
         locale = QLocale(QLocale.Language.Portuguese, QLocale.Country.Brazil)
-        startup_dam = context.get('available_credits_startup', {}).get('DAM', {})
-        startup_pgdas = context.get('available_credits_startup', {}).get('PGDAS', {})
-        available_credits = self.wizard.available_credits_map
+        ledger = context.get('credit_ledger')
+        if ledger is None: return
 
-        all_credit_periods = set()
-
-        for p in startup_dam: 
-            try:
-                y = int(p.split('/')[1])
-                if target_year is None or y == target_year:
-                    all_credit_periods.add(p)
-            except: pass
-            
-        for p in startup_pgdas:
-            try:
-                y = int(p.split('/')[1])
-                if target_year is None or y == target_year:
-                    all_credit_periods.add(p)
-            except: pass
-
-        def sort_key(period_str):
-            try: return datetime.strptime(period_str, "%m/%Y")
-            except ValueError:
-                try: return datetime.strptime(period_str, "%#m/%Y")
-                except ValueError: return datetime.min
-        
-        sorted_periods = sorted(list(all_credit_periods), key=sort_key)
-
-        for period in sorted_periods:
-            try: display_period = sort_key(period).strftime("%m/%Y")
-            except: display_period = period
-
-            pgdas_key = display_period 
-            dam_key = f"{int(display_period.split('/')[0])}/{display_period.split('/')[1]}" 
-            
-            pgdas_orig = startup_pgdas.get(pgdas_key, 0.0)
-            pgdas_rem = available_credits.get('PGDAS', {}).get(pgdas_key, 0.0)
-            
-            dam_list_orig = startup_dam.get(dam_key, [])
-            dam_orig = sum(d['val'] for d in dam_list_orig)
-            
-            dam_list_rem = available_credits.get('DAM', {}).get(dam_key, [])
-            dam_rem = sum(d['val'] for d in dam_list_rem)
+        for month in ledger.periods(target_year):
+            display_period = month_label(month)
+            pgdas_orig, pgdas_rem = ledger.pgdas_totals(display_period)
+            dam_orig, dam_rem = ledger.dam_totals(display_period)
 
             if pgdas_orig > 0.001:
                 key = f"PGDAS {display_period}"
@@ -3041,9 +3098,9 @@ class PreviewPage(QWidget):
                 # Get invoice numbers from the source of truth (wizard.autos)
                 invoice_list_str = "..."
                 if auto_key in self.wizard.autos:
-                    df = self.wizard.autos[auto_key].get('df')
-                    if isinstance(df, pd.DataFrame) and not df.empty and Columns.INVOICE_NUMBER in df.columns:
-                        nums = df[Columns.INVOICE_NUMBER].astype(str).tolist()
+                    positions = auto_positions(self.wizard.autos[auto_key])
+                    if len(positions) and Columns.INVOICE_NUMBER in self.wizard.all_invoices_df.columns:
+                        nums = self.wizard.all_invoices_df[Columns.INVOICE_NUMBER].iloc[positions].astype(str).tolist()
                         invoice_list_str = format_invoice_numbers(nums)
 
                 summary_autos_list.append({
@@ -3083,11 +3140,9 @@ class PreviewPage(QWidget):
         locale = QLocale(QLocale.Language.Portuguese, QLocale.Country.Brazil)
         context = self.wizard.preview_context
         
-        if not context or 'available_credits_startup' not in context:
+        if not context or 'credit_ledger' not in context:
             logging.warning("PreviewPage._read_tables_into_context called with invalid context.")
             return
-            
-        original_pgdas_map = self.wizard.pgdas_payments_map
 
         for auto_key, (_, edit) in self.manual_credit_widgets.items():
             wizard_auto_data = self.wizard.autos.get(auto_key)
@@ -3106,10 +3161,9 @@ class PreviewPage(QWidget):
                     auto['user_defined_credito'] = wizard_auto_data['user_defined_credito']
                     break
 
-        self.wizard.available_credits_map = {
-            'DAM': copy.deepcopy(context['available_credits_startup']['DAM']),
-            'PGDAS': copy.deepcopy(context['available_credits_startup']['PGDAS'])
-        }
+        # Valores editados à mão: realoca desde os créditos iniciais (reset é O(1))
+        ledger = context['credit_ledger']
+        ledger.reset()
 
         for auto_data in context.get('autos', []):
             auto_key = auto_data['numero']
@@ -3168,45 +3222,19 @@ class PreviewPage(QWidget):
                 
                 mes_data['iss_apurado'] = new_monthly_iss_apurado
 
-                period_key_str_pgdas = mes_data['mes_ano'] 
-                try:
-                    dt = datetime.strptime(mes_data['mes_ano'], "%m/%Y")
-                    period_key_str_dam = f"{dt.month}/{dt.year}"
-                except:
-                    period_key_str_dam = mes_data['mes_ano']
-
-                dams_list = self.wizard.available_credits_map['DAM'].get(period_key_str_dam, [])
-                available_dam_total = sum(d['val'] for d in dams_list)
-                
-                available_pgdas = self.wizard.available_credits_map['PGDAS'].get(period_key_str_pgdas, 0.0)
-                pgdas_decl_num = original_pgdas_map.get(period_key_str_pgdas, (0.0, "-"))[1]
-
-                dam_utilizado = min(dam_val_num, available_dam_total)
+                dam_utilizado, dam_ident_str = ledger.allocate(DAM, mes_ano_str, dam_val_num, owner=auto_key)
                 iss_apos_dam = mes_data['iss_apurado'] - dam_utilizado
-                das_utilizado = min(das_val_num, max(0, min(iss_apos_dam, available_pgdas)))
-                
-                iss_apurado_op = max(0, iss_apos_dam - das_utilizado)
+                das_utilizado, das_ident_str = ledger.allocate(PGDAS, mes_ano_str, min(das_val_num, max(0, iss_apos_dam)),
+                                                               owner=auto_key)
 
-                remainder_to_deduct = dam_utilizado
-                used_dam_codes = []
-                for dam_obj in dams_list:
-                    if remainder_to_deduct <= 0.0001: break
-                    if dam_obj['val'] > 0:
-                        deduct = min(dam_obj['val'], remainder_to_deduct)
-                        dam_obj['val'] -= deduct
-                        remainder_to_deduct -= deduct
-                        used_dam_codes.append(dam_obj['code'])
-                
-                dam_ident_str = ", ".join(sorted(set(used_dam_codes))) if used_dam_codes else "-"
+                iss_apurado_op = max(0, iss_apos_dam - das_utilizado)
 
                 mes_data['dam_iss_pago'] = dam_utilizado
                 mes_data['das_iss_pago'] = das_utilizado
                 mes_data['iss_apurado_op'] = iss_apurado_op
-                mes_data['das_identificacao'] = pgdas_decl_num if das_utilizado > 0 else "-"
+                mes_data['das_identificacao'] = das_ident_str
                 mes_data['dam_identificacao'] = dam_ident_str
 
-                self.wizard.available_credits_map['PGDAS'][period_key_str_pgdas] = available_pgdas - das_utilizado
-
             auto_data['totais']['iss_apurado'] = sum(m['iss_apurado'] for m in auto_data['dados_anuais'])
             auto_data['totais']['dam_iss_pago'] = sum(m['dam_iss_pago'] for m in auto_data['dados_anuais'])
             auto_data['totais']['das_iss_pago'] = sum(m['das_iss_pago'] for m in auto_data['dados_anuais'])
@@ -2,8 +2,8 @@
 import pandas as pd
 import numpy as np
 import unicodedata
-from datetime import datetime
-from pandas.tseries.offsets import MonthEnd, DateOffset
+from legal_deadlines import LegalDeadlines
+from invoice_schema import apply_invoice_schema, transform_values, map_values
 
 # ... (Keep build_aliquotas_lookup and existing helper functions if needed for legacy support, 
 # but the new logic relies on the function below) ...
@@ -46,11 +46,10 @@ def process_invoices_vectorized(df, aliquotas_lookup, today=None, idd_mode=False
         return df
 
     # --- 1. PREPARATION & MAPPING (Data Enrichment) ---
-    if today is None:
-        today = pd.to_datetime(datetime.now().date())
+    # (today=None -> legal_deadlines uses the current date)
 
-    # Ensure types
-    df['CÓDIGO DA ATIVIDADE'] = df['CÓDIGO DA ATIVIDADE'].astype(str).str.strip()
+    # Ensure types (text normalization runs once per distinct code, not per row)
+    df['CÓDIGO DA ATIVIDADE'] = transform_values(df['CÓDIGO DA ATIVIDADE'], lambda u: u.astype(str).str.strip()).astype('category')
     df['DATA EMISSÃO'] = pd.to_datetime(df['DATA EMISSÃO'], errors='coerce')
     df['ALÍQUOTA'] = pd.to_numeric(df['ALÍQUOTA'], errors='coerce').fillna(0.0)
     df['VALOR DEDUÇÃO'] = pd.to_numeric(df['VALOR DEDUÇÃO'], errors='coerce').fillna(0.0)
@@ -80,18 +79,21 @@ def process_invoices_vectorized(df, aliquotas_lookup, today=None, idd_mode=False
         ref_imunidade[code] = str(def_row.get('Imunidade', '')).strip().lower()
 
     # Map defaults
-    df['ref_correct_rate'] = df['CÓDIGO DA ATIVIDADE'].map(ref_rate).fillna(0.0)
-    df['ref_activity_desc'] = df['CÓDIGO DA ATIVIDADE'].map(ref_desc).fillna('N/A')
-    df['ref_deducao'] = df['CÓDIGO DA ATIVIDADE'].map(ref_deducao).fillna('não habilita')
-    df['ref_retencao'] = df['CÓDIGO DA ATIVIDADE'].map(ref_retencao).fillna('não habilita')
-    df['ref_local'] = df['CÓDIGO DA ATIVIDADE'].map(ref_local).fillna('')
-    df['ref_isencao'] = df['CÓDIGO DA ATIVIDADE'].map(ref_isencao).fillna('')
-    df['ref_imunidade'] = df['CÓDIGO DA ATIVIDADE'].map(ref_imunidade).fillna('')
+    codes = df['CÓDIGO DA ATIVIDADE']
+    df['ref_correct_rate'] = map_values(codes, ref_rate, 0.0).astype(float)
+    df['ref_activity_desc'] = map_values(codes, ref_desc, 'N/A')
+    df['ref_deducao'] = map_values(codes, ref_deducao, 'não habilita')
+    df['ref_retencao'] = map_values(codes, ref_retencao, 'não habilita')
+    df['ref_local'] = map_values(codes, ref_local, '')
+    df['ref_isencao'] = map_values(codes, ref_isencao, '')
+    df['ref_imunidade'] = map_values(codes, ref_imunidade, '')
 
     # Handle "Description Overrides" (Specific Description matching)
-    # Since vector mapping dictionary overrides is hard, we iterate only the codes that HAVE overrides.
+    # Since vector mapping dictionary overrides is hard, we iterate only the codes that HAVE overrides
+    # and actually appear in this company's invoices.
+    present_codes = set(codes.cat.categories[np.unique(codes.cat.codes[codes.cat.codes >= 0])])
     for code, data in aliquotas_lookup.items():
-        if data.get('by_desc'):
+        if data.get('by_desc') and code in present_codes:
             for specific_desc, row_data in data['by_desc'].items():
                 # Boolean mask where Code AND Desc match
                 mask_override = (df['CÓDIGO DA ATIVIDADE'] == code) & (df['activity_desc'] == specific_desc)
@@ -101,13 +103,18 @@ def process_invoices_vectorized(df, aliquotas_lookup, today=None, idd_mode=False
                     df.loc[mask_override, 'ref_local'] = str(row_data.get('Local', '')).lower()
                     # ... update other refs if needed ...
 
-    # Helper columns
-    df['norm_natureza'] = df['NATUREZA DA OPERAÇÃO'].astype(str).str.strip().str.lower().str.replace(" ", "", regex=False)
+    # Helper columns (computed on the distinct values of each column, then broadcast)
+    def _norm_natureza(u):
+        return u.astype(str).str.strip().str.lower().str.replace(" ", "", regex=False)
+
+    df['norm_natureza'] = transform_values(df['NATUREZA DA OPERAÇÃO'], _norm_natureza)
     # Remove accents from nature for easier comparison
-    df['norm_natureza_nfd'] = df['norm_natureza'].apply(lambda x: unicodedata.normalize('NFD', x).encode('ascii', 'ignore').decode("utf-8"))
+    df['norm_natureza_nfd'] = transform_values(df['NATUREZA DA OPERAÇÃO'], lambda u: _norm_natureza(u).map(
+        lambda x: unicodedata.normalize('NFD', x).encode('ascii', 'ignore').decode("utf-8") if isinstance(x, str) else x))
     
-    df['is_paid'] = df['PAGAMENTO'].astype(str).str.strip().str.lower().isin(['sim', 'idd'])
-    df['regime_normal'] = df['REGIME DE TRIBUTAÇÃO'].astype(str).str.strip() == 'Contribuinte sujeito a tributação normal'
+    df['is_paid'] = transform_values(df['PAGAMENTO'], lambda u: u.astype(str).str.strip().str.lower().isin(['sim', 'idd'])).astype(bool)
+    df['regime_normal'] = transform_values(df['REGIME DE TRIBUTAÇÃO'], lambda u: u.astype(str).str.strip() == 'Contribuinte sujeito a tributação normal').astype(bool)
+    iss_retido = transform_values(df['ISS RETIDO'], lambda u: u.astype(str).str.strip().str.lower())
     
     # --- 2. BOOLEAN MASKS FOR RULES (The Engine) ---
 
@@ -175,7 +182,7 @@ def process_invoices_vectorized(df, aliquotas_lookup, today=None, idd_mode=False
 
     # 2.6. Rule: Retenção na Fonte a Verificar
     if not idd_mode:
-        iss_retido_sim = df['ISS RETIDO'].astype(str).str.strip().str.lower() == 'sim'
+        iss_retido_sim = iss_retido == 'sim'
         m_retencao = mask_active & (~mask_tomador_ok) & iss_retido_sim
 
     # --- 3. COMBINE INFRACTIONS & HANDLE DECADENCE (ART 173) ---
@@ -183,12 +190,9 @@ def process_invoices_vectorized(df, aliquotas_lookup, today=None, idd_mode=False
     # Identify rows that have ANY infraction
     df['has_infraction'] = (m_regime | m_aliquota | m_isencao_imu | m_natureza_local | m_deducao | m_retencao)
 
-    # Decadence Calculation (Art 173): First day of invoice year + 6 years (logic from original: year + 6)
-    # Original used: invoice_date.replace(day=1, month=1) -> year start
-    dt_year_start = df['DATA EMISSÃO'].dt.to_period('Y').dt.to_timestamp() 
-    cutoff_173 = dt_year_start + pd.DateOffset(years=6)
-    
-    m_decadente_173 = df['has_infraction'] & (today >= cutoff_173)
+    # Decadence Calculation (Art 173): First day of invoice year + 6 years
+    deadlines = LegalDeadlines(df['DATA EMISSÃO'])
+    m_decadente_173 = df['has_infraction'] & deadlines.decadente(today)
 
     # If decadent, we suppress the specific infractions in the output, just marking "Decadente"
     df.loc[m_decadente_173, 'status_legal'] = 'Decadente'
@@ -200,15 +204,8 @@ def process_invoices_vectorized(df, aliquotas_lookup, today=None, idd_mode=False
     
     mask_check_idd = mask_active & (~df['has_infraction']) & (~df['is_paid']) & (~m_decadente_173) & (~mask_tomador_ok)
 
-    # Prescription Date Calculation (Art 174)
-    # Original: last_day_of_prev_month + 20 days + 5 years
-    # Logic for "last day of prev month": (Date - MonthEnd) gets to prev month end?
-    # safest: go to MonthBegin, subtract 1 day.
-    prev_month_end = df['DATA EMISSÃO'].dt.to_period('M').dt.to_timestamp() - pd.Timedelta(days=1)
-    due_date = prev_month_end + pd.Timedelta(days=20)
-    cutoff_174 = due_date + pd.DateOffset(years=5)
-
-    m_prescrito = mask_check_idd & (today >= cutoff_174)
+    # Prescription (Art 174): last day of previous month + 20 days + 5 years
+    m_prescrito = mask_check_idd & deadlines.prescrito(today)
     df.loc[m_prescrito, 'status_legal'] = 'Prescrito'
     
     # IDD Check (If not prescribed)
@@ -221,7 +218,7 @@ def process_invoices_vectorized(df, aliquotas_lookup, today=None, idd_mode=False
     # 4. Regime == Normal
     
     is_tributacao_mun = df['norm_natureza'].str.contains('tributacaomunicipio', na=False)
-    iss_retido_nao = df['ISS RETIDO'].astype(str).str.strip().str.lower() == 'não'
+    iss_retido_nao = iss_retido == 'não'
     
     m_idd_nao_pago = mask_idd_candidates & (
         (df['ALÍQUOTA'] != 0) &
@@ -302,5 +299,42 @@ def process_invoices_vectorized(df, aliquotas_lookup, today=None, idd_mode=False
     # Only drop what we created to avoid errors if cols didn't exist
     cols_to_drop = [c for c in drop_cols if c in df.columns]
     # We keep ref_correct_rate etc as they might be useful
-    
-    return df
\ No newline at end of file
+    df.drop(columns=cols_to_drop, inplace=True)
+
+    # ref_* / status columns back to the canonical (categorical) schema
+    return apply_invoice_schema(df)
+
+
+def build_infraction_groups(analyzed_df, split_by_year=False):
+    """
+    {group name: rows} of the non-compliant invoices, from a single groupby.
+
+    split_by_year: groups that span several emission years become one group per
+    year, named "<group> (<year>)" (rows without a date are left out of those);
+    single-year groups keep their plain name. The year of every row is computed
+    once, not once per group.
+    """
+    violating = analyzed_df[analyzed_df['primary_infraction_group'] != 'compliant']
+    if violating.empty:
+        return {}
+    if not split_by_year or 'DATA EMISSÃO' not in violating.columns:
+        return {key: group for key, group in violating.groupby('primary_infraction_group', sort=True)}
+
+    group_codes, group_names = pd.factorize(violating['primary_infraction_group'], sort=True)
+    years = pd.to_datetime(violating['DATA EMISSÃO'], errors='coerce').dt.year.fillna(-1).to_numpy(dtype=np.int64)
+
+    # Distinct (group, year) pairs -> number of dated years per group
+    dated = years >= 0
+    pair_keys = np.unique(group_codes[dated] * 10000 + years[dated])
+    years_per_group = np.bincount(pair_keys // 10000, minlength=len(group_names))
+    multi_year = years_per_group[group_codes] > 1
+
+    partition_year = np.where(multi_year, years, -1)
+    keep = ~multi_year | dated
+    partitions = violating[keep].groupby([group_codes[keep], partition_year[keep]], sort=True)
+
+    split_groups = {}
+    for (code, year), group in partitions:
+        name = group_names[code]
+        split_groups[name if year < 0 else f"{name} ({year})"] = group
+    return split_groups
@@ -0,0 +1,247 @@
+# --- FILE: app/session_store.py ---
+"""
+Armazenamento das sessões do ReviewWizard.
+
+    session_<cnpj>.npz      -> snapshot compacto: tabela única dos números de nota +
+                               um array int32 de posições por auto + metadados (JSON)
+    session_<cnpj>.journal  -> diário append-only (uma linha JSON por edição), escrito
+                               pelo autosave e aplicado por cima do snapshot ao carregar.
+                               É apagado sempre que o snapshot é reescrito (compactação).
+    session_<cnpj>.dams.npz -> DAMs consolidados só em memória (Multi-Ano), colunas tipadas;
+                               a sessão guarda este caminho em 'dam_filepath'.
+
+Sessões antigas em JSON (session_<cnpj>.json) continuam a ser lidas e são
+substituídas pelo snapshot na primeira gravação.
+"""
+
+import copy
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+SESSION_FORMAT_VERSION = 1
+AUTOSAVE_INTERVAL_MS = 30_000
+
+# Campos de cada auto guardados no snapshot/diário (além dos invoice_ids)
+AUTO_FIELDS = ("motive", "rule_name", "user_defined_aliquota", "user_defined_credito",
+               "auto_text", "monthly_overrides")
+
+# Colunas do frame de DAMs (data_loader.build_dam_frame)
+DAM_TEXT_COLUMNS = ("codigo", "referencia", "competencia", "tributo")
+DAM_NUMBER_COLUMNS = ("valor", "receita")
+DAM_COLUMNS = ("codigo", "referencia", "competencia", "valor", "receita", "tributo")
+
+
+class SessionStore:
+    """Lê/grava o snapshot .npz e o diário de uma sessão (base = 'session_<cnpj>')."""
+
+    def __init__(self, base_path):
+        self.snapshot_path = base_path + ".npz"
+        self.journal_path = base_path + ".journal"
+        self.legacy_path = base_path + ".json"
+        self.dams_path = base_path + ".dams.npz"
+
+    def exists(self):
+        return any(os.path.exists(p) for p in (self.snapshot_path, self.journal_path, self.legacy_path))
+
+    def has_base(self):
+        """True se existe um snapshot (ou JSON antigo) sobre o qual o diário pode ser aplicado."""
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.legacy_path)
+
+    # --- Snapshot ---
+
+    def write_snapshot(self, session_data):
+        """Grava a sessão completa (formato do antigo JSON) e descarta o diário."""
+        autos = session_data.get("autos", {})
+        auto_ids = list(autos.keys())
+        id_lists = [[str(n) for n in autos[a].get("invoice_ids", [])] for a in auto_ids]
+
+        numbers = pd.unique(pd.Series([n for ids in id_lists for n in ids], dtype=object))
+        number_index = pd.Index(numbers)
+
+        arrays = {}
+        meta = {k: v for k, v in session_data.items() if k != "autos"}
+        meta["format_version"] = SESSION_FORMAT_VERSION
+        meta["autos"] = []
+        for i, (auto_id, ids) in enumerate(zip(auto_ids, id_lists)):
+            arrays[f"auto_{i}"] = number_index.get_indexer(ids).astype(np.int32)
+            meta["autos"].append({"id": auto_id, **{k: autos[auto_id].get(k) for k in AUTO_FIELDS}})
+
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f,
+                                numbers=np.array(numbers, dtype=str),
+                                meta=np.array(json.dumps(meta, ensure_ascii=False)),
+                                **arrays)
+        os.replace(tmp_path, self.snapshot_path)
+
+        for stale in (self.journal_path, self.legacy_path):
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    def _read_snapshot(self):
+        with np.load(self.snapshot_path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            numbers = data["numbers"]
+            autos = {}
+            for i, entry in enumerate(meta.pop("autos", [])):
+                auto = {k: entry.get(k) for k in AUTO_FIELDS}
+                auto["invoice_ids"] = numbers[data[f"auto_{i}"]].tolist()
+                autos[entry["id"]] = auto
+        meta.pop("format_version", None)
+        meta["autos"] = autos
+        return meta
+
+    # --- DAMs consolidados (Multi-Ano) ---
+
+    def write_dam_frame(self, dam_frame):
+        """Grava o frame de DAMs que só existe em memória; devolve o caminho a guardar na sessão."""
+        arrays = {c: dam_frame[c].fillna('').astype(str).to_numpy(dtype=str) for c in DAM_TEXT_COLUMNS}
+        arrays.update({c: dam_frame[c].to_numpy(dtype=np.float64) for c in DAM_NUMBER_COLUMNS})
+        tmp_path = self.dams_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, self.dams_path)
+        return self.dams_path
+
+    def read_dam_frame(self):
+        with np.load(self.dams_path, allow_pickle=False) as data:
+            columns = {c: data[c].astype(object) if c in DAM_TEXT_COLUMNS else data[c] for c in DAM_COLUMNS}
+        frame = pd.DataFrame(columns)
+        # Competência inválida é None no frame original (não entra na alocação)
+        frame['competencia'] = frame['competencia'].where(frame['competencia'] != '', None)
+        return frame
+
+    # --- Diário ---
+
+    def append(self, entries):
+        """Acrescenta edições ao diário (uma linha JSON cada)."""
+        if not entries:
+            return
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+
+    def _replay_journal(self, session_data):
+        applied = 0
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Última linha incompleta (aplicação fechada a meio da escrita)
+                    logging.warning(f"Diário de sessão truncado em '{self.journal_path}'; o resto é ignorado.")
+                    break
+                apply_journal_entry(session_data, entry)
+                applied += 1
+        return applied
+
+    # --- Leitura / compactação ---
+
+    def read(self):
+        """Devolve a sessão (snapshot + diário) no formato do antigo JSON, ou None."""
+        if os.path.exists(self.snapshot_path):
+            session_data = self._read_snapshot()
+        elif os.path.exists(self.legacy_path):
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                session_data = json.load(f)
+        elif os.path.exists(self.journal_path):
+            session_data = {"autos": {}}
+        else:
+            return None
+
+        if os.path.exists(self.journal_path):
+            self._replay_journal(session_data)
+        return session_data
+
+    def compact(self):
+        """Incorpora o diário no snapshot (chamado ao fechar o assistente)."""
+        if not os.path.exists(self.journal_path):
+            return
+        session_data = self.read()
+        if session_data is not None:
+            self.write_snapshot(session_data)
+
+
+def apply_journal_entry(session_data, entry):
+    autos = session_data.setdefault("autos", {})
+    op = entry.get("op")
+    auto_id = entry.get("auto")
+
+    if op == "put":
+        autos[auto_id] = entry["data"]
+    elif op == "delete":
+        autos.pop(auto_id, None)
+    elif op == "move" and auto_id in autos:
+        removed = set(entry.get("remove", []))
+        ids = [n for n in autos[auto_id].get("invoice_ids", []) if n not in removed]
+        present = set(ids)
+        ids.extend(n for n in entry.get("add", []) if n not in present)
+        autos[auto_id]["invoice_ids"] = ids
+    elif op == "update" and auto_id in autos:
+        autos[auto_id].update(entry.get("fields", {}))
+    elif op == "meta":
+        session_data.update(entry.get("fields", {}))
+
+
+class SessionJournal:
+    """
+    Compara o estado atual da sessão com o último estado gravado e produz as
+    entradas do diário: 'move' (notas adicionadas/removidas), 'update'
+    (alíquota, overrides mensais, motivo, texto), 'put'/'delete' (autos) e 'meta'.
+    """
+
+    def __init__(self):
+        self._baseline = None
+
+    @property
+    def active(self):
+        return self._baseline is not None
+
+    def reset(self, session_data):
+        """Define o estado já persistido (após gravar ou restaurar a sessão)."""
+        self._baseline = copy.deepcopy(session_data)
+
+    def stop(self):
+        self._baseline = None
+
+    def diff(self, session_data):
+        if self._baseline is None:
+            return []
+
+        entries = []
+        old_autos = self._baseline.get("autos", {})
+        new_autos = session_data.get("autos", {})
+
+        for auto_id in old_autos.keys() - new_autos.keys():
+            entries.append({"op": "delete", "auto": auto_id})
+
+        for auto_id, new in new_autos.items():
+            old = old_autos.get(auto_id)
+            if old is None:
+                entries.append({"op": "put", "auto": auto_id, "data": new})
+                continue
+
+            if old.get("invoice_ids") != new.get("invoice_ids"):
+                old_ids, new_ids = set(old.get("invoice_ids", [])), set(new.get("invoice_ids", []))
+                added = [n for n in new.get("invoice_ids", []) if n not in old_ids]
+                removed = [n for n in old.get("invoice_ids", []) if n not in new_ids]
+                if added or removed:
+                    entries.append({"op": "move", "auto": auto_id, "add": added, "remove": removed})
+
+            changed = {k: new.get(k) for k in AUTO_FIELDS if old.get(k) != new.get(k)}
+            if changed:
+                entries.append({"op": "update", "auto": auto_id, "fields": changed})
+
+        changed_meta = {k: v for k, v in session_data.items()
+                        if k not in ("autos", "timestamp") and self._baseline.get(k) != v}
+        if entries or changed_meta:
+            changed_meta["timestamp"] = session_data.get("timestamp")
+            entries.append({"op": "meta", "fields": changed_meta})
+            self._baseline = copy.deepcopy(session_data)
+        return entries
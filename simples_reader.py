@@ -6,9 +6,9 @@ from PIL import Image, ImageOps, ImageEnhance
 import io
 import re
 import os
-import pandas as pd
 from datetime import datetime, timedelta
 from PySide6.QtCore import QThread
+from app.excel_export import StreamingExcelWriter
 
 # --- CONFIGURATION ---
 DEFAULT_TESS_PATH = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
@@ -287,6 +287,8 @@ def consolidate_status(year_statuses):
         
     return ", ".join([f"{s.strftime('%d/%m/%Y')}-{e.strftime('%d/%m/%Y')}" for s, e in merged])
 
+RESULT_COLUMNS = ["Pasta", "Arquivo", "Status"]
+
 def run_simples_reader(root_folder, target_years, progress_callback):
     # 1. Install Check
     installed, msg = verify_tesseract_installed()
@@ -299,49 +301,61 @@ def run_simples_reader(root_folder, target_years, progress_callback):
     progress_callback.emit("--- Iniciando Leitura (Overhaul Híbrido) ---")
     progress_callback.emit("Estratégia: Texto Digital (Prioridade) -> OCR (Backup)")
     
-    results = []
+    # O .xlsx é criado no primeiro resultado e cada pasta é gravada assim que lida:
+    # uma leitura interrompida deixa o ficheiro parcial com as pastas já processadas
+    book = None
+    sheet = None
+    out = None
     stopped = False
     
-    for root, dirs, files in os.walk(root_folder):
-        if check_stop_flag(): stopped = True; break
-        
-        target_file = None
-        for f in files:
-            if f.lower().endswith(".pdf") and ("optante" in f.lower() or "simples" in f.lower()):
-                target_file = f
-                break
-        
-        if target_file:
-            path = os.path.join(root, target_file)
-            progress_callback.emit(f"Processando: {target_file}")
-            
-            # STEP 1: Get Content (Hybrid)
-            text = get_pdf_content_hybrid(path)
+    try:
+        for root, dirs, files in os.walk(root_folder):
+            if check_stop_flag(): stopped = True; break
             
-            if text == "STOPPED": stopped = True; break
+            target_file = None
+            for f in files:
+                if f.lower().endswith(".pdf") and ("optante" in f.lower() or "simples" in f.lower()):
+                    target_file = f
+                    break
             
-            # STEP 2: Analyze
-            yr_stats = {}
-            for y in target_years:
-                yr_stats[y] = analyze_simples_data(text, y)
+            if target_file:
+                path = os.path.join(root, target_file)
+                progress_callback.emit(f"Processando: {target_file}")
                 
-            final = consolidate_status(yr_stats)
-            
-            results.append({
-                "Pasta": os.path.basename(root),
-                "Arquivo": target_file,
-                "Status": final
-            })
+                # STEP 1: Get Content (Hybrid)
+                text = get_pdf_content_hybrid(path)
+                
+                if text == "STOPPED": stopped = True; break
+                
+                # STEP 2: Analyze
+                yr_stats = {}
+                for y in target_years:
+                    yr_stats[y] = analyze_simples_data(text, y)
+                    
+                final = consolidate_status(yr_stats)
+                
+                if book is None:
+                    ts = datetime.now().strftime("%H%M%S")
+                    out = os.path.join(root_folder, f"Resultado_Simples_{ts}.xlsx")
+                    book = StreamingExcelWriter(out)
+                    sheet = book.add_sheet("Folha1", RESULT_COLUMNS, default_width=30)
+                sheet.write_row({
+                    "Pasta": os.path.basename(root),
+                    "Arquivo": target_file,
+                    "Status": final
+                })
+    finally:
+        if book is not None:
+            book.close()
             
     if stopped:
-        progress_callback.emit("🛑 Interrompido.")
+        if book is not None:
+            progress_callback.emit(f"🛑 Interrompido. Resultado parcial ({sheet.rows_written} pastas) em: {out}")
+        else:
+            progress_callback.emit("🛑 Interrompido.")
         return None
         
-    if results:
-        df = pd.DataFrame(results)
-        ts = datetime.now().strftime("%H%M%S")
-        out = os.path.join(root_folder, f"Resultado_Simples_{ts}.xlsx")
-        df.to_excel(out, index=False)
+    if book is not None:
         progress_callback.emit(f"Salvo em: {out}")
         return out
     else:
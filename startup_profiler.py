@@ -0,0 +1,177 @@
+# --- FILE: app/startup_profiler.py ---
+"""
+Instrumentação do arranque da aplicação (cold start).
+
+Modo de perfil dentro da GUI:
+    python gui.py --profile-startup        (ou CARONTE_PROFILE_STARTUP=1)
+    -> grava 'startup_profile.txt' com a linha temporal até à primeira pintura
+       e a árvore de imports (tempo cumulativo de cada primeira importação).
+
+Verificação do orçamento de importação (antes de cada build / em CI):
+    python -m app.startup_profiler --budget 3.0
+    -> importa app.main_window num processo limpo e sai com código != 0 se o
+       tempo ultrapassar o orçamento ou se algum módulo pesado for carregado.
+"""
+
+import builtins
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+PROFILE_FLAG = "--profile-startup"
+PROFILE_ENV_VAR = "CARONTE_PROFILE_STARTUP"
+REPORT_FILENAME = "startup_profile.txt"
+DEFAULT_IMPORT_BUDGET_S = 3.0
+MAIN_WINDOW_MODULE = "app.main_window"
+
+# Subsistemas que só devem ser importados pelas ações/menus que os usam
+HEAVY_MODULES = (
+    "spacy", "fitz", "pytesseract", "DrissionPage", "pywinauto",
+    "docx", "docxtpl", "docx2pdf", "fpdf", "openpyxl", "PyPDF2",
+)
+
+_T0 = time.perf_counter()
+_marks = []
+_import_records = []  # [depth, nome, segundos]
+_depth = 0
+_original_import = None
+
+
+def is_enabled(argv=None):
+    argv = sys.argv if argv is None else argv
+    return PROFILE_FLAG in argv or os.environ.get(PROFILE_ENV_VAR) == "1"
+
+
+def mark(label):
+    """Regista um ponto na linha temporal do arranque (segundos desde o início)."""
+    _marks.append((label, time.perf_counter() - _T0))
+
+
+def install():
+    """Envolve __import__ para medir cada importação nova feita pela thread principal."""
+    global _original_import
+    if _original_import is not None:
+        return
+    _original_import = builtins.__import__
+    main_thread = threading.main_thread()
+
+    def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        global _depth
+        if threading.current_thread() is not main_thread:
+            return _original_import(name, globals, locals, fromlist, level)
+
+        known_modules = len(sys.modules)
+        if level and globals:
+            # Import relativo: mostra o nome absoluto aproximado (pacote + nome)
+            name_label = ".".join(p for p in (globals.get("__package__"), name) if p)
+        else:
+            name_label = name
+        record = [_depth, name_label, 0.0]
+        slot = len(_import_records)
+        _import_records.append(record)
+        _depth += 1
+        start = time.perf_counter()
+        try:
+            return _original_import(name, globals, locals, fromlist, level)
+        finally:
+            _depth -= 1
+            record[2] = time.perf_counter() - start
+            # Import já em cache: não interessa para a árvore
+            if len(sys.modules) == known_modules and len(_import_records) == slot + 1:
+                _import_records.pop()
+
+    builtins.__import__ = _timed_import
+
+
+def uninstall():
+    global _original_import
+    if _original_import is not None:
+        builtins.__import__ = _original_import
+        _original_import = None
+
+
+def loaded_heavy_modules():
+    return [m for m in HEAVY_MODULES if m in sys.modules]
+
+
+def write_report(path=REPORT_FILENAME, min_ms=1.0):
+    """Grava a linha temporal e a árvore de imports (entradas abaixo de min_ms são omitidas)."""
+    lines = ["=== Linha temporal do arranque ==="]
+    for label, seconds in _marks:
+        lines.append(f"{seconds * 1000:10.1f} ms  {label}")
+
+    heavy = loaded_heavy_modules()
+    lines.append("")
+    lines.append(f"Módulos pesados carregados no arranque: {', '.join(heavy) if heavy else 'nenhum'}")
+
+    lines.append("")
+    lines.append("=== Árvore de imports (tempo cumulativo) ===")
+    for depth, name, seconds in _import_records:
+        if seconds * 1000 >= min_ms:
+            lines.append(f"{seconds * 1000:10.1f} ms  {'  ' * depth}{name}")
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def measure_cold_import(module=MAIN_WINDOW_MODULE, python=None, cwd=None):
+    """
+    Importa `module` num interpretador novo e devolve
+    {'seconds': float, 'heavy': [..]} ou levanta RuntimeError se a importação falhar.
+    """
+    code = (
+        "import sys, time, json\n"
+        "t = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - t\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps({'seconds': elapsed, 'heavy': heavy}))\n"
+    )
+    if cwd is None:
+        # Raiz do projeto (pasta que contém 'app/')
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run([python or sys.executable, "-c", code],
+                          capture_output=True, text=True, cwd=cwd)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Falha ao importar {module}:\n{proc.stderr.strip()}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def check_import_budget(budget_s=DEFAULT_IMPORT_BUDGET_S, module=MAIN_WINDOW_MODULE, runs=3):
+    """Devolve (ok, mensagem). Usa o melhor de `runs` medições para reduzir ruído."""
+    results = [measure_cold_import(module) for _ in range(max(1, runs))]
+    best = min(r["seconds"] for r in results)
+    heavy = sorted(set(m for r in results for m in r["heavy"]))
+
+    problems = []
+    if best > budget_s:
+        problems.append(f"importação de {module} demorou {best:.2f}s (orçamento: {budget_s:.2f}s)")
+    if heavy:
+        problems.append(f"módulos pesados importados no arranque: {', '.join(heavy)}")
+
+    if problems:
+        return False, "❌ " + "; ".join(problems)
+    return True, f"✅ {module} importado em {best:.2f}s (orçamento: {budget_s:.2f}s)"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Verifica o orçamento de importação da janela principal.")
+    parser.add_argument("--budget", type=float, default=DEFAULT_IMPORT_BUDGET_S,
+                        help="Tempo máximo (s) para importar a janela principal.")
+    parser.add_argument("--module", default=MAIN_WINDOW_MODULE)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    try:
+        ok, message = check_import_budget(args.budget, args.module, args.runs)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(2)
+    print(message)
+    sys.exit(0 if ok else 1)
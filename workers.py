@@ -6,16 +6,18 @@ import traceback
 import logging
 from PySide6.QtCore import QObject, Signal, QCoreApplication
 import multiprocessing
-from app.generation_task import run_generation_task
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from app.shared_memory import share_dataframe
-from app.updater import Updater
 import os
-import copy
 from datetime import datetime
 from app.constants import Columns
-from data_loader import _load_and_process_dams
+from data_loader import _load_and_process_dams, read_dam_report, consolidate_dam_reports
 from app.pgdas_loader import _load_and_process_pgdas
 from document_parts import format_invoice_numbers
+from invoice_schema import apply_invoice_schema
+from legal_deadlines import mark_paid_decadence
+from app.auto_membership import positions_of, auto_positions, auto_labels
+from app.credit_ledger import CreditLedger, DAM
 import tempfile
 import glob
 import urllib.request
@@ -48,6 +50,7 @@ class UpdateCheckerWorker(QObject):
     def run(self):
         logger = logging.getLogger(__name__)
         try:
+            from app.updater import Updater  # Lazy: requests/packaging only when checking
             updater = Updater()
             available, url, ver = updater.check_for_updates()
             self.finished.emit(available, url, ver)
@@ -65,6 +68,7 @@ class UpdateDownloaderWorker(QObject):
     def run(self):
         logger = logging.getLogger(__name__)
         try:
+            from app.updater import Updater
             updater = Updater()
             success = updater.download_and_install(self.download_url, status_callback=self.progress.emit)
             if success: self.reboot_requested.emit()
@@ -125,13 +129,38 @@ class AIAnalysisWorker(BaseWorker):
         except Exception:
             self.error.emit(f"❌ Erro durante a análise de descrição (IA):\n{traceback.format_exc()}")
 
+def list_multi_year_files(folder_path):
+    """Returns (invoice_files, dam_files) of a multi-year folder."""
+    invoice_files = []
+    for f in glob.glob(os.path.join(folder_path, "*.xls*")):
+        fname = os.path.basename(f).lower()
+        if "controle_de_atividades" in fname: continue
+        if "~$" in fname: continue
+        # Logic: Exclude only DAM reports
+        if "dam" in fname and "relatorio" in fname: continue 
+        
+        invoice_files.append(f)
+
+    dam_files = glob.glob(os.path.join(folder_path, "*Relatorio_DAMS*.csv"))
+    dam_files += glob.glob(os.path.join(folder_path, "*Relatorio_DAMS*.xls*"))
+    return invoice_files, dam_files
+
+
+def _load_invoice_workbook(master_path, invoice_path, cnpj):
+    """Runs in a pool process: one invoice workbook, duplicates preserved for review."""
+    from main import load_and_prepare_invoices
+    # ✅ FIXED: auto_resolve_conflicts=False to PRESERVE duplicates for review
+    return load_and_prepare_invoices(master_path, invoice_path, cnpj, auto_resolve_conflicts=False)
+
+
 class MultiYearPrepWorker(BaseWorker):
     """
     Scans a folder for Invoice Excels and DAM CSVs/Excels.
-    Merges them into single datasets and PREPARES CONFLICTS for UI review.
-    ✅ FIXED: Disable auto-resolve in inner loop to catch intra-file duplicates.
+    Parses all of them concurrently on a process pool, concatenates each kind once
+    and PREPARES CONFLICTS for UI review. DAMs are returned as an in-memory typed
+    frame (see data_loader.build_dam_frame), or None when the folder has none.
     """
-    finished = Signal(pd.DataFrame, str) 
+    finished = Signal(pd.DataFrame, object) 
 
     def __init__(self, folder_path, master_path, cnpj):
         super().__init__()
@@ -139,66 +168,46 @@ class MultiYearPrepWorker(BaseWorker):
         self.master_path = master_path
         self.cnpj = cnpj
 
-    def _normalize_dam_df(self, df):
-        if df is None or df.empty: return df
-        df.columns = df.columns.astype(str).str.strip().str.replace(r'^[^\w]+', '', regex=True)
-        col_map = {
-            'codigoVerificacao': 'codigoVerificacao', 'Código Verificação': 'codigoVerificacao',
-            'Codigo Verificacao': 'codigoVerificacao', 'Código de Verificação': 'codigoVerificacao', 
-            'Codigo': 'codigoVerificacao', 'Verificação': 'codigoVerificacao',
-            'Competência': 'referenciaPagamento', 'referenciaPagamento': 'referenciaPagamento',
-            'Referência': 'referenciaPagamento',
-            'receita': 'receita', 'Receita': 'receita',
-            'Valor': 'totalRecolher', 'Valor Pago': 'totalRecolher', 'totalRecolher': 'totalRecolher'
-        }
-        new_cols = {}
-        for col in df.columns:
-            c = str(col).strip()
-            if c in col_map: 
-                new_cols[col] = col_map[c]
-            else:
-                for k,v in col_map.items():
-                    if k.lower() == c.lower(): 
-                        new_cols[col] = v
-                        break
-        if new_cols: df.rename(columns=new_cols, inplace=True)
-        return df
+    def _parse_all(self, invoice_files, dam_files):
+        """Returns ({path: invoices_df}, {path: raw_dam_df}) in completion order."""
+        invoice_frames, dam_frames = {}, {}
+        max_workers = max(1, min(len(invoice_files) + len(dam_files), os.cpu_count() or 1))
+        ctx = multiprocessing.get_context('spawn')
+
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as pool:
+            futures = {pool.submit(_load_invoice_workbook, self.master_path, f, self.cnpj): (f, invoice_frames)
+                       for f in invoice_files}
+            futures.update({pool.submit(read_dam_report, f): (f, dam_frames) for f in dam_files})
+
+            for future in as_completed(futures):
+                path, target = futures[future]
+                name = os.path.basename(path)
+                try:
+                    target[path] = future.result()
+                    self.progress.emit(f"   - Lido: {name}")
+                except Exception as e:
+                    kind = "nota" if target is invoice_frames else "DAM"
+                    self.progress.emit(f"   ⚠️ Erro ao ler {kind} {name}: {e}")
+        return invoice_frames, dam_frames
 
     def run(self):
         try:
-            from main import load_and_prepare_invoices
-            
             self.progress.emit(f"📂 Escaneando pasta: {self.folder_path}")
 
-            # --- 1. INVOICE LOADING ---
-            all_files = glob.glob(os.path.join(self.folder_path, "*.xls*"))
-            invoice_files = []
-            
-            for f in all_files:
-                fname = os.path.basename(f).lower()
-                if "controle_de_atividades" in fname: continue
-                if "~$" in fname: continue
-                # Logic: Exclude only DAM reports
-                if "dam" in fname and "relatorio" in fname: continue 
-                
-                invoice_files.append(f)
+            # --- 1. FILE DISCOVERY ---
+            invoice_files, dam_files = list_multi_year_files(self.folder_path)
 
             if not invoice_files:
                 self.error.emit("❌ Nenhum ficheiro de notas (Excel) encontrado na pasta.")
                 return
 
-            merged_df = pd.DataFrame()
-            self.progress.emit(f"🔄 Carregando {len(invoice_files)} ficheiros de notas...")
-            
-            for f in invoice_files:
-                self.progress.emit(f"   - Lendo: {os.path.basename(f)}")
-                try:
-                    # ✅ FIXED: auto_resolve_conflicts=False to PRESERVE duplicates for review
-                    df = load_and_prepare_invoices(self.master_path, f, self.cnpj, auto_resolve_conflicts=False)
-                    if not df.empty:
-                        merged_df = pd.concat([merged_df, df], ignore_index=True)
-                except Exception as e:
-                    self.progress.emit(f"   ⚠️ Erro ao ler nota {os.path.basename(f)}: {e}")
+            # --- 2. PARALLEL PARSING (invoices + DAMs) ---
+            self.progress.emit(f"🔄 Carregando {len(invoice_files)} ficheiros de notas e {len(dam_files)} de DAMs em paralelo...")
+            invoice_frames, dam_frames = self._parse_all(invoice_files, dam_files)
+
+            # Single concat, in folder order (keeps the conflict tie-break deterministic)
+            frames = [invoice_frames[f] for f in invoice_files if f in invoice_frames and not invoice_frames[f].empty]
+            merged_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
             if merged_df.empty:
                 self.error.emit("❌ Dados vazios após leitura dos arquivos de notas.")
@@ -209,18 +218,14 @@ class MultiYearPrepWorker(BaseWorker):
                 merged_df['status_manual'] = None
             if '_is_conflict' not in merged_df.columns:
                 merged_df['_is_conflict'] = False
+            # Categoricals with different categories per file come out of concat as object
+            apply_invoice_schema(merged_df)
+
+            # --- 3. MULTI-YEAR CONFLICT DETECTION ---
+            from conflict_resolution import rank_conflicts, find_column, ID_SYNONYMS
 
-            # --- 2. MULTI-YEAR CONFLICT DETECTION ---
-            
             # ✅ FIX: Robust ID Column Finder
-            id_col = None
-            possible_ids = ['NÚMERO', 'NUMERO', 'NUMBER', 'NO', 'Nº']
-            upper_cols = {c.upper(): c for c in merged_df.columns}
-            
-            for p in possible_ids:
-                if p in upper_cols:
-                    id_col = upper_cols[p]
-                    break
+            id_col = find_column(merged_df.columns, ID_SYNONYMS)
             
             if id_col:
                 self.progress.emit(f"   🔍 Analisando conflitos (Coluna ID: {id_col})...")
@@ -231,44 +236,8 @@ class MultiYearPrepWorker(BaseWorker):
                     .astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
                 )
                 
-                # 2. Smart Sort
-                desc_synonyms = ['DISCRIMINAÇÃO DOS SERVIÇOS', 'DISCRIMINACAO DOS SERVICOS', 'DESCRIÇÃO', 'DESC']
-                desc_col = None
-                
-                # Re-map upper cols in case they changed (unlikely but safe)
-                upper_cols = {c.upper(): c for c in merged_df.columns}
-                for t in desc_synonyms:
-                    if t in upper_cols:
-                        desc_col = upper_cols[t]
-                        break
-
-                if desc_col:
-                    merged_df['_desc_len'] = merged_df[desc_col].astype(str).str.len()
-                else:
-                    merged_df['_desc_len'] = 0
-                
-                if 'ALÍQUOTA' not in merged_df.columns: merged_df['ALÍQUOTA'] = 0.0
-                if 'VALOR' not in merged_df.columns: merged_df['VALOR'] = 0.0
-                
-                # Sort: ID (Asc), Aliquot (Desc), Value (Desc), DescLen (Desc)
-                merged_df.sort_values(
-                    by=[id_col, 'ALÍQUOTA', 'VALOR', '_desc_len'], 
-                    ascending=[True, False, False, False], 
-                    inplace=True
-                )
-                merged_df.drop(columns=['_desc_len'], inplace=True)
-
-                # 3. Detect Conflicts (COMBINED)
-                # Combine intra-file conflicts (already in _is_conflict) with inter-file conflicts (duplicated now)
-                
-                # Check for duplicates across the whole merged set
-                inter_file_duplicates = merged_df.duplicated(subset=[id_col], keep=False)
-                
-                # OR logic: True if it was already a conflict OR if it is a conflict now in the merge
-                # FillNA(False) ensures boolean operation works
-                merged_df['_is_conflict'] = merged_df['_is_conflict'].fillna(False) | inter_file_duplicates
-                
-                conflict_count = merged_df[merged_df['_is_conflict']][id_col].nunique()
+                # 2. Rank over the whole merged set (intra-file + inter-file duplicates, no re-sort)
+                conflict_count = rank_conflicts(merged_df, id_col)
                 
                 if conflict_count > 0:
                     self.progress.emit(f"   ⚠️ Encontrados {conflict_count} conflitos entre arquivos/anos.")
@@ -278,44 +247,14 @@ class MultiYearPrepWorker(BaseWorker):
                  self.progress.emit("   ⚠️ Aviso: Coluna NÚMERO não encontrada. Pulo verificação de conflitos.")
                  merged_df['_is_conflict'] = False
 
-            # --- 3. DAM LOADING ---
-            dam_files = glob.glob(os.path.join(self.folder_path, "*Relatorio_DAMS*.csv"))
-            dam_files += glob.glob(os.path.join(self.folder_path, "*Relatorio_DAMS*.xls*"))
-            merged_dams_path = ""
-            
-            if dam_files:
-                self.progress.emit(f"🔄 Consolidando {len(dam_files)} ficheiros de DAMs...")
-                dam_dfs = []
-                for df_path in dam_files:
-                    try:
-                        df = None
-                        if df_path.lower().endswith('.csv'):
-                            try: df = pd.read_csv(df_path, on_bad_lines='skip', sep=None, engine='python')
-                            except: pass
-                        else:
-                            df = pd.read_excel(df_path)
-                        
-                        if df is not None:
-                            df = self._normalize_dam_df(df)
-                            dam_dfs.append(df)
-                    except Exception: pass
-
-                if dam_dfs:
-                    full_dam_df = pd.concat(dam_dfs, ignore_index=True)
-                    # Deduplicate DAMs
-                    subset_cols = ['codigoVerificacao']
-                    if 'referenciaPagamento' in full_dam_df.columns: subset_cols.append('referenciaPagamento')
-                    if 'codigoVerificacao' in full_dam_df.columns:
-                         full_dam_df['codigoVerificacao'] = full_dam_df['codigoVerificacao'].astype(str).str.strip()
-                    full_dam_df.drop_duplicates(subset=subset_cols, inplace=True)
-                    
-                    temp = tempfile.NamedTemporaryFile(delete=False, suffix="_consolidated_auto_dams.csv", mode='w', encoding='utf-8')
-                    full_dam_df.to_csv(temp.name, index=False, sep=',') 
-                    temp.close()
-                    merged_dams_path = temp.name
-                    self.progress.emit(f"✅ {len(dam_dfs)} arquivos de DAMs unidos.")
+            # --- 4. DAM CONSOLIDATION (in memory, no temp CSV) ---
+            dam_frame = None
+            raw_dams = [dam_frames[f] for f in dam_files if f in dam_frames]
+            if raw_dams:
+                dam_frame = consolidate_dam_reports(raw_dams)
+                self.progress.emit(f"✅ {len(raw_dams)} arquivos de DAMs unidos ({len(dam_frame)} pagamentos avulsos).")
 
-            self.finished.emit(merged_df, merged_dams_path)
+            self.finished.emit(merged_df, dam_frame)
 
         except Exception as e:
             self.error.emit(f"❌ Erro na consolidação:\n{traceback.format_exc()}")
@@ -330,36 +269,9 @@ class RulesPrepWorker(BaseWorker):
     def run(self):
         try:
             from main import perform_rules_analysis
-            # 1. Run Standard Analysis
-            infraction_groups, df_with_analysis = perform_rules_analysis(self.all_invoices_df, idd_mode=self.idd_mode)
-            
-            # 2. SPLIT GROUPS BY YEAR
-            split_groups = {}
-            for group_name, df_group in infraction_groups.items():
-                if df_group.empty: continue
-                
-                if 'DATA EMISSÃO' not in df_group.columns:
-                    split_groups[group_name] = df_group
-                    continue
-                
-                # Temp year column
-                df_group['__temp_year'] = pd.to_datetime(df_group['DATA EMISSÃO'], errors='coerce').dt.year
-                unique_years = sorted(df_group['__temp_year'].dropna().unique())
-
-                if len(unique_years) <= 1:
-                    # Single year or no year -> Keep original name
-                    split_groups[group_name] = df_group
-                else:
-                    # Multiple years -> Split
-                    for year in unique_years:
-                        new_key = f"{group_name} ({int(year)})"
-                        year_df = df_group[df_group['__temp_year'] == year].copy()
-                        del year_df['__temp_year']
-                        split_groups[new_key] = year_df
-
-            if '__temp_year' in df_with_analysis.columns:
-                del df_with_analysis['__temp_year']
-
+            # Analysis + groups already split by year ("<group> (<year>)") in one pass
+            split_groups, df_with_analysis = perform_rules_analysis(self.all_invoices_df, idd_mode=self.idd_mode,
+                                                                    split_by_year=True)
             self.finished.emit(split_groups, df_with_analysis)
         except Exception:
             self.error.emit(f"❌ Erro na análise de regras:\n{traceback.format_exc()}")
@@ -393,6 +305,8 @@ class GenerationWorker(QObject):
         try: multiprocessing.set_start_method('spawn', force=True)
         except RuntimeError: pass
         except Exception as e: logging.warning(f"Não foi possível forçar 'spawn': {e}")
+        # Lazy: a geração (docx/fpdf/openpyxl) só é importada quando é pedida
+        from app.generation_task import run_generation_task
         self.queue = multiprocessing.Queue()
         self.process = multiprocessing.Process(target=run_generation_task, args=(self.queue, self.generation_args))
         self.stop_signal.connect(self.stop) 
@@ -524,6 +438,58 @@ class ValidationExtractorWorker(BaseWorker):
         except Exception:
             self.error.emit(f"❌ Erro Crítico:\n{traceback.format_exc()}")
 
+class PaymentSourcesWorker(BaseWorker):
+    """
+    Re-reads the DAM CSV and the PGDAS folder of a restored session off the GUI thread.
+    Both loaders cache by file mtime/size, so unchanged sources come back almost instantly.
+    Each source is loaded on its own: a DAM parse error does not discard the PGDAS map.
+    `tag` is emitted back unchanged so the caller can drop results of superseded jobs.
+    """
+    finished = Signal(dict, dict, object)  # (dam_payments_map, pgdas_payments_map, tag)
+    def __init__(self, dam_path, pgdas_path, tag=None):
+        super().__init__()
+        self.dam_path = dam_path
+        self.pgdas_path = pgdas_path
+        self.tag = tag
+    def run(self):
+        dam_map, pgdas_map = {}, {}
+        errors = []
+        if self.dam_path and os.path.exists(self.dam_path):
+            try:
+                dam_map = _load_and_process_dams(self.dam_path)
+            except Exception:
+                errors.append(f"❌ Erro ao recarregar os DAMs da sessão:\n{traceback.format_exc()}")
+        if self.pgdas_path and os.path.exists(self.pgdas_path):
+            try:
+                pgdas_map = _load_and_process_pgdas(self.pgdas_path, self.progress)
+            except Exception:
+                errors.append(f"❌ Erro ao recarregar os PGDAS da sessão:\n{traceback.format_exc()}")
+        # Whatever loaded is delivered first; the failures are reported after it
+        self.finished.emit(dam_map, pgdas_map, self.tag)
+        for message in errors:
+            self.error.emit(message)
+
+class WorkspaceSaveWorker(BaseWorker):
+    """
+    Writes the company workspace (frame pickles + meta.json) off the GUI thread.
+    It receives snapshots of the frames, so the analysis can keep changing meanwhile.
+    """
+    finished = Signal(object, list)  # (WorkspaceStore, described sources)
+    def __init__(self, store, source_paths, workflow_state, frames, sources=None):
+        super().__init__()
+        self.store = store
+        self.source_paths = source_paths
+        self.workflow_state = workflow_state
+        self.frames = frames
+        self.sources = sources
+    def run(self):
+        try:
+            sources = self.store.save(self.source_paths, self.workflow_state,
+                                      sources=self.sources, **self.frames)
+            self.finished.emit(self.store, sources)
+        except Exception as e:
+            self.error.emit(f"Falha ao gravar o workspace: {e}")
+
 class AutomaticIDDWorker(BaseWorker):
     finished = Signal(dict) 
     def __init__(self, imu, year, expected_value, output_folder=None): 
@@ -575,7 +541,7 @@ class HeadlessTaxCalculator:
             rule_name = self.motive_to_rule_map.get(base_motive, 'regra_desconhecida')
             self.autos[auto_id] = {
                 'motive': group_name, 
-                'df': group_df.copy(),
+                'positions': positions_of(self.all_invoices_df, group_df.index),
                 'rule_name': rule_name,
                 'user_defined_aliquota': None, 
                 'user_defined_credito': None
@@ -586,17 +552,17 @@ class HeadlessTaxCalculator:
         # ... (Same logic as in original file, reused here) ...
         final_data = {}
         for auto_id, auto_data in self.autos.items():
-            df = auto_data.get('df')
-            if df is None or df.empty: continue
-            invoice_list = df.index.tolist()
-            first_row = df.iloc[0]
+            positions = auto_positions(auto_data)
+            if not len(positions): continue
             correct_aliquota_val = auto_data.get('user_defined_aliquota')
-            if correct_aliquota_val is None:
-                if 'correct_rate' in df.columns and pd.notna(first_row.get('correct_rate')):
-                    correct_aliquota_val = first_row.get('correct_rate')
+            if correct_aliquota_val is None and 'correct_rate' in self.all_invoices_df.columns:
+                first_rate = self.all_invoices_df['correct_rate'].iloc[positions[0]]
+                if pd.notna(first_rate):
+                    correct_aliquota_val = first_rate
             correct_aliquota_str = f"{correct_aliquota_val:.2f}" if correct_aliquota_val is not None else "5.00"
             final_data[auto_id] = {
-                'invoices': invoice_list,
+                'invoices': auto_labels(self.all_invoices_df, auto_data).tolist(),
+                'positions': positions,
                 'auto_id': auto_id,
                 'rule_name': auto_data['rule_name'],
                 'motive_text': auto_data['motive'],
@@ -609,11 +575,8 @@ class HeadlessTaxCalculator:
         
         all_valid_dates = []
         for auto_info in final_data.values():
-            invoice_indices = auto_info.get('invoices', [])
-            if not invoice_indices: continue
-            df_inv = self.all_invoices_df.loc[invoice_indices].copy()
-            df_inv['DATA EMISSÃO'] = pd.to_datetime(df_inv['DATA EMISSÃO'], errors='coerce')
-            all_valid_dates.extend(df_inv['DATA EMISSÃO'].dropna().tolist())
+            issue_dates = pd.to_datetime(self.all_invoices_df['DATA EMISSÃO'].iloc[auto_info['positions']], errors='coerce')
+            all_valid_dates.extend(issue_dates.dropna().tolist())
 
         all_periods_list = []
         if all_valid_dates:
@@ -628,12 +591,12 @@ class HeadlessTaxCalculator:
             for month in range(1, 13):
                all_periods_list.append(pd.Period(year=current_year, month=month, freq='M'))
 
-        available_credits = {'DAM': copy.deepcopy(self.dam_payments_map), 'PGDAS': {k: v[0] for k, v in self.pgdas_payments_map.items()}}
+        credit_ledger = CreditLedger(self.dam_payments_map, self.pgdas_payments_map)
+        pending_credits = []  # (auto, mês, competência, ISS líquido): DAM alocado num só lote
         autos_context = []
         
         for auto_key, auto_info in final_data.items():
-            invoice_indices = auto_info.get('invoices', [])
-            df_invoices = self.all_invoices_df.loc[invoice_indices].copy()
+            df_invoices = self.all_invoices_df.iloc[auto_info['positions']].copy()
             df_invoices['DATA EMISSÃO'] = pd.to_datetime(df_invoices['DATA EMISSÃO'], errors='coerce')
             df_invoices['_month_str'] = df_invoices['DATA EMISSÃO'].dt.strftime('%m/%Y')
             
@@ -653,11 +616,10 @@ class HeadlessTaxCalculator:
                     df_invoices.at[idx, '_target_rate_group'] = float(target)
             
             dados_anuais = []
-            total_iss_liquido_auto = 0.0; total_iss_op = 0.0; total_iss_bruto_auto = 0.0
+            total_iss_liquido_auto = 0.0; total_iss_bruto_auto = 0.0
             
             for period_key in all_periods_list:
                 period_str_mm_yyyy = period_key.strftime('%m/%Y')
-                period_str_m_yyyy = f"{period_key.month}/{period_key.year}"
                 mask = (df_invoices['DATA EMISSÃO'].dt.to_period('M') == period_key)
                 df_month = df_invoices[mask]
                 if df_month.empty: continue
@@ -682,28 +644,14 @@ class HeadlessTaxCalculator:
                         if is_paid: iss_liquido_calc += max(0, (rate_dec - decl_rate) * v)
                         else: iss_liquido_calc += (rate_dec * v)
 
-                    dams_list = available_credits['DAM'].get(period_str_m_yyyy, [])
-                    available_dam_total = sum(d['val'] for d in dams_list)
-                    dam_utilizado = min(iss_liquido_calc, available_dam_total)
-                    rem = dam_utilizado; codes = []
-                    for d_obj in dams_list:
-                        if rem <= 0.0001: break
-                        if d_obj['val'] > 0:
-                            deduct = min(d_obj['val'], rem)
-                            d_obj['val'] -= deduct
-                            rem -= deduct
-                            codes.append(d_obj['code'])
-                    dam_ident = ", ".join(sorted(set(codes))) if codes else "-"
-                    iss_op = max(0, iss_liquido_calc - dam_utilizado)
                     total_iss_liquido_auto += iss_liquido_calc
-                    total_iss_op += iss_op
                     total_iss_bruto_auto += iss_correto_bruto
                     
                     aliquota_op_display = f'{rate_val:.2f}%'
                     if base_calculo > 0.001: aliquota_declarada_display = f'{(iss_declarado_pago / base_calculo) * 100.0:.2f}%'
                     else: aliquota_declarada_display = "-"
 
-                    dados_anuais.append({
+                    mes_data = {
                         'mes_ano': period_str_mm_yyyy,
                         'base_calculo': base_calculo,
                         'aliquota_op': aliquota_op_display,
@@ -712,11 +660,13 @@ class HeadlessTaxCalculator:
                         'iss_declarado_pago': iss_declarado_pago,
                         'base_calculo_op': base_calculo,
                         'iss_apurado': iss_liquido_calc,
-                        'iss_apurado_op': iss_op,
-                        'dam_iss_pago': dam_utilizado,
-                        'dam_identificacao': dam_ident,
+                        'iss_apurado_op': iss_liquido_calc,
+                        'dam_iss_pago': 0.0,
+                        'dam_identificacao': "-",
                         'das_iss_pago': 0.0, 'das_identificacao': "-", 'das_aliquota': "-", 'dam_aliquota': "-"
-                    })
+                    }
+                    dados_anuais.append(mes_data)
+                    pending_credits.append((auto_key, mes_data, period_key, iss_liquido_calc))
 
             autos_context.append({
                 'numero': auto_key,
@@ -724,7 +674,7 @@ class HeadlessTaxCalculator:
                 'dados_anuais': dados_anuais,
                 'totais': {
                     'iss_apurado': total_iss_liquido_auto,
-                    'iss_apurado_op': total_iss_op,
+                    'iss_apurado_op': 0.0,
                     'iss_apurado_bruto': total_iss_bruto_auto,
                     'base_calculo': total_iss_bruto_auto / (default_aliquota_pct/100) if default_aliquota_pct else 0,
                     'base_calculo_op': total_iss_bruto_auto / (default_aliquota_pct/100) if default_aliquota_pct else 0,
@@ -732,6 +682,15 @@ class HeadlessTaxCalculator:
                 }
             })
 
+        if pending_credits:
+            dam_used, dam_idents = credit_ledger.allocate_many(
+                DAM, [p[2] for p in pending_credits], [p[3] for p in pending_credits], [p[0] for p in pending_credits])
+            for (_, mes_data, _, iss_liquido_calc), used, ident in zip(pending_credits, dam_used, dam_idents):
+                mes_data.update({'dam_iss_pago': float(used), 'dam_identificacao': ident,
+                                 'iss_apurado_op': max(0, iss_liquido_calc - float(used))})
+        for auto in autos_context:
+            auto['totais']['iss_apurado_op'] = sum(m['iss_apurado_op'] for m in auto['dados_anuais'])
+
         summary_autos_list = []
         total_geral = 0.0
         nfs_map = {}
@@ -759,15 +718,14 @@ class HeadlessTaxCalculator:
     def get_final_data(self):
         data = {}
         for auto_id, auto_data in self.autos.items():
-            df = auto_data.get('df')
-            if df is None: continue
+            positions = auto_positions(auto_data)
             correct_aliquota_val = auto_data.get('user_defined_aliquota')
-            if correct_aliquota_val is None and not df.empty:
-                first = df.iloc[0]
-                if 'correct_rate' in df.columns: correct_aliquota_val = first.get('correct_rate')
+            if correct_aliquota_val is None and len(positions):
+                if 'correct_rate' in self.all_invoices_df.columns:
+                    correct_aliquota_val = self.all_invoices_df['correct_rate'].iloc[positions[0]]
             str_rate = f"{correct_aliquota_val:.2f}" if correct_aliquota_val else "5.00"
             data[auto_id] = {
-                'invoices': df.index.tolist(),
+                'invoices': auto_labels(self.all_invoices_df, auto_data).tolist(),
                 'auto_id': auto_id,
                 'rule_name': auto_data['rule_name'],
                 'motive_text': auto_data['motive'],
@@ -1020,9 +978,13 @@ class AnalysisScannerWorker(BaseWorker):
     """
     finished = Signal(str) # Returns path to the generated report
 
-    def __init__(self, root_folder):
+    REPORT_COLUMNS = ['Pasta', 'IMU', 'Ano', 'Status', 'Potencial Total (R$)',
+                      'Potencial IDD (R$)', 'Qtd Autos', 'Detalhes Infrações']
+
+    def __init__(self, root_folder, reference_date=None):
         super().__init__()
         self.root_folder = root_folder
+        self.reference_date = reference_date  # None = today (what-if runs pass another date)
 
     def run(self):
         try:
@@ -1031,9 +993,10 @@ class AnalysisScannerWorker(BaseWorker):
             import pandas as pd
             from main import perform_rules_analysis
             from app.constants import Columns
+            from app.excel_export import StreamingExcelWriter, BRL_FORMAT
             from datetime import datetime
 
-            results = []
+            book = None
             files_to_process = []
 
             # 1. Scan for files first
@@ -1063,6 +1026,16 @@ class AnalysisScannerWorker(BaseWorker):
 
             self.progress.emit(f"📄 Encontrados {total_files} arquivos para análise.")
 
+            output_filename = f"Relatorio_Analitico_Geral_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+            output_path = os.path.join(self.root_folder, output_filename)
+
+            # Cada linha vai para o .xlsx assim que é calculada (memória constante;
+            # um scan interrompido deixa o relatório parcial com o que já foi analisado)
+            book = StreamingExcelWriter(output_path)
+            report = book.add_sheet("Resumo", self.REPORT_COLUMNS, default_width=20,
+                                    formats={'Potencial Total (R$)': BRL_FORMAT,
+                                             'Potencial IDD (R$)': BRL_FORMAT})
+
             # 2. Process each file
             for i, task in enumerate(files_to_process):
                 if self.check_stop(): break
@@ -1083,7 +1056,7 @@ class AnalysisScannerWorker(BaseWorker):
                     df = pd.read_excel(path, engine='openpyxl', skiprows=2)
                     
                     if df.empty:
-                        results.append(self._make_error_row(imu, year, folder_name, "Arquivo Vazio (sem dados)"))
+                        report.write_row(self._make_error_row(imu, year, folder_name, "Arquivo Vazio (sem dados)"))
                         continue
 
                     # B. Column Cleaning & Type Conversion
@@ -1106,7 +1079,7 @@ class AnalysisScannerWorker(BaseWorker):
                         df = df[pd.isna(df['DT. CANCELAMENTO'])]
                         
                     if df.empty:
-                         results.append(self._make_success_row(imu, year, folder_name, 0.0, ["Todas Canceladas"], 0, 0.0))
+                         report.write_row(self._make_success_row(imu, year, folder_name, 0.0, ["Todas Canceladas"], 0, 0.0))
                          continue
 
                     # E. Apply Discount Logic (Net Value)
@@ -1131,25 +1104,18 @@ class AnalysisScannerWorker(BaseWorker):
                     is_paid_mask = df['PAGAMENTO'].str.strip().str.lower().isin(['sim', 'idd'])
                     
                     if 'DATA EMISSÃO' in df.columns:
-                        today = pd.to_datetime(datetime.now().date())
-                        paid_invoices_mask = is_paid_mask & df['DATA EMISSÃO'].notna()
-                        
-                        if paid_invoices_mask.any():
-                             # Art 150: 5 years from payment (approx invoice date here)
-                             # Matches main.py logic: MonthEnd(0) + 5 Years
-                             cutoff_dates_paid = df.loc[paid_invoices_mask, 'DATA EMISSÃO'] + pd.offsets.MonthEnd(0) + pd.DateOffset(years=5)
-                             mask_decadente_paid = today > cutoff_dates_paid
-                             df.loc[mask_decadente_paid[mask_decadente_paid].index, 'status_legal'] = 'Decadente_Pago'
+                        # Art 150: same helper as main.py (legal_deadlines)
+                        mark_paid_decadence(df, is_paid_mask, self.reference_date)
 
                     # ==========================================================
                     # ⚠️  END OF REPLICATION ⚠️
                     # ==========================================================
 
                     # D. Run Rules (idd_mode=False for analytical scan)
-                    infraction_groups, df_analyzed = perform_rules_analysis(df, idd_mode=False)
+                    infraction_groups, df_analyzed = perform_rules_analysis(df, idd_mode=False, reference_date=self.reference_date)
                     
                     if not infraction_groups:
-                        results.append(self._make_success_row(imu, year, folder_name, 0.0, [], 0, 0.0))
+                        report.write_row(self._make_success_row(imu, year, folder_name, 0.0, [], 0, 0.0))
                         continue
 
                     # E. Calculate Potentials
@@ -1174,7 +1140,7 @@ class AnalysisScannerWorker(BaseWorker):
                     motives_str = "; ".join(motives)
                     num_autos = len(autos_summary)
 
-                    results.append(self._make_success_row(
+                    report.write_row(self._make_success_row(
                         imu, year, folder_name, total_credito, 
                         motives_str, num_autos, idd_amount
                     ))
@@ -1182,32 +1148,23 @@ class AnalysisScannerWorker(BaseWorker):
                 except Exception as e:
                     import traceback
                     logging.error(f"Scanner Error on {path}: {traceback.format_exc()}")
-                    results.append(self._make_error_row(imu, year, folder_name, str(e)))
+                    report.write_row(self._make_error_row(imu, year, folder_name, str(e)))
 
             # 3. Save Report
-            if results:
-                self.progress.emit("💾 Salvando relatório final...")
-                df_report = pd.DataFrame(results)
-                
-                output_filename = f"Relatorio_Analitico_Geral_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-                output_path = os.path.join(self.root_folder, output_filename)
-                
-                # Format currency columns for easier reading
-                try:
-                    with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-                        df_report.to_excel(writer, index=False, sheet_name="Resumo")
-                        sheet = writer.sheets["Resumo"]
-                        # Auto-adjust column width (basic)
-                        for column in sheet.columns:
-                            sheet.column_dimensions[column[0].column_letter].width = 20
-                except:
-                    df_report.to_excel(output_path, index=False)
-
+            self.progress.emit("💾 Salvando relatório final...")
+            book.close()
+            if report.rows_written:
                 self.finished.emit(output_path)
             else:
+                os.remove(output_path)
                 self.error.emit("Nenhum resultado gerado.")
 
         except Exception as e:
+            if book is not None:
+                try:
+                    book.close()  # grava o relatório parcial (no-op se já fechado)
+                except Exception:
+                    logging.error(f"Scanner: falha ao gravar relatório parcial {book.path}")
             self.error.emit(f"❌ Erro Crítico no Scanner:\n{traceback.format_exc()}")
 
     def _make_success_row(self, imu, year, folder, total, motives, count, idd_val):
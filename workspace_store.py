@@ -0,0 +1,164 @@
+# --- FILE: app/workspace_store.py ---
+"""
+Workspace por empresa: permite retomar a análise sem reler os Excel de origem.
+
+    workspace_<cnpj>/
+        invoices_clean.pkl     -> notas após a resolução de conflitos (cópia "limpa")
+        invoices_working.pkl   -> cópia de trabalho (relabels, status_manual, saída das regras)
+        infraction_groups.pkl  -> grupos do motor de regras ({nome: DataFrame})
+        dams.pkl               -> DAMs consolidados em memória (Multi-Ano), se houver
+        meta.json              -> versão, fontes (tamanho/mtime/sha1), workflow_state, data
+
+Os DataFrames são gravados em pickle do pandas (dtypes preservados, leitura em
+milissegundos); cada ficheiro é escrito num .tmp e trocado com os.replace.
+O workspace fica desatualizado se algum ficheiro de origem (notas, DAMs, mestre)
+mudar de conteúdo.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+import pandas as pd
+
+from .constants import WORKSPACE_DIR_PREFIX
+
+WORKSPACE_FORMAT_VERSION = 1
+
+# Estados do fluxo de trabalho que fazem sentido retomar ('review' recomeça sempre)
+RESUMABLE_STEPS = ("load", "rules", "ai", "relabel")
+
+# save(frame=UNCHANGED) mantém o ficheiro já gravado desse frame
+UNCHANGED = object()
+
+_FRAMES = {
+    "clean": "invoices_clean.pkl",
+    "working": "invoices_working.pkl",
+    "groups": "infraction_groups.pkl",
+    "dams": "dams.pkl",
+}
+
+
+def _file_sha1(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe_source(path):
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns, "sha1": _file_sha1(path)}
+
+
+def _source_unchanged(entry):
+    """Mesmo tamanho+mtime dispensa o hash; caso contrário compara o sha1 do conteúdo."""
+    path = entry.get("path")
+    if not path or not os.path.exists(path):
+        return False
+    st = os.stat(path)
+    if st.st_size != entry.get("size"):
+        return False
+    if st.st_mtime_ns == entry.get("mtime_ns"):
+        return True
+    return _file_sha1(path) == entry.get("sha1")
+
+
+class WorkspaceStore:
+    """Lê/grava o workspace de uma empresa (pasta 'workspace_<cnpj>')."""
+
+    def __init__(self, cnpj, base_dir="."):
+        sanitized_cnpj = "".join(filter(str.isdigit, str(cnpj)))
+        self.folder = os.path.join(base_dir, f"{WORKSPACE_DIR_PREFIX}{sanitized_cnpj}")
+        self.meta_path = os.path.join(self.folder, "meta.json")
+
+    def _path(self, key):
+        return os.path.join(self.folder, _FRAMES[key])
+
+    def exists(self):
+        return os.path.exists(self.meta_path)
+
+    def read_meta(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("format_version") != WORKSPACE_FORMAT_VERSION:
+            return None
+        return meta
+
+    def is_fresh(self, meta=None):
+        """True se todas as fontes gravadas ainda existem com o mesmo conteúdo."""
+        meta = meta or self.read_meta()
+        if not meta or not meta.get("sources"):
+            return False
+        return all(_source_unchanged(entry) for entry in meta["sources"])
+
+    # --- Gravação ---
+
+    def _write_frame(self, key, obj):
+        if obj is UNCHANGED:
+            return
+        path = self._path(key)
+        if obj is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp_path = path + ".tmp"
+        pd.to_pickle(obj, tmp_path)
+        os.replace(tmp_path, path)
+
+    def save(self, source_paths, workflow_state, clean_df=None, working_df=None,
+             infraction_groups=None, dams_df=None, sources=None):
+        """
+        Grava o estado atual. `sources` (já descritas) evita recalcular o sha1 dos
+        ficheiros de origem a cada gravação; devolve-as para reutilização.
+        Frames passados como UNCHANGED não são reescritos.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        if sources is None:
+            sources = [describe_source(p) for p in source_paths if p and os.path.exists(p)]
+
+        self._write_frame("clean", clean_df)
+        self._write_frame("working", working_df)
+        self._write_frame("groups", infraction_groups or None)
+        self._write_frame("dams", dams_df)
+
+        meta = {
+            "format_version": WORKSPACE_FORMAT_VERSION,
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "sources": sources,
+            "workflow_state": {k: v for k, v in workflow_state.items()
+                               if k in RESUMABLE_STEPS and v != 'running'},
+        }
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.meta_path)
+        return sources
+
+    # --- Leitura ---
+
+    def _read_frame(self, key):
+        path = self._path(key)
+        return pd.read_pickle(path) if os.path.exists(path) else None
+
+    def load(self):
+        """Devolve {'meta', 'clean', 'working', 'groups', 'dams'} ou None se ilegível."""
+        meta = self.read_meta()
+        if meta is None:
+            return None
+        try:
+            data = {key: self._read_frame(key) for key in _FRAMES}
+        except Exception as e:
+            logging.warning(f"Workspace '{self.folder}' ilegível: {e}")
+            return None
+        if data["clean"] is None and data["working"] is None:
+            return None
+        data["groups"] = data["groups"] or {}
+        data["meta"] = meta
+        return data